@@ -1,4 +1,29 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+# programs which serve the site, the pool is only started in their processes
+SERVER_PROGRAMS = ('gunicorn', 'uwsgi')
+
+
+def serves_requests():
+    """
+    Method to tell if the process serves requests: a gunicorn or uwsgi
+    server, or the runserver process the autoreloader restarts. Management
+    commands, test runners, workers and scripts do not
+    """
+    program = sys.argv[0] if sys.argv else ''
+    name = os.path.basename(program)
+    if name == '__main__.py':
+        # started as python -m gunicorn
+        name = os.path.basename(os.path.dirname(program))
+    if name in SERVER_PROGRAMS:
+        return True
+    return (name in ('manage.py', 'django-admin') and sys.argv[1:2] == ['runserver']
+            and (os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv))
 
 
 class ExpensenseConfig(AppConfig):
@@ -9,6 +34,6 @@ class ExpensenseConfig(AppConfig):
         from .models import Category
         Category.create_default_categories()
         import expensense.signals
-
-
-
+        if settings.SIGNATURE_POOL_SIZE and serves_requests():
+            from .scoring import get_pool
+            get_pool().start()
@@ -0,0 +1,689 @@
+"""
+Benchmarks of the expense processing, run them through the benchmark
+management command. Every benchmark returns a JSON serialisable dictionary
+so the results can be compared between releases.
+"""
+
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import cv2
+import numpy as np
+import skimage
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+# the modules of the benchmarks are imported by the processes the signature
+# matching suite spawns, which do not set django up, so the modules which
+# import the models are only imported by the benchmarks using them
+from expensense.ocr_api import OcrClient, parse_text
+from expensense.ocr_backends import RecordedBackend, TesseractBackend, pytesseract
+from expensense.ocr_cache import receipt_digest
+from expensense.ocr_preprocess import compress_receipt
+from expensense.ocr_stub import StubOcrServer, parsed_response
+from expensense.receipt_parser import extract
+from expensense.signature_matching import (calculate_similarity, calculate_similarities,
+                                           cascade_similarity, PRESCREEN_STAGE)
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# registered benchmarks by name
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Decorator to register a benchmark under a name """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def sample_receipts():
+    """ Method to get the paths of the sample receipts shipped with the project """
+    sample_dir = os.path.join(settings.MEDIA_ROOT, 'signature_test')
+    return [os.path.join(sample_dir, name) for name in sorted(os.listdir(sample_dir))]
+
+
+def read_corpus(paths, size):
+    """ Method to read a corpus of encoded images of the given size from the paths """
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return [contents[i % len(contents)] for i in range(size)]
+
+
+def synthetic_photo(path, width=4000):
+    """ Method to get a phone camera sized jpeg made from a sample receipt """
+    img = cv2.imread(path)
+    height = round(img.shape[0] * width / img.shape[1])
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def synthetic_signature(rng):
+    """ Method to draw a random signature like stroke """
+    img = np.full((300, 300), 255, dtype=np.uint8)
+    points = np.cumsum(rng.integers(-25, 26, (12, 2)), axis=0) + 150
+    cv2.polylines(img, [np.clip(points, 20, 280).astype(np.int32)], False, 0, 4)
+    return img
+
+
+def synthetic_receipt(rng, signature, width, height):
+    """ Method to draw a receipt with printed lines, specks and a signature """
+    img = np.full((height, width), 235, dtype=np.uint8)
+    scale = width / 800
+    for line in range(int(height / (40 * scale)) - 8):
+        text = f'ITEM {rng.integers(100)}  {rng.integers(1000)}.{rng.integers(100):02d}'
+        cv2.putText(img, text, (int(40 * scale), int((60 + line * 40) * scale)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9 * scale, 30, max(1, int(2 * scale)))
+    for x, y in zip(rng.integers(0, width, 300), rng.integers(0, height, 300)):
+        cv2.circle(img, (int(x), int(y)), max(1, int(scale)), 0, -1)
+
+    side = min(width, height) // 3
+    top = height - side - int(10 * scale)
+    left = width - side - int(20 * scale)
+    img[top:top + side, left:left + side] = np.minimum(
+        img[top:top + side, left:left + side], cv2.resize(signature, (side, side)))
+    return img
+
+
+def synthetic_corpus(size, resolutions=((800, 1100), (1600, 2200), (3000, 4000)), seed=0):
+    """
+    Method to get a corpus of jpeg receipts and the signature they were drawn
+    with. Every fourth receipt is an upscaled sample receipt, which score close
+    to the approval threshold, the rest are synthetic at the given resolutions
+    """
+    rng = np.random.default_rng(seed)
+    signature = synthetic_signature(rng)
+    samples = sample_receipts()
+
+    corpus = []
+    for i in range(size):
+        width, height = resolutions[i % len(resolutions)]
+        if i % 4 == 3:
+            img = cv2.resize(cv2.imread(samples[i % len(samples)], cv2.IMREAD_GRAYSCALE),
+                             (width, height), interpolation=cv2.INTER_CUBIC)
+        else:
+            # half of the receipts are signed by someone else
+            signer = signature if i % 2 == 0 else synthetic_signature(rng)
+            img = synthetic_receipt(rng, signer, width, height)
+        corpus.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+
+    return corpus, cv2.imencode('.png', signature)[1].tobytes()
+
+
+def traced(func, *args, **kwargs):
+    """ Method to call a function and return its result and peak traced memory in bytes """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def peak_rss():
+    """ Method to get the peak resident set size of the process in bytes """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes and macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def environment():
+    """ Method to describe the environment the benchmarks ran in """
+    return {
+        'date': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'scikit-image': skimage.__version__,
+    }
+
+
+def timed(func, *args, **kwargs):
+    """ Method to call a function and return its result and the seconds it took """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+@benchmark('batch_similarity')
+def batch_similarity(sizes=None):
+    """ Benchmark of the batch scoring against one calculate_similarity call per receipt """
+    sizes = sizes or [10, 100, 1000]
+    paths = sample_receipts()
+    signature = paths[0]
+
+    results = []
+    for size in sizes:
+        corpus = read_corpus(paths, size)
+        per_call, per_call_seconds = timed(
+            lambda: [calculate_similarity(receipt, signature) for receipt in corpus])
+        batch, batch_seconds = timed(calculate_similarities, corpus, signature)
+        results.append({
+            'receipts': size,
+            'per_call_seconds': per_call_seconds,
+            'batch_seconds': batch_seconds,
+            'speedup': per_call_seconds / batch_seconds,
+            'max_score_difference': float(max(abs(a - b) for a, b in zip(per_call, batch))),
+        })
+
+    return {'results': results}
+
+
+@benchmark('reduced_decode')
+def reduced_decode(sizes=None):
+    """
+    Benchmark of the score drift and peak memory of processing receipts at a
+    reduced resolution, the sizes are the maximum working sizes to try
+    """
+    sizes = sizes or [2048, 1024, 512]
+    paths = sample_receipts()
+    signature = paths[0]
+
+    receipts = {os.path.basename(path): read_corpus([path], 1)[0] for path in paths}
+    receipts['synthetic_12mp.jpg'] = synthetic_photo(paths[1])
+
+    results = []
+    for name, receipt in receipts.items():
+        full, full_peak = traced(calculate_similarity, receipt, signature)
+        for size in sizes:
+            reduced, reduced_peak = traced(calculate_similarity, receipt, signature, max_size=size)
+            results.append({
+                'receipt': name,
+                'max_size': size,
+                'full_score': full,
+                'reduced_score': reduced,
+                'score_drift': abs(full - reduced),
+                'full_peak_bytes': full_peak,
+                'reduced_peak_bytes': reduced_peak,
+                'peak_reduction': 1 - reduced_peak / full_peak,
+            })
+
+    return {'results': results}
+
+
+@benchmark('cascade')
+def cascade(sizes=None):
+    """
+    Benchmark of the throughput of the cascade matcher against always scoring
+    at the working size, on a synthetic corpus of the given sizes
+    """
+    sizes = sizes or [60]
+    threshold = settings.SIGNATURE_APPROVAL_THRESHOLD
+    options = {
+        'threshold': threshold,
+        'prescreen_size': settings.SIGNATURE_PRESCREEN_SIZE,
+        'max_size': settings.SIGNATURE_MAX_WORKING_SIZE,
+    }
+
+    results = []
+    for size in sizes:
+        corpus, signature = synthetic_corpus(size)
+        full, full_seconds = timed(
+            lambda: [cascade_similarity(receipt, signature, band=None, **options)[0]
+                     for receipt in corpus])
+        staged, cascade_seconds = timed(
+            lambda: [cascade_similarity(receipt, signature, band=settings.SIGNATURE_CASCADE_BAND,
+                                        **options) for receipt in corpus])
+
+        scores = [score for score, stage in staged]
+        prescreened = [i for i, (score, stage) in enumerate(staged) if stage == PRESCREEN_STAGE]
+        results.append({
+            'receipts': size,
+            'band': settings.SIGNATURE_CASCADE_BAND,
+            'full_receipts_per_second': size / full_seconds,
+            'cascade_receipts_per_second': size / cascade_seconds,
+            'speedup': full_seconds / cascade_seconds,
+            'decided_by_prescreen': len(prescreened) / size,
+            'approval_agreement': sum((a > threshold) == (b > threshold)
+                                      for a, b in zip(full, scores)) / size,
+            'max_prescreen_drift': max((abs(full[i] - scores[i]) for i in prescreened), default=0.0),
+        })
+
+    return {'results': results}
+
+
+# matcher configurations compared by the signature matching suite and the
+# difference in similarity points they may have from the reference, the first
+# one is the reference the others are checked against
+SIGNATURE_SUITE_CONFIGS = {
+    'skimage': {'options': {'engine': 'skimage'}, 'tolerance': 0},
+    'opencv': {'options': {'engine': 'opencv'}, 'tolerance': 1e-9},
+    'opencv_reduced': {'options': {'engine': 'opencv', 'max_size': 2048}, 'tolerance': 3},
+    'cascade': {'options': {'engine': 'opencv', 'max_size': 2048, 'band': 5,
+                            'prescreen_size': 512}, 'tolerance': 3},
+}
+
+
+def run_signature_config(options, corpus, signature):
+    """
+    Method to score a corpus with one matcher configuration. It runs in its
+    own process so the peak resident memory belongs to that configuration
+    """
+    if 'band' in options:
+        score = lambda receipt: cascade_similarity(receipt, signature, **options)[0]
+    else:
+        score = lambda receipt: calculate_similarity(receipt, signature, **options)
+
+    scores = []
+    latencies = []
+    for receipt in corpus:
+        start = time.perf_counter()
+        scores.append(float(score(receipt)))
+        latencies.append(time.perf_counter() - start)
+
+    # measure the memory in a second pass, tracing slows the code down
+    peak_traced = max(traced(score, receipt)[1] for receipt in corpus)
+
+    return {
+        'scores': scores,
+        'latencies': latencies,
+        'peak_traced_bytes': peak_traced,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+@benchmark('signature_matching')
+def signature_matching(sizes=None):
+    """
+    Suite of the signature matching latency, memory and throughput of every
+    configuration in SIGNATURE_SUITE_CONFIGS, with a parity table against the
+    reference. It runs on the sample receipts and on synthetic receipts whose
+    width is each of the sizes
+    """
+    sizes = sizes or [800, 1600, 3200]
+    resolutions = [(width, round(width * 1.375)) for width in sizes]
+    corpus, signature = synthetic_corpus(4 * len(resolutions), resolutions)
+    corpus = read_corpus(sample_receipts(), len(sample_receipts())) + corpus
+
+    # spawn a fresh process per configuration so the peak rss is not shared
+    runs = {}
+    context = multiprocessing.get_context('spawn')
+    for name, config in SIGNATURE_SUITE_CONFIGS.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs[name] = executor.submit(run_signature_config, config['options'],
+                                         corpus, signature).result()
+
+    reference_name = next(iter(SIGNATURE_SUITE_CONFIGS))
+    reference = np.array(runs[reference_name]['scores'])
+    threshold = settings.SIGNATURE_APPROVAL_THRESHOLD
+
+    results = []
+    for name, run in runs.items():
+        config = SIGNATURE_SUITE_CONFIGS[name]
+        latencies = np.array(run['latencies'])
+        differences = np.abs(np.array(run['scores']) - reference)
+        results.append({
+            'config': name,
+            'options': config['options'],
+            'receipts': len(corpus),
+            'p50_seconds': float(np.percentile(latencies, 50)),
+            'p95_seconds': float(np.percentile(latencies, 95)),
+            'receipts_per_second_per_core': float(len(latencies) / latencies.sum()),
+            'peak_traced_bytes': run['peak_traced_bytes'],
+            'peak_rss_bytes': run['peak_rss_bytes'],
+            'parity': {
+                'reference': reference_name,
+                'tolerance': config['tolerance'],
+                'max_difference': float(differences.max()),
+                'mean_difference': float(differences.mean()),
+                'within_tolerance': bool(differences.max() <= config['tolerance']),
+                'approval_flips': int(np.sum((np.array(run['scores']) > threshold) !=
+                                             (reference > threshold))),
+            },
+        })
+
+    return {'environment': environment(), 'results': results}
+
+
+def ocr_latencies(backend, receipts):
+    """
+    Method to read the receipts with the backend, returns the seconds every
+    one took and the number of receipts it failed to read
+    """
+    latencies = []
+    errors = 0
+    for receipt in receipts:
+        start = time.perf_counter()
+        response = backend.results(receipt)
+        latencies.append(time.perf_counter() - start)
+        errors += 'error' in json.loads(response)
+    return np.array(latencies), errors
+
+
+@benchmark('ocr_backends')
+def ocr_backends(sizes=None):
+    """
+    Benchmark of the latency and throughput of the OCR backends which run
+    without network access, the OCR.space client is run against the local
+    stub server. The sizes are the numbers of receipts to read
+    """
+    sizes = sizes or [30]
+    paths = sample_receipts()
+    text = 'Total 12.50 Date 05/08/2023'
+    server = StubOcrServer(responses={1: parsed_response(text)}).start()
+
+    recorded = RecordedBackend()
+    for path in paths:
+        recorded.record(receipt_digest(path), json.dumps(parse_text(text)))
+    backends = {
+        'ocrspace_stub': lambda: OcrClient(api_key='benchmark', endpoint=server.endpoint),
+        'recorded': lambda: recorded,
+        'tesseract': lambda: TesseractBackend(pool_size=os.cpu_count()),
+    }
+
+    results = []
+    try:
+        for name, make_backend in backends.items():
+            try:
+                backend = make_backend()
+            except ImproperlyConfigured as e:
+                results.append({'backend': name, 'skipped': str(e)})
+                continue
+            try:
+                # the first read starts worker processes and connections
+                backend.results(paths[0])
+                for size in sizes:
+                    receipts = [paths[i % len(paths)] for i in range(size)]
+                    latencies, errors = ocr_latencies(backend, receipts)
+                    results.append({
+                        'backend': name,
+                        'receipts': size,
+                        'errors': errors,
+                        'p50_seconds': float(np.percentile(latencies, 50)),
+                        'p95_seconds': float(np.percentile(latencies, 95)),
+                        'receipts_per_second': float(size / latencies.sum()),
+                    })
+            finally:
+                backend.close()
+    finally:
+        server.stop()
+
+    return {'environment': environment(), 'results': results}
+
+
+@benchmark('ocr_compression')
+def ocr_compression(sizes=None):
+    """
+    Benchmark of the bytes sent and end to end latency of the OCR client with
+    and without compressing the receipts, against the local stub server. The
+    sizes are the upload bandwidths in kilobytes per second to simulate
+    """
+    sizes = sizes or [1000, 10000]
+    paths = sample_receipts()
+    receipts = {os.path.basename(path): path for path in paths}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        photo = os.path.join(temp_dir, 'synthetic_12mp.jpg')
+        with open(photo, 'wb') as f:
+            f.write(synthetic_photo(paths[1]))
+        receipts['synthetic_12mp.jpg'] = photo
+
+        results = []
+        for bandwidth in sizes:
+            server = StubOcrServer(responses={1: parsed_response('Total 12.50 Date 05/08/2023')},
+                                   bandwidth=bandwidth * 1000).start()
+            clients = {
+                'raw': OcrClient(api_key='benchmark', endpoint=server.endpoint, compress=False),
+                'compressed': OcrClient(api_key='benchmark', endpoint=server.endpoint),
+            }
+            try:
+                for name, receipt in receipts.items():
+                    result = {'receipt': name, 'bandwidth_kb_per_second': bandwidth,
+                              'original_bytes': os.path.getsize(receipt)}
+                    for mode, client in clients.items():
+                        sent = server.bytes_received
+                        response, seconds = timed(client.results, receipt)
+                        result[f'{mode}_bytes_sent'] = server.bytes_received - sent
+                        result[f'{mode}_seconds'] = seconds
+                        result[f'{mode}_parsed'] = 'error' not in json.loads(response)
+                    result['bytes_reduction'] = 1 - result['compressed_bytes_sent'] / result['raw_bytes_sent']
+                    result['speedup'] = result['raw_seconds'] / result['compressed_seconds']
+                    results.append(result)
+            finally:
+                for client in clients.values():
+                    client.close()
+                server.stop()
+
+    return {'environment': environment(), 'results': results}
+
+
+def skewed_photo(path, angle=6):
+    """ Method to get a photo of a sample receipt lying rotated on a dark table """
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    height, width = img.shape
+    canvas = np.full((height * 2, width * 2), 50, dtype=np.uint8)
+    canvas[height // 2:height // 2 + height, width // 2:width // 2 + width] = img
+    rotation = cv2.getRotationMatrix2D((width, height), angle, 1.0)
+    canvas = cv2.warpAffine(canvas, rotation, (width * 2, height * 2), borderValue=50)
+    return cv2.imencode('.jpg', canvas, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+@benchmark('ocr_enhancement')
+def ocr_enhancement(sizes=None):
+    """
+    Benchmark of the cost of enhancing the receipts before the OCR, the time
+    it takes and the bytes sent. With tesseract installed it also reads the
+    receipts with and without the enhancement, the sizes are the longest
+    sides in pixels to send the receipts at
+    """
+    sizes = sizes or [2000]
+    paths = sample_receipts()
+    receipts = {os.path.basename(path): read_corpus([path], 1)[0] for path in paths}
+    receipts['skewed_photo.jpg'] = skewed_photo(paths[1])
+
+    results = []
+    for max_side in sizes:
+        for name, receipt in receipts.items():
+            result = {'receipt': name, 'max_side': max_side}
+            for mode, enhance in (('plain', False), ('enhanced', True)):
+                (sent_name, content), seconds = timed(compress_receipt, receipt, max_side,
+                                                      enhance=enhance)
+                result[f'{mode}_seconds'] = seconds
+                result[f'{mode}_bytes'] = len(content)
+                if pytesseract is not None:
+                    text = pytesseract.image_to_string(
+                        cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED))
+                    result[f'{mode}_amount_found'] = parse_text(text)['amount'] != 0
+            results.append(result)
+
+    return {'environment': environment(), 'tesseract': pytesseract is not None, 'results': results}
+
+
+LEGACY_AMOUNT_RE = re.compile(r'(?i)\b(?:AMOUNT|Amount|amount|Total|TOTAL|total)\s+(\d+(\.\d{1,2})?)\b')
+LEGACY_DATE_RE = re.compile(r'\b(\d{2})[/-](\d{2})[/-](\d{4})\b')
+
+
+def legacy_extract(text):
+    """ Method to find the amount and date the way the OCR did before the receipt parser """
+    amount = LEGACY_AMOUNT_RE.search(text)
+    found_date = LEGACY_DATE_RE.search(text)
+    return (float(amount.group(1)) if amount else None,
+            tuple(int(part) for part in found_date.groups()) if found_date else (0, 0, 0))
+
+
+def parser_extract(text):
+    """ Method to find the amount and date with the receipt parser """
+    amounts, dates = extract(text)
+    found_date = dates[0].value if dates else None
+    return (amounts[0].value if amounts else None,
+            (found_date.day, found_date.month, found_date.year) if found_date else (0, 0, 0))
+
+
+@benchmark('receipt_parsing')
+def receipt_parsing(sizes=None):
+    """
+    Benchmark of the accuracy and throughput of finding the amount and date
+    in the stored OCR texts of receipts, with the receipt parser and the
+    regexes it replaced. The sizes are the numbers of texts to parse
+    """
+    sizes = sizes or [1000, 10000]
+    with open(os.path.join(settings.MEDIA_ROOT, 'ocr_test', 'receipt_texts.json')) as f:
+        corpus = json.load(f)
+
+    results = []
+    for name, parse in (('legacy', legacy_extract), ('parser', parser_extract)):
+        found = [parse(receipt['text']) for receipt in corpus]
+        result = {
+            'parser': name,
+            'texts': len(corpus),
+            'amount_accuracy': sum(amount == receipt['amount'] for (amount, _), receipt
+                                   in zip(found, corpus)) / len(corpus),
+            'date_accuracy': sum(list(found_date) == receipt['date'] for (_, found_date), receipt
+                                 in zip(found, corpus)) / len(corpus),
+        }
+        for size in sizes:
+            texts = [corpus[i % len(corpus)]['text'] for i in range(size)]
+            _, seconds = timed(lambda: [parse(text) for text in texts])
+            result[f'texts_per_second_{size}'] = size / seconds
+        results.append(result)
+
+    return {'environment': environment(), 'results': results}
+
+
+# the single table of the old report is split again for every page, it is
+# only built for the smaller sizes
+LEGACY_REPORT_MAX_ROWS = 5000
+
+
+def synthetic_report_expenses(size):
+    """
+    Method to add a company with the given number of expenses over its
+    employees, returns its admin. Every tenth expense name is too long for
+    its column of the report
+    """
+    from expensense.models import Category, Company, Expense, Team, User
+
+    company = Company.objects.create(company='Benchmark Ltd', company_budget=1000)
+    category = Category.objects.create(category_name='Benchmark Travel')
+    teams = [Team.objects.create(company=company, team_name=f'Benchmark Team {i}') for i in range(5)]
+    admin = User.objects.create(username='benchmark-admin', role='ADM', company=company)
+    users = [User.objects.create(username=f'benchmark-employee{i}', company=company, team=teams[i % 5])
+             for i in range(50)]
+    statuses = [status for status, label in Expense.status_choice]
+    start = datetime.date(2023, 1, 1)
+    Expense.objects.bulk_create(
+        (Expense(user_id=users[i % 50], category=category, amount=Decimal((i * 37) % 10000) / 100,
+                 expense_name=f'Expense {i}' + (' dinner with clients at the conference hotel'
+                                                if i % 10 == 0 else ''),
+                 expense_date=start + datetime.timedelta(days=i % 365), status=statuses[i % len(statuses)],
+                 receipt='receipt.png')
+         for i in range(size)), batch_size=5000)
+    return admin
+
+
+def legacy_report(output, rows):
+    """ Method to build the report the way generate_pdf did before, as one table """
+    table = Table([['S. No', 'Expense Date', 'Expense Name', 'Amount', 'Category', 'Expense By',
+                    'Status']] + list(rows))
+    table.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black)]))
+    SimpleDocTemplate(output, pagesize=A4).build([table])
+
+
+@benchmark('pdf_report')
+def pdf_report(sizes=None):
+    """
+    Benchmark of the time, peak traced memory and size of the expense report
+    PDF, built a page sized table at a time from the expenses read from the
+    database the way generate_pdf does, and the way it was before. The sizes
+    are the numbers of expenses in the report, they are added in a
+    transaction which is rolled back
+    """
+    from expensense.report import build_report, report_rows, scoped_expenses
+
+    sizes = sizes or [1000, 10000, 100000]
+    start_date, end_date = datetime.date(2023, 1, 1), datetime.date(2023, 12, 31)
+    results = []
+    for size in sizes:
+        with transaction.atomic():
+            admin = synthetic_report_expenses(size)
+            expenses = scoped_expenses(admin, start_date, end_date)
+            output = io.BytesIO()
+            (_, peak), seconds = timed(traced, build_report, output, report_rows(expenses),
+                                       'Benchmark Ltd', 'Bench Mark', start_date, end_date)
+            result = {
+                'rows': size,
+                'seconds': seconds,
+                'rows_per_second': size / seconds,
+                'peak_traced_bytes': peak,
+                'pdf_bytes': len(output.getvalue()),
+                'pages': output.getvalue().count(b'/Type /Page\n'),
+            }
+            if size <= LEGACY_REPORT_MAX_ROWS:
+                (_, peak), seconds = timed(traced, legacy_report, io.BytesIO(), report_rows(expenses))
+                result['legacy_seconds'] = seconds
+                result['legacy_peak_traced_bytes'] = peak
+            results.append(result)
+            transaction.set_rollback(True)
+
+    return {'environment': environment(), 'results': results}
+
+
+def synthetic_export_rows(size):
+    """ Method to get the rows of an expense export of the given size """
+    statuses = ['Pending', 'Manager Approved', 'Admin Approved', 'Rejected by Manager']
+    start = datetime.date(2023, 1, 1)
+    for i in range(size):
+        yield [i + 1, start + datetime.timedelta(days=i % 365), f'Expense {i}',
+               Decimal((i * 37) % 10000) / 100, 'Travel', f'employee{i % 50}', f'Team {i % 5}',
+               statuses[i % 4]]
+
+
+def consume(chunks):
+    """ Method to read the chunks of a streamed export, returns how many bytes they held """
+    return sum(len(chunk) for chunk in chunks)
+
+
+@benchmark('expense_export')
+def expense_export(sizes=None):
+    """
+    Benchmark of the rows per second and peak traced memory of streaming the
+    expense exports. The sizes are the numbers of expenses exported, a peak
+    which does not grow with them means the export runs in constant memory
+    """
+    from expensense.export import EXPORT_WRITERS
+
+    sizes = sizes or [10000, 100000]
+    results = []
+    for file_format, writer in EXPORT_WRITERS.items():
+        for size in sizes:
+            # tracing slows the export down, so it is timed on its own
+            output_bytes, seconds = timed(consume, writer(synthetic_export_rows(size)))
+            _, peak = traced(consume, writer(synthetic_export_rows(size)))
+            results.append({
+                'format': file_format,
+                'rows': size,
+                'seconds': seconds,
+                'rows_per_second': size / seconds,
+                'peak_traced_bytes': peak,
+                'output_bytes': output_bytes,
+            })
+
+    return {'environment': environment(), 'results': results}
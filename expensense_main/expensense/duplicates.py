@@ -0,0 +1,163 @@
+"""
+Detection of re-submitted receipts. Every receipt gets a 64 bit difference
+hash (dHash) which changes little when the same photo is re-encoded or
+resized, near duplicates are found with a BK-tree of the hashes per company.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+from expensense.models import Expense
+from expensense.report_cache import bump_scopes, scope_version
+from expensense.signature_matching import read_receipt
+
+# size of the grid the hash is calculated on, one bit per horizontal pair
+HASH_SIZE = 8
+
+
+def dhash(receipt):
+    """
+    Method to calculate the difference hash of a receipt given as a path,
+    encoded bytes or a decoded array. Returns the hash as an integer
+    """
+    # a small working size lets big jpegs be decoded at a reduced resolution
+    img, _ = read_receipt(receipt, max_size=256)
+    img = cv2.resize(img, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (img[:, 1:] > img[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hash_to_str(value):
+    """ Method to format a hash the way it is stored on the expense """
+    return f'{value:016x}'
+
+
+def hamming_distance(a, b):
+    """ Method to count the bits two hashes differ in """
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Class to store hashes in a BK-tree, a search only visits the children
+    whose distance to their parent can still be within the searched distance
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        """ Method to add a hash and the item it belongs to """
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming_distance(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            if distance not in children:
+                children[distance] = (value, [item], {})
+                return
+            node = children[distance]
+
+    def search(self, value, max_distance):
+        """ Method to get (distance, item) of every hash within max_distance, closest first """
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                found.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+def hashes_scope(company_id):
+    """ Method to get the scope of the version of the receipt hashes of a company """
+    return f'receipt-hashes-{company_id}'
+
+
+def hashes_changed(*company_ids):
+    """
+    Method to have the trees of the companies loaded again in every process,
+    for changes other than new expenses, like deleted ones or backfilled hashes
+    """
+    bump_scopes({hashes_scope(company_id) for company_id in company_ids})
+
+
+class DuplicateIndex:
+    """
+    Class to keep a BK-tree of the receipt hashes of every company. The trees
+    are loaded on first use and caught up with expenses saved by other
+    processes before every search
+    """
+
+    def __init__(self):
+        self._trees = {}
+        self._last_ids = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self, company_id):
+        """
+        Method to add the expenses saved since the last refresh. The tree is
+        loaded again when the version of the company's hashes was bumped
+        since, as it is when any process deletes expenses or backfills hashes
+        """
+        hashed = Expense.objects.filter(user_id__company_id=company_id).exclude(receipt_hash__isnull=True)
+        # read before the hashes, a bump while they load has the tree loaded again next time
+        version = scope_version(hashes_scope(company_id))
+        tree = self._trees.get(company_id)
+        last_id = self._last_ids.get(company_id, 0)
+        if tree is None or self._versions.get(company_id) != version:
+            tree = self._trees[company_id] = BKTree()
+            last_id = 0
+            self._versions[company_id] = version
+
+        new_hashes = hashed.filter(id__gt=last_id).order_by('id').values_list('id', 'receipt_hash')
+        for expense_id, receipt_hash in new_hashes.iterator():
+            tree.add(int(receipt_hash, 16), expense_id)
+            last_id = expense_id
+        self._last_ids[company_id] = last_id
+        return tree
+
+    def find(self, company_id, receipt_hash, max_distance):
+        """ Method to get (distance, expense id) of the near duplicates in a company """
+        with self._lock:
+            return self._refresh(company_id).search(int(receipt_hash, 16), max_distance)
+
+    def clear(self):
+        """ Method to drop the loaded trees, they are loaded again on next use """
+        with self._lock:
+            self._trees.clear()
+            self._last_ids.clear()
+            self._versions.clear()
+
+
+index = DuplicateIndex()
+
+
+def find_duplicate(company_id, receipt_hash, max_distance):
+    """ Method to get the id of the closest earlier receipt within max_distance or None """
+    matches = index.find(company_id, receipt_hash, max_distance)
+    if not matches:
+        return None
+    # an expense may have been deleted since the tree was refreshed, only
+    # the matches are looked up
+    existing = set(Expense.objects.filter(id__in=[expense_id for distance, expense_id in matches])
+                   .values_list('id', flat=True))
+    return next((expense_id for distance, expense_id in matches if expense_id in existing), None)
@@ -0,0 +1,231 @@
+"""
+CSV and XLSX exports of the expenses a user may see. The rows are read from
+the database in chunks and written out as they are read, so an export is
+streamed to the client in constant memory however many expenses it holds.
+The XLSX workbook is written by hand as a zip of SpreadsheetML parts, which
+zipfile can write to a stream it cannot seek.
+"""
+
+import csv
+import datetime
+import re
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.http import StreamingHttpResponse
+
+from expensense.report import ITERATOR_CHUNK_SIZE, STATUS_LABELS, scoped_expenses
+
+# columns of the exports and the fields of the expenses they are read from
+COLUMNS = (
+    ('Expense ID', 'id'),
+    ('Expense Date', 'expense_date'),
+    ('Expense Name', 'expense_name'),
+    ('Amount', 'amount'),
+    ('Category', 'category__category_name'),
+    ('Expense By', 'user_id__username'),
+    ('Team', 'user_id__team__team_name'),
+    ('Status', 'status'),
+)
+HEADER = [name for name, field in COLUMNS]
+EXPORT_FIELDS = [field for name, field in COLUMNS]
+STATUS_INDEX = EXPORT_FIELDS.index('status')
+
+# rows written between two chunks of the response
+ROWS_PER_CHUNK = 500
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def export_rows(expenses):
+    """
+    Method to get the rows of the expenses as tuples of their values, read
+    in chunks without building the models
+    """
+    rows = expenses.values_list(*EXPORT_FIELDS).iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    for row in rows:
+        row = list(row)
+        row[STATUS_INDEX] = STATUS_LABELS.get(row[STATUS_INDEX], '')
+        yield row
+
+
+class ChunkBuffer:
+    """
+    Class to collect what a writer writes until it is taken as one chunk of
+    the response. It can not be seeked, so zipfile streams to it
+    """
+
+    def __init__(self, binary=False):
+        self._parts = []
+        self._empty = b'' if binary else ''
+
+    def write(self, data):
+        self._parts.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """ Method to get what was written since the last time and empty the buffer """
+        chunk = self._empty.join(self._parts)
+        self._parts = []
+        return chunk
+
+
+# a text cell starting with one of these runs as a formula in a spreadsheet
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_value(value):
+    """ Method to get a value for the CSV, texts which would run as formulas are quoted with a ' """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_chunks(rows):
+    """ Method to get the CSV of the rows in chunks of ROWS_PER_CHUNK rows """
+    buffer = ChunkBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for index, row in enumerate(rows, 1):
+        writer.writerow([csv_value(value) for value in row])
+        if index % ROWS_PER_CHUNK == 0:
+            yield buffer.take()
+    yield buffer.take()
+
+
+# characters XML 1.0 does not allow, which a spreadsheet would refuse
+INVALID_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# days are counted from this date in the cells of a workbook
+EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Expenses" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="styles.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+        '</Relationships>'),
+    # the second cell format shows dates, the third amounts with two decimals
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy"/></numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="4">'
+        '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="2" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+        '</cellXfs>'
+        '</styleSheet>'),
+}
+
+SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetData>')
+SHEET_END = '</sheetData></worksheet>'
+
+DATE_STYLE = 1
+AMOUNT_STYLE = 2
+HEADER_STYLE = 3
+
+
+def xlsx_cell(value, style=0):
+    """ Method to get the XML of a cell, numbers and dates are kept as numbers """
+    if value is None:
+        return '<c/>'
+    if isinstance(value, datetime.date):
+        return f'<c s="{style or DATE_STYLE}"><v>{(value - EXCEL_EPOCH).days}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        style = f' s="{style}"' if style else ''
+        return f'<c{style}><v>{value}</v></c>'
+    style = f' s="{style}"' if style else ''
+    text = escape(INVALID_XML_RE.sub('', str(value)))
+    return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_row(row, styles):
+    """ Method to get the XML of a row of cells """
+    return '<row>' + ''.join(xlsx_cell(value, style) for value, style in zip(row, styles)) + '</row>'
+
+
+def xlsx_chunks(rows):
+    """
+    Method to get the XLSX workbook of the rows in chunks, the worksheet is
+    compressed as it is written so a chunk holds about ROWS_PER_CHUNK rows
+    """
+    buffer = ChunkBuffer(binary=True)
+    amount_index = EXPORT_FIELDS.index('amount')
+    styles = [AMOUNT_STYLE if index == amount_index else 0 for index in range(len(COLUMNS))]
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        # the size of the worksheet is not known up front
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((SHEET_START + xlsx_row(HEADER, [HEADER_STYLE] * len(HEADER))).encode())
+            lines = []
+            for index, row in enumerate(rows, 1):
+                lines.append(xlsx_row(row, styles))
+                if index % ROWS_PER_CHUNK == 0:
+                    sheet.write(''.join(lines).encode())
+                    lines = []
+                    yield buffer.take()
+            sheet.write((''.join(lines) + SHEET_END).encode())
+    yield buffer.take()
+
+
+EXPORT_WRITERS = {
+    'csv': csv_chunks,
+    'xlsx': xlsx_chunks,
+}
+
+
+def export_expenses(user, start_date, end_date, file_format):
+    """ Method to get the streaming response of the expenses of a timeframe the user may see """
+    rows = export_rows(scoped_expenses(user, start_date, end_date))
+    response = StreamingHttpResponse(EXPORT_WRITERS[file_format](rows),
+                                     content_type=CONTENT_TYPES[file_format])
+    response['Content-Disposition'] = (f'attachment; filename="expenses_{start_date}_{end_date}'
+                                       f'.{file_format}"')
+    return response
@@ -96,7 +96,9 @@ class ExpenseForm(forms.ModelForm):
                                       widget=forms.Select(attrs={
                                           'class': 'form-select'}))
     note = forms.CharField(max_length=256, required=False)
-    receipt = forms.ImageField()
+    receipt = forms.ImageField(required=False)
+    # token of the receipt already uploaded for the OCR preview
+    receipt_token = forms.CharField(max_length=64, required=False, widget=forms.HiddenInput())
 
     class Meta:
         model = Expense
@@ -105,11 +107,31 @@ class ExpenseForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
         super(ExpenseForm, self).__init__(*args, **kwargs)
+        self.user = user
         
         # Filter the categories based on the user's company
         if user and user.company:
             self.fields['category'].queryset = Category.objects.filter(companies=user.company)
 
+    def clean(self):
+        """ Method to check a receipt is either uploaded or given by its token """
+        cleaned_data = super().clean()
+        token = cleaned_data.get('receipt_token')
+        if token:
+            try:
+                cleaned_data['receipt_upload'] = ReceiptUpload.objects.get(token=token,
+                                                                           user=self.user)
+            except ReceiptUpload.DoesNotExist:
+                self.add_error('receipt_token', 'The uploaded receipt was not found, select it again')
+        elif not cleaned_data.get('receipt'):
+            self.add_error('receipt', 'This field is required.')
+        return cleaned_data
+
+class ReceiptUploadForm(forms.Form):
+    """ Form to check a receipt uploaded for the OCR preview is an image """
+    file = forms.ImageField()
+
+
 class ApprovalConditionForm(forms.ModelForm):
     """ Class to set approval conditions """
     
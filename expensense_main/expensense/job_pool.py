@@ -0,0 +1,65 @@
+"""
+Pool of threads running background jobs queued by their id, shared by the
+OCR and report jobs. The queue has a fixed depth so a burst of requests
+is turned away rather than piling up jobs nobody waits for any more.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+
+class JobPool:
+    """
+    Class to manage the threads running the jobs of a kind, the subclasses
+    set the function running a job by its id
+    """
+    # function running a job by its id on a thread of the pool
+    job = None
+    thread_name_prefix = 'job'
+
+    def __init__(self, size, queue_depth):
+        self.size = size
+        self.queue_depth = queue_depth
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(queue_depth, 1))
+
+    def _get_executor(self):
+        """ Method to start the threads on first use """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.size,
+                                                    thread_name_prefix=self.thread_name_prefix)
+            return self._executor
+
+    def _run(self, job_id):
+        """ Method to run a job on a thread of the pool """
+        try:
+            self.job(job_id)
+        finally:
+            # do not keep a connection open per pool thread
+            connection.close()
+
+    def submit(self, job_id):
+        """
+        Method to queue a job, returns its future or None when the pool is
+        disabled or its queue is full
+        """
+        if not self.size or not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._get_executor().submit(self._run, job_id)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """ Method to stop the threads after the queued jobs are done """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from expensense.benchmarks import BENCHMARKS
+import json
+
+
+class Command(BaseCommand):
+    help = 'Runs the benchmarks and prints their results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help='Benchmarks to run, all of them when left out')
+        parser.add_argument('--sizes', nargs='+', type=int,
+                            help='Input sizes to run the benchmarks at')
+        parser.add_argument('--output', help='File to write the results to')
+
+    def handle(self, *args, **options):
+        names = options['names'] or sorted(BENCHMARKS)
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            raise CommandError(f'Unknown benchmarks: {", ".join(unknown)}. '
+                               f'Available: {", ".join(sorted(BENCHMARKS))}')
+
+        results = {}
+        for name in names:
+            self.stderr.write(f'Running {name}')
+            results[name] = BENCHMARKS[name](sizes=options['sizes'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from expensense.models import ReceiptUpload
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = 'Deletes the receipts uploaded for the OCR preview which no expense was logged with'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24,
+                            help='Age in hours after which an unclaimed receipt is deleted')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        uploads = ReceiptUpload.objects.filter(created_at__lt=cutoff)
+        deleted = 0
+        for upload in uploads.iterator():
+            upload.receipt.delete(save=False)
+            upload.delete()
+            deleted += 1
+        self.stdout.write(f'Deleted {deleted} unclaimed receipts')
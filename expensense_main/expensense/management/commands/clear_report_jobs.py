@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from expensense.report_jobs import expire_jobs
+
+
+class Command(BaseCommand):
+    help = 'Deletes the reports generated in the background which have expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=settings.REPORT_JOB_EXPIRY_HOURS,
+                            help='Age in hours after which a report is deleted')
+
+    def handle(self, *args, **options):
+        deleted = expire_jobs(options['hours'])
+        self.stdout.write(f'Deleted {deleted} expired reports')
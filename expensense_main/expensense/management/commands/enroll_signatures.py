@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from expensense.models import User
+from expensense.signature_matching import enroll_signature, template_is_current
+
+
+class Command(BaseCommand):
+    help = 'Stores the signature templates of users who do not have an up to date one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild the templates even if they are up to date')
+
+    def handle(self, *args, **options):
+        enrolled = 0
+        users = User.objects.exclude(signature='').exclude(signature__isnull=True)
+        for user in users.only('username', 'signature').iterator():
+            signature_path = user.signature.path
+            if not options['force'] and template_is_current(signature_path):
+                continue
+            try:
+                enroll_signature(signature_path)
+                enrolled += 1
+            except (OSError, ValueError) as e:
+                self.stderr.write(f'Could not enroll {user.username}: {e}')
+
+        self.stdout.write(f'Enrolled {enrolled} signatures')
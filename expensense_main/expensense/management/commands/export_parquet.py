@@ -0,0 +1,41 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from expensense.models import Expense
+from expensense.parquet_export import export_dataset
+
+
+class Command(BaseCommand):
+    help = 'Exports the expenses to a parquet dataset partitioned by company and month'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Directory of the dataset')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only export the expenses saved since the last incremental export '
+                                 'to the directory')
+        parser.add_argument('--since', help='Only export the expenses saved after this ISO date and time')
+        parser.add_argument('--company', type=int, help='Id of the company whose expenses to export')
+        parser.add_argument('--batch-rows', type=int, help='Rows in a record batch')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f'{options["since"]} is not an ISO date and time')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        expenses = Expense.objects.all()
+        if options['company'] is not None:
+            expenses = expenses.filter(user_id__company_id=options['company'])
+
+        try:
+            exported = export_dataset(options['output'], expenses, since, options['incremental'],
+                                      options['batch_rows'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f'Exported {exported["rows"]} expenses to {len(exported["files"])} files, '
+                          f'watermark {exported["watermark"].isoformat()}')
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from expensense.models import Expense
+from expensense.duplicates import BKTree, dhash, hash_to_str, hashes_changed
+
+
+class Command(BaseCommand):
+    help = 'Calculates the perceptual hash of receipts stored before duplicate detection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Expenses written back at a time')
+        parser.add_argument('--flag', action='store_true',
+                            help='Also flag the existing expenses which look re-submitted')
+
+    def hash_missing(self, chunk_size):
+        """ Method to hash the receipts which do not have a hash yet """
+        hashed = 0
+        last_id = 0
+        companies = set()
+        expenses = (Expense.objects.filter(receipt_hash__isnull=True).select_related('user_id')
+                    .only('id', 'receipt', 'user_id__company_id'))
+        while True:
+            # page by id, the rows written back drop out of the filter
+            chunk = list(expenses.filter(id__gt=last_id).order_by('id')[:chunk_size])
+            if not chunk:
+                # the trees loaded by every process do not have the backfilled hashes
+                hashes_changed(*companies)
+                return hashed
+            last_id = chunk[-1].id
+
+            updated = []
+            for expense in chunk:
+                try:
+                    expense.receipt_hash = hash_to_str(dhash(expense.receipt.path))
+                except (OSError, ValueError) as e:
+                    self.stderr.write(f'Could not hash expense {expense.id}: {e}')
+                    continue
+                updated.append(expense)
+                companies.add(expense.user_id.company_id)
+            Expense.objects.bulk_update(updated, ['receipt_hash'])
+            hashed += len(updated)
+
+    def flag_duplicates(self, chunk_size):
+        """
+        Method to flag every expense whose receipt is close to an earlier one
+        of the same company, going through the expenses in the order they were
+        logged
+        """
+        trees = {}
+        flagged = []
+        expenses = (Expense.objects.exclude(receipt_hash__isnull=True)
+                    .order_by('id').values_list('id', 'user_id__company_id',
+                                                'receipt_hash', 'duplicate_of_id'))
+        for expense_id, company_id, receipt_hash, duplicate_of_id in expenses.iterator(chunk_size=chunk_size):
+            tree = trees.setdefault(company_id, BKTree())
+            value = int(receipt_hash, 16)
+            matches = tree.search(value, settings.RECEIPT_DUPLICATE_DISTANCE)
+            if matches and duplicate_of_id is None:
+                flagged.append(Expense(id=expense_id, duplicate_of_id=matches[0][1]))
+            tree.add(value, expense_id)
+
+        Expense.objects.bulk_update(flagged, ['duplicate_of'], batch_size=chunk_size)
+        return len(flagged)
+
+    def handle(self, *args, **options):
+        hashed = self.hash_missing(options['chunk_size'])
+        self.stdout.write(f'Hashed {hashed} receipts')
+
+        if options['flag']:
+            flagged = self.flag_duplicates(options['chunk_size'])
+            self.stdout.write(f'Flagged {flagged} possible duplicates')
@@ -0,0 +1,46 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from expensense.ocr_api import ENHANCED, PLAIN
+from expensense.ocr_limits import CacheCounter, CircuitBreaker, LimitStore, OutcomeCounter, RateLimiter
+
+
+class Command(BaseCommand):
+    help = ('Shows the OCR rate limiter, circuit breakers, enhanced receipt counts and result '
+            'cache hit rate shared by the server processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', type=int, nargs='+', choices=[1, 2, 3], metavar='ENGINE',
+                            help='Engines whose circuit breakers to close')
+        parser.add_argument('--reset-enhancement', action='store_true',
+                            help='Start the counts of the enhanced and plain receipts over')
+        parser.add_argument('--reset-cache', action='store_true',
+                            help='Start the counts of the result cache hits and misses over')
+
+    def handle(self, *args, **options):
+        if not settings.OCR_LIMITS_PATH:
+            raise CommandError('The OCR limits are disabled, set OCR_LIMITS_PATH')
+        store = LimitStore(settings.OCR_LIMITS_PATH)
+        breaker = CircuitBreaker(store, settings.OCR_BREAKER_THRESHOLD, settings.OCR_BREAKER_COOLDOWN)
+        for engine in options['reset'] or []:
+            breaker.reset(engine)
+            self.stdout.write(f'Closed the circuit breaker of engine {engine}')
+
+        outcomes = OutcomeCounter(store)
+        if options['reset_enhancement']:
+            outcomes.reset()
+            self.stdout.write('Started the enhanced and plain receipt counts over')
+
+        cache_counts = CacheCounter(store)
+        if options['reset_cache']:
+            cache_counts.reset()
+            self.stdout.write('Started the result cache counts over')
+
+        state = {'breakers': breaker.states(), 'enhancement': outcomes.counts([ENHANCED, PLAIN]),
+                 'result_cache': cache_counts.counts()}
+        if settings.OCR_RATE_LIMIT:
+            limiter = RateLimiter(store, settings.OCR_RATE_LIMIT, settings.OCR_RATE_BURST)
+            state['rate_limiter'] = {key: value for key, value in limiter.state().items()
+                                     if key in ('rate', 'burst', 'tokens')}
+        self.stdout.write(json.dumps(state, indent=2))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from expensense.ocr_stub import StubOcrServer, parsed_response
+
+
+class Command(BaseCommand):
+    help = 'Serves a local stub of the OCR.space API for offline and load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8001, help='Port to listen on')
+        parser.add_argument('--text', default='Total 12.50 Date 05/08/2023',
+                            help='Text every receipt is read as')
+        parser.add_argument('--engine', type=int, default=1, choices=[1, 2, 3],
+                            help='Engine which reads the receipts, the others fail to')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds to wait before every response')
+        parser.add_argument('--bandwidth', type=int,
+                            help='Bytes per second the uploads are slowed down to')
+
+    def handle(self, *args, **options):
+        server = StubOcrServer(options['host'], options['port'],
+                               responses={options['engine']: parsed_response(options['text'])},
+                               delays={engine: options['latency'] for engine in (1, 2, 3)},
+                               bandwidth=options['bandwidth'])
+        self.stdout.write(f'Serving the stub OCR API, set OCR_ENDPOINT = "{server.endpoint}"')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand
 from expensense.models import User, Expense, Category
 from datetime import datetime, timedelta
 import random
-from expensense.signature_matching import calculate_similarity
+from expensense.signature_matching import calculate_similarities
 
 class Command(BaseCommand):
     help = 'Populates expenses for the past 2 years'
@@ -12,6 +12,11 @@ class Command(BaseCommand):
         categories = Category.objects.all()
         current_date = datetime.now()
 
+        # score all the receipts against the signature at once
+        receipt_path = 'media/signature_test/signature_receipt_2.jpeg'
+        similarity_scores = iter(calculate_similarities([receipt_path] * 24 * 3,
+                                                        user.signature.path))
+
         for _ in range(24):  # 2 years
             for _ in range(3):  # 3 expenses per month
                 expense_name = "Expense " + str(random.randint(1, 100))
@@ -20,8 +25,7 @@ class Command(BaseCommand):
                 note = "Demo note for the expense"
                 category = random.choice(categories)
                 status = 0
-                receipt_path = 'media/signature_test/signature_receipt_2.jpeg'
-                similarity_score = calculate_similarity(receipt_path, user.signature.path)
+                similarity_score = next(similarity_scores)
                 
                 Expense.objects.create(
                     user_id=user,
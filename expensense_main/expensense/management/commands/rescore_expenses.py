@@ -0,0 +1,148 @@
+from django.core.management.base import BaseCommand, CommandError
+from expensense.models import Expense
+from expensense.scoring import similarity_options
+from expensense.signature_matching import cascade_similarity, warm_up
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+import multiprocessing
+import json
+import os
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the signature similarity of stored expenses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help='Only expenses of this company id')
+        parser.add_argument('--team', type=int, help='Only expenses of this team id')
+        parser.add_argument('--start-date', help='Only expenses on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--end-date', help='Only expenses on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Worker processes to score with, 0 scores in this process')
+        parser.add_argument('--chunk-size', type=int, default=200,
+                            help='Expenses scored and written back at a time')
+        parser.add_argument('--full', action='store_true',
+                            help='Always score at the working size instead of the cascade')
+        parser.add_argument('--checkpoint', default='rescore_expenses.checkpoint.json',
+                            help='File the progress is saved to after every chunk')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue from the checkpoint of an interrupted run')
+
+    def get_filters(self, options):
+        """ Method to get the expense filters from the options """
+        filters = {}
+        if options['company'] is not None:
+            filters['user_id__company_id'] = options['company']
+        if options['team'] is not None:
+            filters['user_id__team_id'] = options['team']
+        try:
+            if options['start_date']:
+                datetime.strptime(options['start_date'], '%Y-%m-%d')
+                filters['expense_date__gte'] = options['start_date']
+            if options['end_date']:
+                datetime.strptime(options['end_date'], '%Y-%m-%d')
+                filters['expense_date__lte'] = options['end_date']
+        except ValueError:
+            raise CommandError('Dates have to be given as YYYY-MM-DD')
+        return filters
+
+    def read_checkpoint(self, path, filters):
+        """ Method to read the progress of an interrupted run """
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            raise CommandError(f'No checkpoint found at {path}')
+        if checkpoint['filters'] != filters:
+            raise CommandError('The checkpoint was made with different filters: '
+                               f'{checkpoint["filters"]}')
+        return checkpoint
+
+    def write_checkpoint(self, path, checkpoint):
+        """ Method to save the progress, replacing the file so it is never partial """
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, path)
+
+    def score_chunk(self, executor, chunk, options):
+        """ Method to score a chunk of expenses, returns the futures in order """
+        futures = []
+        for expense in chunk:
+            args = (expense.receipt.path, expense.user_id.signature.path)
+            if executor is None:
+                future = Future()
+                try:
+                    future.set_result(cascade_similarity(*args, **options))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = executor.submit(cascade_similarity, *args, **options)
+            futures.append(future)
+        return futures
+
+    def write_chunk(self, chunk, futures, checkpoint):
+        """ Method to write the scores of a chunk back to the database """
+        scored = []
+        for expense, future in zip(chunk, futures):
+            try:
+                expense.similarity, expense.similarity_stage = future.result()
+            except Exception as e:
+                # keep the stored score of receipts that cannot be read
+                self.stderr.write(f'Could not score expense {expense.id}: {e}')
+                checkpoint['failed'] += 1
+                continue
+            expense.similarity_pending = False
+            scored.append(expense)
+
+        Expense.objects.bulk_update(scored, ['similarity', 'similarity_stage',
+                                             'similarity_pending'])
+        checkpoint['scored'] += len(scored)
+        checkpoint['last_id'] = chunk[-1].id
+
+    def handle(self, *args, **options):
+        filters = self.get_filters(options)
+        checkpoint_path = options['checkpoint']
+        if options['resume']:
+            checkpoint = self.read_checkpoint(checkpoint_path, filters)
+        else:
+            checkpoint = {'filters': filters, 'last_id': 0, 'scored': 0, 'failed': 0}
+
+        score_options = similarity_options()
+        if options['full']:
+            score_options['band'] = None
+
+        # expenses are streamed in id order so a run can resume after the
+        # last id written back
+        expenses = (Expense.objects.filter(id__gt=checkpoint['last_id'], **filters)
+                    .exclude(user_id__signature='').exclude(user_id__signature__isnull=True)
+                    .select_related('user_id').only('id', 'receipt', 'user_id__signature')
+                    .order_by('id'))
+
+        executor = None
+        if options['workers']:
+            executor = ProcessPoolExecutor(max_workers=options['workers'],
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=warm_up)
+        try:
+            chunk = []
+            for expense in expenses.iterator(chunk_size=options['chunk_size']):
+                chunk.append(expense)
+                if len(chunk) == options['chunk_size']:
+                    self.write_chunk(chunk, self.score_chunk(executor, chunk, score_options),
+                                     checkpoint)
+                    self.write_checkpoint(checkpoint_path, checkpoint)
+                    self.stdout.write(f'Scored {checkpoint["scored"]} expenses')
+                    chunk = []
+            if chunk:
+                self.write_chunk(chunk, self.score_chunk(executor, chunk, score_options),
+                                 checkpoint)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # the run is complete, nothing left to resume
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(f'Scored {checkpoint["scored"]} expenses, '
+                          f'{checkpoint["failed"]} failed')
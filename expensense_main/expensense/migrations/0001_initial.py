@@ -0,0 +1,174 @@
+# Generated by Django 3.2.20 on 2026-10-18 08:53
+
+from django.conf import settings
+import django.contrib.auth.models
+import django.contrib.auth.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import expensense.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('username', models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, unique=True, validators=[django.contrib.auth.validators.UnicodeUsernameValidator()], verbose_name='username')),
+                ('first_name', models.CharField(blank=True, max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('email', models.EmailField(blank=True, max_length=254, verbose_name='email address')),
+                ('is_staff', models.BooleanField(default=False, help_text='Designates whether the user can log into this admin site.', verbose_name='staff status')),
+                ('is_active', models.BooleanField(default=True, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('role', models.CharField(choices=[('ADM', 'Admin'), ('MNG', 'Manager'), ('EMP', 'Employee')], default='EMP', max_length=3)),
+                ('signature', models.ImageField(blank=True, null=True, upload_to=expensense.models.get_signature_image_upload_path)),
+            ],
+            options={
+                'verbose_name': 'user',
+                'verbose_name_plural': 'users',
+                'abstract': False,
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category_name', models.CharField(max_length=128)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Company',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('company', models.CharField(max_length=128, unique=True)),
+                ('company_budget', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('categories', models.ManyToManyField(related_name='companies', to='expensense.Category')),
+            ],
+            options={
+                'verbose_name_plural': 'Companies',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=32, unique=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Team',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('team_name', models.CharField(max_length=128)),
+                ('team_budget', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='teams', to='expensense.company')),
+            ],
+            options={
+                'verbose_name_plural': 'Teams',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Queued'), ('running', 'Generating'), ('done', 'Ready'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('report', models.FileField(blank=True, null=True, upload_to=expensense.models.get_report_upload_path)),
+                ('error', models.CharField(blank=True, max_length=256, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='report_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReceiptUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('receipt', models.ImageField(upload_to=expensense.models.get_receipt_upload_path)),
+                ('sha256', models.CharField(max_length=64)),
+                ('receipt_hash', models.CharField(blank=True, max_length=16, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ocr_status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('ocr_result', models.TextField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipt_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Expense',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expense_name', models.CharField(max_length=128)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('expense_date', models.DateField()),
+                ('note', models.TextField(max_length=256, null=True)),
+                ('receipt', models.ImageField(upload_to=expensense.models.get_image_upload_path)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Manager Approved'), (2, 'Admin Approved'), (3, 'Rejected by Manager'), (4, 'Rejected by Admin')], default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('manager_approved_at', models.DateTimeField(blank=True, null=True)),
+                ('admin_approved_at', models.DateTimeField(blank=True, null=True)),
+                ('manager_auto_approved', models.BooleanField(blank=True, default=False, null=True)),
+                ('admin_auto_approved', models.BooleanField(blank=True, default=False, null=True)),
+                ('similarity', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('similarity_pending', models.BooleanField(default=False)),
+                ('similarity_stage', models.CharField(blank=True, choices=[('prescreen', 'Pre-screen'), ('full', 'Full resolution')], max_length=16, null=True)),
+                ('receipt_hash', models.CharField(blank=True, max_length=16, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='expensense.category')),
+                ('duplicate_of', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='expensense.expense')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expenses', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Expenses',
+            },
+        ),
+        migrations.CreateModel(
+            name='ApprovalConditions',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='approval_conditions', to='expensense.company')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='approval_conditions', to='expensense.team')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='approval_conditions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='company',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='users', to='expensense.company'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='groups',
+            field=models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.Group', verbose_name='groups'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='team',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='users', to='expensense.team'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='user_permissions',
+            field=models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.Permission', verbose_name='user permissions'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 import os
+from expensense.signature_matching import FULL_STAGE, PRESCREEN_STAGE
 
 
 # Create your models here.
@@ -115,6 +116,23 @@ class Expense(models.Model):
     manager_auto_approved = models.BooleanField(default=False, null=True, blank=True)
     admin_auto_approved = models.BooleanField(default=False, blank= True, null=True)
     similarity = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    # set while the similarity is being calculated in the background
+    similarity_pending = models.BooleanField(default=False)
+    similarity_stage_choices = [
+        (PRESCREEN_STAGE, 'Pre-screen'),
+        (FULL_STAGE, 'Full resolution'),
+    ]
+    # stage of the cascade matcher which decided the similarity
+    similarity_stage = models.CharField(max_length=16, choices=similarity_stage_choices,
+                                        null=True, blank=True)
+    # perceptual hash of the receipt and the earlier expense it looks re-submitted from
+    receipt_hash = models.CharField(max_length=16, null=True, blank=True)
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='duplicates')
+    # last time the expense was saved, which the incremental parquet export
+    # picks the changed expenses by. bulk_update leaves it as it is, which is
+    # only used for fields the export does not hold
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         verbose_name_plural = 'Expenses'
@@ -123,6 +141,92 @@ class Expense(models.Model):
         return f'{self.user_id} - {self.expense_name} - {self.status}'
 
 
+def get_receipt_upload_path(instance, filename):
+    """ Method to store uploaded receipts where the receipts of expenses are stored """
+    user_folder = instance.user.username
+    team_folder = instance.user.team.team_name if instance.user.team else 'NoTeam'
+    company_folder = instance.user.company.company
+    return os.path.join('receipts', company_folder, team_folder, user_folder, filename)
+
+class ReceiptUpload(models.Model):
+    """
+    Class to store a receipt uploaded for the OCR preview until the expense
+    form claims it by its token, the expense then keeps the stored file
+    """
+    token = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='receipt_uploads')
+    receipt = models.ImageField(upload_to=get_receipt_upload_path)
+    sha256 = models.CharField(max_length=64)
+    # perceptual hash of the receipt, see Expense.receipt_hash
+    receipt_hash = models.CharField(max_length=16, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    ocr_pending = 'pending'
+    ocr_done = 'done'
+    ocr_failed = 'failed'
+    ocr_status_choices = [
+        (ocr_pending, 'Pending'),
+        (ocr_done, 'Done'),
+        (ocr_failed, 'Failed'),
+    ]
+    # the OCR of the receipt runs as a background job, its result is the
+    # JSON of the amount and date or of the error it failed with
+    ocr_status = models.CharField(max_length=8, choices=ocr_status_choices, default=ocr_pending)
+    ocr_result = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.user} - {self.receipt.name}'
+
+
+class ReportVersion(models.Model):
+    """
+    Class to store the version of the expenses of a company, team or user,
+    which every change of their expenses bumps. Cached reports are kept by
+    the version they were built from
+    """
+    scope = models.CharField(max_length=32, unique=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.scope} - {self.version}'
+
+
+def get_report_upload_path(instance, filename):
+    """ Method to get the path the report of a report job is stored at """
+    return os.path.join('reports', instance.user.company.company, instance.user.username, filename)
+
+
+class ReportJob(models.Model):
+    """
+    Class to store an expense report generated in the background, the file
+    it was written to is downloaded until the job expires
+    """
+    token = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='report_jobs')
+    start_date = models.DateField()
+    end_date = models.DateField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+    status_choices = [
+        (pending, 'Queued'),
+        (running, 'Generating'),
+        (done, 'Ready'),
+        (failed, 'Failed'),
+    ]
+    status = models.CharField(max_length=8, choices=status_choices, default=pending)
+    report = models.FileField(upload_to=get_report_upload_path, null=True, blank=True)
+    error = models.CharField(max_length=256, null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.user} - {self.start_date} - {self.end_date}'
+
+
 class ApprovalConditions(models.Model):
     """ Class to store the approval conditions """
     company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='approval_conditions')
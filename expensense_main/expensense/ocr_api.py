@@ -1,7 +1,35 @@
 import json
+import logging
+import os
+import random
 import requests
-import re
-from datetime import datetime
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+from expensense.ocr_limits import CircuitBreaker, LimitStore, OutcomeCounter, RateLimiter
+from expensense.ocr_preprocess import OCR_MAX_BYTES, OCR_MAX_SIDE, compress_receipt
+from expensense.receipt_parser import find_amount, find_date, parse_text
+
+logger = logging.getLogger(__name__)
+
+OCR_ENDPOINT = 'https://api.ocr.space/parse/image'
+
+# engines are tried in turn, or all queried at once taking the first result
+SEQUENTIAL_POLICY = 'sequential'
+RACING_POLICY = 'racing'
+
+# receipts sent enhanced or as they are, the success rates are kept for both
+ENHANCED = 'enhanced'
+PLAIN = 'plain'
+
+# a receipt as it is sent to the API and whether it was enhanced
+PreparedReceipt = namedtuple('PreparedReceipt', ['name', 'content', 'enhanced'])
+
 
 def read_ocr_key():
     """ Method to read OCR Key from the ocr_key file"""
@@ -23,103 +51,363 @@ def read_ocr_key():
 
 def post_query_to_ocr(receipt, engine=1):
     """ Method to post the image to the API """
-    api_key = read_ocr_key()
-    is_table = True
-    payload = {'istable': is_table,
-               'apikey':api_key}
-    endpoint = 'https://api.ocr.space/parse/image'
+    return get_client().post(receipt, engine)
 
-    if engine in [2,3]:
-        payload['OCREngine']=engine
 
-    with open(receipt, 'rb') as f:
-        response = requests.post(endpoint,files={receipt: f},
-                                 data=payload)
-    return response.content.decode()
+class OcrBackend(ABC):
+    """
+    Class every OCR backend extends, the backend configured in the settings
+    reads the receipts of results and the OCR API view
+    """
 
+    @classmethod
+    def from_settings(cls):
+        """ Method to create the backend with the options in the settings """
+        return cls(**settings.OCR_BACKEND_OPTIONS)
 
-def find_amount(string):
-    """ Method to find Amount from a string using regex """
+    @abstractmethod
+    def results(self, receipt):
+        """
+        Method to return the amount and date found on the receipt at the given
+        path as JSON, or the error reading it failed with
+        """
+
+    def close(self):
+        """ Method to release the resources of the backend """
+
+
+class OcrClient(OcrBackend):
+    """
+    Class to query the OCR.space API over a pool of keep-alive connections.
+    The key is read once, every request is bounded by the connect and read
+    timeouts and every results call by the deadline. With a limits path the
+    requests of all the processes are rate limited and engines which keep
+    failing are skipped by their circuit breakers
+    """
+
+    def __init__(self, api_key=None, endpoint=OCR_ENDPOINT, connect_timeout=5,
+                 read_timeout=30, deadline=60, pool_size=10, policy=SEQUENTIAL_POLICY,
+                 compress=True, max_side=OCR_MAX_SIDE, max_bytes=OCR_MAX_BYTES, enhance_rate=0,
+                 limits_path=None, rate_limit=0, rate_burst=None, rate_limit_wait=0,
+                 breaker_threshold=0, breaker_cooldown=30):
+        self.api_key = api_key or read_ocr_key()
+        self.compress = compress
+        self.enhance_rate = enhance_rate
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.endpoint = endpoint
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.pool_size = pool_size
+        self.policy = policy
+        self.rate_limit_wait = rate_limit_wait
+
+        store = LimitStore(limits_path) if limits_path else None
+        self.limiter = RateLimiter(store, rate_limit, rate_burst) if store and rate_limit else None
+        self.breaker = (CircuitBreaker(store, breaker_threshold, breaker_cooldown)
+                        if store and breaker_threshold else None)
+        # the enhanced and plain receipts are compared across all the
+        # processes when they share a store, within this one otherwise
+        self.outcomes = OutcomeCounter(store) if store else None
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._outcomes = {ENHANCED: {'receipts': 0, 'engines': {}},
+                          PLAIN: {'receipts': 0, 'engines': {}}}
+        self._executor = None
+
+    @classmethod
+    def from_settings(cls):
+        """ Method to create the client with the OCR settings """
+        options = {
+            'endpoint': settings.OCR_ENDPOINT,
+            'connect_timeout': settings.OCR_CONNECT_TIMEOUT,
+            'read_timeout': settings.OCR_READ_TIMEOUT,
+            'deadline': settings.OCR_DEADLINE,
+            'pool_size': settings.OCR_POOL_SIZE,
+            'policy': settings.OCR_ENGINE_POLICY,
+            'compress': settings.OCR_COMPRESS,
+            'max_side': settings.OCR_MAX_SIDE,
+            'max_bytes': settings.OCR_MAX_BYTES,
+            'enhance_rate': settings.OCR_ENHANCE_RATE,
+            'limits_path': settings.OCR_LIMITS_PATH,
+            'rate_limit': settings.OCR_RATE_LIMIT,
+            'rate_burst': settings.OCR_RATE_BURST,
+            'rate_limit_wait': settings.OCR_RATE_LIMIT_WAIT,
+            'breaker_threshold': settings.OCR_BREAKER_THRESHOLD,
+            'breaker_cooldown': settings.OCR_BREAKER_COOLDOWN,
+        }
+        options.update(settings.OCR_BACKEND_OPTIONS)
+        return cls(**options)
+
+    def _record(self, engine, seconds, sent, error=False):
+        """ Method to add a request to the metrics of its engine """
+        with self._lock:
+            stats = self._engines.setdefault(engine, {'requests': 0, 'errors': 0, 'seconds': 0.0,
+                                                      'bytes_sent': 0})
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['bytes_sent'] += sent
+
+    def _record_parse(self, enhanced, engine, parsed):
+        """ Method to add an answered request to the success rate of its engine """
+        mode = ENHANCED if enhanced else PLAIN
+        if self.outcomes:
+            self.outcomes.add_attempt(mode, engine, parsed)
+            return
+        with self._lock:
+            stats = self._outcomes[mode]['engines'].setdefault(engine, {'attempts': 0, 'parsed': 0})
+            stats['attempts'] += 1
+            stats['parsed'] += int(parsed)
+
+    def _record_receipt(self, enhanced):
+        """ Method to count a receipt sent enhanced or plain """
+        mode = ENHANCED if enhanced else PLAIN
+        if self.outcomes:
+            self.outcomes.add_receipt(mode)
+            return
+        with self._lock:
+            self._outcomes[mode]['receipts'] += 1
+
+    def prepare(self, receipt, enhance=None):
+        """
+        Method to get the receipt at the given path as it is sent, compressed
+        to fit the size budget unless disabled. Receipts are enhanced at the
+        enhance rate unless told whether to enhance them, the rest are sent
+        plain so the success rates of both can be compared
+        """
+        if enhance is None:
+            enhance = random.random() < self.enhance_rate
+        if self.compress or enhance:
+            try:
+                name, content = compress_receipt(receipt, self.max_side, self.max_bytes, enhance)
+                return PreparedReceipt(name, content, enhance)
+            except ValueError:
+                # not an image opencv can decode, let the API try it as it is
+                logger.warning('Could not compress receipt %s', receipt)
+        with open(receipt, 'rb') as f:
+            return PreparedReceipt(os.path.basename(receipt), f.read(), False)
+
+    def post(self, receipt, engine=1, read_timeout=None):
+        """
+        Method to post the image to the API and return the response text, the
+        receipt is a path or what prepare returned
+        """
+        if not isinstance(receipt, PreparedReceipt):
+            receipt = self.prepare(receipt)
+        name, content = receipt.name, receipt.content
+        payload = {'istable': True,
+                   'apikey': self.api_key}
+        if engine in [2, 3]:
+            payload['OCREngine'] = engine
+
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.endpoint, files={'file': (name, content)}, data=payload,
+                timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+            response.raise_for_status()
+        except requests.RequestException:
+            self._record(engine, time.perf_counter() - start, len(content), error=True)
+            raise
+        self._record(engine, time.perf_counter() - start, len(content))
+        return response.content.decode()
+
+    def _try_engine(self, receipt, engine, deadline):
+        """ Method to query one engine, returns its result or None and the error it failed with """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, 'timeout'
+        if self.breaker and not self.breaker.allow(engine):
+            return None, 'OCR engine unavailable'
+        if self.limiter and not self.limiter.acquire(min(self.rate_limit_wait, remaining)):
+            logger.warning('OCR engine %s rate limited', engine)
+            return None, 'OCR rate limited'
+        remaining = deadline - time.monotonic()
+        try:
+            # a slow engine may not read past the deadline of the call
+            data = json.loads(self.post(receipt, engine,
+                                        read_timeout=max(min(self.read_timeout, remaining), 0.1)))
+        except requests.Timeout:
+            logger.warning('OCR engine %s timed out', engine)
+            self._record_outage(engine)
+            return None, 'timeout'
+        except (requests.RequestException, ValueError) as e:
+            logger.warning('OCR engine %s failed: %s', engine, e)
+            self._record_outage(engine)
+            return None, 'OCR request failed'
+        if self.breaker:
+            self.breaker.record_success(engine)
+
+        result = process_data(data, engine) if data.get('OCRExitCode') else None
+        self._record_parse(receipt.enhanced, engine, bool(result))
+        if result:
+            return result, None
+        return None, 'partial parse'
+
+    def _record_outage(self, engine):
+        """ Method to count a request an engine did not answer towards opening its breaker """
+        if self.breaker:
+            self.breaker.record_failure(engine)
+
+    def available(self, engines=(1, 2, 3)):
+        """ Method to check whether the breaker of at least one of the engines lets requests through """
+        return not self.breaker or not all(self.breaker.is_open(engine) for engine in engines)
+
+    def _get_executor(self):
+        """ Method to start the threads racing the engines on first use """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size,
+                                                    thread_name_prefix='ocr')
+            return self._executor
+
+    def _sequential(self, receipt, engines, deadline):
+        """ Method to try the engines one after another until one parses the receipt """
+        error = 'partial parse'
+        for engine in engines:
+            result, error = self._try_engine(receipt, engine, deadline)
+            if result:
+                return result, None
+        return None, error
+
+    def _racing(self, receipt, engines, deadline):
+        """ Method to query the engines at once and take the first one parsing the receipt """
+        executor = self._get_executor()
+        futures = [executor.submit(self._try_engine, receipt, engine, deadline)
+                   for engine in engines]
+        error = 'partial parse'
+        try:
+            for future in as_completed(futures, timeout=max(deadline - time.monotonic(), 0)):
+                result, error = future.result()
+                if result:
+                    return result, None
+        except FuturesTimeoutError:
+            error = 'timeout'
+        finally:
+            # the engines still waiting are not sent, the responses of the
+            # ones in flight are ignored
+            for future in futures:
+                future.cancel()
+        return None, error
+
+    def results(self, receipt, engines=(1, 2, 3), policy=None):
+        """
+        Method to return result of the OCR API. The sequential policy tries
+        the engines in turn, using the least of the quota, the racing policy
+        queries them at once for the lowest latency
+        """
+        policy = policy or self.policy
+        if policy not in OCR_POLICIES:
+            raise ValueError(f'Unknown OCR engine policy {policy}')
+        if not self.available(engines):
+            # do not spend the time compressing a receipt no engine is sent
+            return json.dumps({'error': 'OCR engine unavailable'})
+        deadline = time.monotonic() + self.deadline
+        # the receipt is compressed once for all the engines
+        prepared = self.prepare(receipt)
+        self._record_receipt(prepared.enhanced)
+        result, error = OCR_POLICIES[policy](self, prepared, engines, deadline)
+        if result:
+            return json.dumps(result)
+        return json.dumps({'error': error})
+
+    def metrics(self):
+        """
+        Method to get the connections opened and requests sent over them, the
+        requests, errors and seconds spent per engine, for enhanced and
+        plain receipts the engine calls per receipt and success rate of every
+        engine, and the state of the rate limiter and circuit breakers
+        """
+        connections = requests_sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        if self.outcomes:
+            outcomes = self.outcomes.counts([ENHANCED, PLAIN])
+        else:
+            with self._lock:
+                outcomes = {mode: {'receipts': outcome['receipts'],
+                                   'engines': {engine: dict(stats)
+                                               for engine, stats in outcome['engines'].items()}}
+                            for mode, outcome in self._outcomes.items()}
+        enhancement = {}
+        for mode, outcome in outcomes.items():
+            calls = sum(stats['attempts'] for stats in outcome['engines'].values())
+            enhancement[mode] = {
+                'receipts': outcome['receipts'],
+                'calls_per_receipt': calls / outcome['receipts'] if outcome['receipts'] else None,
+                'engines': {engine: dict(stats, success_rate=stats['parsed'] / stats['attempts'])
+                            for engine, stats in outcome['engines'].items()},
+            }
+        with self._lock:
+            engines = {engine: dict(stats) for engine, stats in self._engines.items()}
+        return {
+            'connections_opened': connections,
+            'requests_sent': requests_sent,
+            'connections_reused': requests_sent - connections,
+            'engines': engines,
+            'enhancement': enhancement,
+            'rate_limiter': self.limiter.state() if self.limiter else None,
+            'breakers': self.breaker.states() if self.breaker else {},
+        }
+
+    def close(self):
+        """ Method to stop the racing threads and close the pooled connections """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        self.session.close()
+
+
+OCR_POLICIES = {
+    SEQUENTIAL_POLICY: OcrClient._sequential,
+    RACING_POLICY: OcrClient._racing,
+}
+
+
+_client = None
+_backend = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Method to get the OCR.space client configured in the settings """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OcrClient.from_settings()
+        return _client
+
+
+def get_backend():
+    """ Method to get the OCR backend configured in the settings """
+    global _backend
+    with _client_lock:
+        if _backend is None:
+            _backend = import_string(settings.OCR_BACKEND).from_settings()
+        return _backend
 
-    # "AMOUNT," "Amount," "amount," "Total," "total," or "TOTAL"
-    amount_pattern = r'(?i)\b(?:AMOUNT|Amount|amount|Total|TOTAL|total)\s+(\d+(\.\d{1,2})?)\b'
-    
-    # Find the pattern using regular expression
-    match = re.search(amount_pattern, string)
-
-    if match:
-        amount = float(match.group(1))
-        return amount
-    else:
-        return None
-
-def find_date(string):
-    """ Method to find date from a string using regex """
-    date_pattern_1 = r'(\b\d{2}[/-]\d{2}[/-]\d{4}\b)'  # DD/MM/YYYY or DD-MM-YYYY
-    date_pattern_2 = r'(\b\d{1,2}\s+[A-Za-z]{3}\s+\d{4}\b)'  # 01 Jan 2018 (e.g., 01 Jan 2018 or 1 Jan 2018)
-
-    # Find dates using regular expressions
-    match1 = re.findall(date_pattern_1, string)
-    match2 = re.findall(date_pattern_2, string)
-
-    #for pattern 1
-    if match1:
-        pattern = r'(\d{2})[/\-](\d{2})[/\-](\d{4})'
-        match = re.search(pattern, match1[0])
-        if match:
-            # Extract day, month, and year from the regex match
-            day = int(match.group(1))
-            month = int(match.group(2))
-            year = int(match.group(3))
-
-            return day, month, year
-    else:
-        # Return None if no match is found
-        return 0,0,0
-
-    #for pattern 2
-    if match2:
-        date_format = "%d %b %Y"
-        parsed_date = datetime.strptime(match2, date_format)
-        day = parsed_date.day
-        month = parsed_date.month
-        year = parsed_date.year
-        return day, month, year
-    else:
-        return 0,0,0
 
 def process_data(data, engine):
         """ Method to process the amount and date data"""
         if data['OCRExitCode'] == 1:
-            amt_data = data['ParsedResults'][0]['ParsedText']
-            amount = find_amount(amt_data) or 0
-            day, month, year = find_date(data['ParsedResults'][0]['ParsedText'])
-            return {
-                "amount": amount,
-                "date": {
-                    "day": day,
-                    "month": month,
-                    "year": year,
-                }
-            }
+            return parse_text(data['ParsedResults'][0]['ParsedText'])
         else:
             print(f'Trying with OCREngine{engine}')
             return None
 
 def results(receipt):
-    """ Method to return result of the OCR API"""
-
-    engines_to_try = [1, 2, 3]
-    
-    for engine in engines_to_try:
-        #call the three engines is result is not found
-        data = json.loads(post_query_to_ocr(receipt, engine))
-        
-        if data['OCRExitCode']:
-            result = process_data(data, engine)
-            if result:
-                return json.dumps(result)
-
-    return json.dumps({'error': 'partial parse'})
-
-
+    """ Method to return result of the OCR backend"""
+    return get_backend().results(receipt)
@@ -0,0 +1,158 @@
+"""
+OCR backends which do not need the OCR.space API. TesseractBackend reads the
+receipts with a local tesseract install and RecordedBackend answers with
+recorded responses, so the OCR can be load tested and used offline.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from expensense.ocr_api import OcrBackend, parse_text
+from expensense.ocr_cache import receipt_digest
+
+try:
+    import pytesseract
+except ImportError:  # the tesseract backend is optional
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+
+def tesseract_text(receipt, config='', timeout=0):
+    """
+    Method to read the text of the receipt at the given path with tesseract,
+    which is killed once it ran for timeout seconds
+    """
+    try:
+        return pytesseract.image_to_string(receipt, config=config, timeout=timeout)
+    except RuntimeError as e:
+        # raised by pytesseract after killing the tesseract process
+        if 'timeout' in str(e).lower():
+            raise TimeoutError(str(e)) from e
+        raise
+
+
+class TesseractBackend(OcrBackend):
+    """
+    Class to read receipts with tesseract in a pool of worker processes. A
+    receipt not read within the timeout fails with a timeout, the tesseract
+    process reading it is killed by pytesseract so the worker is free for
+    the next receipt. Cancelling the future only drops a receipt still
+    waiting for a worker, it can not stop one being read
+    """
+
+    def __init__(self, pool_size=2, config='', timeout=60):
+        if pytesseract is None:
+            raise ImproperlyConfigured('The tesseract OCR backend needs pytesseract installed')
+        self.pool_size = pool_size
+        self.config = config
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """ Method to start the worker processes on first use """
+        with self._lock:
+            if self._executor is None:
+                # spawn the workers so they do not inherit the server's
+                # threads and database connections
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def results(self, receipt):
+        """ Method to return the amount and date tesseract finds on the receipt """
+        future = self._get_executor().submit(tesseract_text, receipt, self.config, self.timeout)
+        try:
+            text = future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            # the receipt waited for a worker or tesseract was killed
+            future.cancel()
+            logger.warning('Tesseract timed out reading %s', receipt)
+            return json.dumps({'error': 'timeout'})
+        except Exception as e:
+            logger.warning('Tesseract failed reading %s: %s', receipt, e)
+            return json.dumps({'error': 'OCR request failed'})
+
+        if not text.strip():
+            return json.dumps({'error': 'partial parse'})
+        return json.dumps(parse_text(text))
+
+    def close(self):
+        """ Method to stop the worker processes """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def is_parsed(response):
+    """ Method to check a response of a backend holds the results rather than an error """
+    try:
+        results = json.loads(response)
+    except (TypeError, ValueError):
+        return False
+    return isinstance(results, dict) and 'error' not in results
+
+
+class RecordedBackend(OcrBackend):
+    """
+    Class to answer with the responses recorded by the SHA-256 of the
+    receipts. Receipts which were not recorded are read with the source
+    backend and recorded when one is given, otherwise they fail to parse.
+    The latency in seconds is added to every response to stand in for a
+    real backend in load tests
+    """
+
+    def __init__(self, recordings=None, source=None, latency=0):
+        self.recordings = recordings
+        self.latency = latency
+        if isinstance(source, str):
+            source = import_string(source).from_settings()
+        self.source = source
+        self._lock = threading.Lock()
+        self.responses = {}
+        if recordings and os.path.exists(recordings):
+            with open(recordings) as f:
+                self.responses = json.load(f)
+
+    def results(self, receipt):
+        """ Method to return the recorded response of the receipt """
+        if self.latency:
+            time.sleep(self.latency)
+        digest = receipt_digest(receipt)
+        response = self.responses.get(digest)
+        if response is not None:
+            return response
+        if self.source is None:
+            return json.dumps({'error': 'not recorded'})
+        response = self.source.results(receipt)
+        if is_parsed(response):
+            # failures may be transient, they are not replayed
+            self.record(digest, response)
+        return response
+
+    def record(self, digest, response):
+        """ Method to record the response of the receipt with the given SHA-256 """
+        with self._lock:
+            self.responses[digest] = response
+            if self.recordings:
+                # replace the file so it is never partial
+                temp_path = f'{self.recordings}.tmp'
+                with open(temp_path, 'w') as f:
+                    json.dump(self.responses, f, indent=2)
+                os.replace(temp_path, self.recordings)
+
+    def close(self):
+        """ Method to release the source backend """
+        if self.source is not None:
+            self.source.close()
@@ -0,0 +1,104 @@
+"""
+Cache of the OCR results of receipts. Results are stored by the SHA-256 of
+the receipt bytes in the 'ocr' cache, so selecting the same image again does
+not query the OCR API again. Requests for a receipt which is already being
+queried wait for that query instead of sending their own. The hits and
+misses are counted across the processes in the database at OCR_LIMITS_PATH,
+see the ocr_limits command.
+"""
+
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+from expensense.ocr_api import results
+from expensense.ocr_limits import CacheCounter, LimitStore
+
+CACHE_ALIAS = 'ocr'
+
+
+def receipt_digest(receipt):
+    """ Method to get the SHA-256 of the receipt file at the given path """
+    digest = hashlib.sha256()
+    with open(receipt, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OcrResultCache:
+    """ Class to cache the OCR results of receipts and coalesce concurrent queries """
+
+    def __init__(self, query=results, alias=CACHE_ALIAS, limits_path=None):
+        self.query = query
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._counters = {'hits': 0, 'misses': 0, 'coalesced': 0}
+        # the counters are added up across the processes when they share a
+        # store, kept within this one otherwise
+        self.counts = CacheCounter(LimitStore(limits_path)) if limits_path else None
+
+    def _count(self, counter):
+        """ Method to increment one of the counters """
+        with self._lock:
+            self._counters[counter] += 1
+        if self.counts:
+            self.counts.add(counter)
+
+    def results(self, receipt, digest=None):
+        """
+        Method to return the OCR result of the receipt at the given path,
+        from the cache when it was parsed before
+        """
+        digest = digest or receipt_digest(receipt)
+        key = f'ocr-result-{digest}'
+        cache = caches[self.alias]
+        cached = cache.get(key)
+        if cached is not None:
+            self._count('hits')
+            return cached
+
+        with self._lock:
+            future = self._in_flight.get(digest)
+            leader = future is None
+            if leader:
+                future = self._in_flight[digest] = Future()
+        self._count('misses' if leader else 'coalesced')
+        if not leader:
+            return future.result()
+
+        try:
+            response = self.query(receipt)
+            # failed parses are not kept so the receipt is tried again
+            if 'error' not in json.loads(response):
+                cache.set(key, response)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[digest]
+
+    def counters(self):
+        """
+        Method to get the cache hits and misses, the queries coalesced with
+        another and the share answered without a query of their own
+        """
+        if self.counts:
+            return self.counts.counts()
+        with self._lock:
+            counts = dict(self._counters)
+        looked_up = sum(counts.values())
+        counts['hit_rate'] = (counts['hits'] + counts['coalesced']) / looked_up if looked_up else None
+        return counts
+
+
+result_cache = OcrResultCache(limits_path=settings.OCR_LIMITS_PATH)
+
@@ -0,0 +1,78 @@
+"""
+Background OCR of the receipts uploaded for the OCR preview. The upload
+request only queues the job, the page polls for the result so a slow OCR
+API does not hold a web worker.
+"""
+
+import json
+import logging
+import threading
+
+from django.conf import settings
+
+from expensense.job_pool import JobPool
+from expensense.models import ReceiptUpload
+from expensense.ocr_cache import result_cache
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(upload_id):
+    """ Method to read the receipt of an upload and save the result on it """
+    try:
+        upload = ReceiptUpload.objects.get(id=upload_id)
+    except ReceiptUpload.DoesNotExist:
+        # the expense was logged with the receipt before the job ran
+        return
+    try:
+        response = result_cache.results(upload.receipt.path, upload.sha256)
+        status = ReceiptUpload.ocr_failed if 'error' in json.loads(response) else ReceiptUpload.ocr_done
+    except Exception:
+        logger.exception('OCR failed for receipt upload %s', upload_id)
+        response, status = json.dumps({'error': 'OCR failed'}), ReceiptUpload.ocr_failed
+    ReceiptUpload.objects.filter(id=upload_id).update(ocr_status=status, ocr_result=response)
+
+
+class OcrJobPool(JobPool):
+    """ Class to manage the threads running the OCR jobs """
+    job = staticmethod(run_job)
+    thread_name_prefix = 'ocr-job'
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ Method to get the pool configured in the settings """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OcrJobPool(settings.OCR_JOB_WORKERS, settings.OCR_JOB_QUEUE_DEPTH)
+        return _pool
+
+
+def start_job(upload):
+    """
+    Method to start the OCR job of a saved upload. It runs within the
+    request when the pool is disabled and fails right away when the queue
+    is full
+    """
+    pool = get_pool()
+    if pool.submit(upload.id) is not None:
+        return
+    if not pool.size:
+        run_job(upload.id)
+    else:
+        ReceiptUpload.objects.filter(id=upload.id).update(
+            ocr_status=ReceiptUpload.ocr_failed,
+            ocr_result=json.dumps({'error': 'OCR is busy, fill in the details'}))
+    upload.refresh_from_db(fields=['ocr_status', 'ocr_result'])
+
+
+def job_status(upload):
+    """ Method to get the status of the OCR job of an upload as sent to the page """
+    status = {'receipt_token': upload.token, 'status': upload.ocr_status}
+    if upload.ocr_result:
+        status.update(json.loads(upload.ocr_result))
+    return status
@@ -0,0 +1,312 @@
+"""
+Limits on the requests sent to the OCR API which hold across all the server
+processes. A token bucket caps the request rate to the quota of the API and
+a circuit breaker per engine stops sending requests to an engine which keeps
+failing until it was given time to recover. Their state is kept in a local
+SQLite database every process on the host opens, as are the counts comparing
+the enhanced receipts with the plain ones and the hits and misses of the OCR
+result cache.
+"""
+
+import sqlite3
+import threading
+import time
+
+# states of a circuit breaker, an open one fails fast until the cooldown is
+# over, then a single probe request is let through while it is half open
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS ocr_buckets (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS ocr_breakers (
+        engine INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        failures INTEGER NOT NULL,
+        opened_at REAL,
+        probe_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS ocr_receipts (
+        mode TEXT PRIMARY KEY,
+        receipts INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS ocr_parses (
+        mode TEXT NOT NULL,
+        engine INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        parsed INTEGER NOT NULL,
+        PRIMARY KEY (mode, engine)
+    );
+    CREATE TABLE IF NOT EXISTS ocr_cache_counts (
+        name TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    );
+'''
+
+
+class LimitStore:
+    """
+    Class to run transactions on the SQLite database the limits are kept
+    in. Every thread has its own connection and every transaction takes
+    the write lock of the database, so the processes take turns
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_created = False
+
+    def _connection(self):
+        """ Method to get the connection of the current thread """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            with self._schema_lock:
+                if not self._schema_created:
+                    connection.executescript(SCHEMA)
+                    self._schema_created = True
+            self._local.connection = connection
+        return connection
+
+    def transaction(self, func):
+        """ Method to call func with a cursor inside a write transaction and return its result """
+        connection = self._connection()
+        cursor = connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(cursor)
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return result
+
+
+class RateLimiter:
+    """
+    Class to limit the requests to rate per second with bursts of up to
+    burst requests, the tokens are shared by every limiter on the same store
+    and name
+    """
+
+    def __init__(self, store, rate, burst=None, name='ocr'):
+        self.store = store
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.name = name
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def _take(self, cursor, tokens):
+        """ Method to take the tokens if the bucket has them, returns the seconds until it does """
+        now = time.time()
+        cursor.execute('SELECT tokens, updated FROM ocr_buckets WHERE name = ?', (self.name,))
+        row = cursor.fetchone()
+        available = self.burst if row is None else min(
+            self.burst, row[0] + max(now - row[1], 0) * self.rate)
+        wait = 0.0
+        if available >= tokens:
+            available -= tokens
+        else:
+            wait = (tokens - available) / self.rate
+        cursor.execute('INSERT OR REPLACE INTO ocr_buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                       (self.name, available, now))
+        return wait
+
+    def acquire(self, timeout=0, tokens=1):
+        """
+        Method to take a token for a request, waiting at most timeout seconds
+        for the bucket to refill. Returns whether the request may be sent
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.store.transaction(lambda cursor: self._take(cursor, tokens))
+            if not wait:
+                with self._lock:
+                    self.allowed += 1
+                return True
+            if time.monotonic() + wait > deadline:
+                with self._lock:
+                    self.limited += 1
+                return False
+            time.sleep(wait)
+
+    def state(self):
+        """ Method to get the tokens left and the requests this process let through and limited """
+        def read(cursor):
+            cursor.execute('SELECT tokens, updated FROM ocr_buckets WHERE name = ?', (self.name,))
+            return cursor.fetchone()
+        row = self.store.transaction(read)
+        tokens = self.burst if row is None else min(
+            self.burst, row[0] + max(time.time() - row[1], 0) * self.rate)
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'tokens': tokens,
+                    'allowed': self.allowed, 'limited': self.limited}
+
+
+class CircuitBreaker:
+    """
+    Class to stop sending requests to an engine after failure_threshold
+    failures in a row. Once the cooldown in seconds is over one probe request
+    is let through, the breaker closes again when it succeeds and stays open
+    for another cooldown when it fails
+    """
+
+    def __init__(self, store, failure_threshold=5, cooldown=30):
+        self.store = store
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    @staticmethod
+    def _read(cursor, engine):
+        """ Method to get the state, failures, opening and probe time of an engine """
+        cursor.execute('SELECT state, failures, opened_at, probe_at FROM ocr_breakers '
+                       'WHERE engine = ?', (engine,))
+        return cursor.fetchone() or (CLOSED, 0, None, None)
+
+    @staticmethod
+    def _write(cursor, engine, state, failures, opened_at=None, probe_at=None):
+        """ Method to save the state of the breaker of an engine """
+        cursor.execute('INSERT OR REPLACE INTO ocr_breakers (engine, state, failures, opened_at, '
+                       'probe_at) VALUES (?, ?, ?, ?, ?)',
+                       (engine, state, failures, opened_at, probe_at))
+
+    def allow(self, engine):
+        """ Method to check whether a request may be sent to the engine """
+        def check(cursor):
+            state, failures, opened_at, probe_at = self._read(cursor, engine)
+            if state == CLOSED:
+                return True
+            now = time.time()
+            if state == OPEN and now - opened_at < self.cooldown:
+                return False
+            # a probe which never reported back does not hold the breaker forever
+            if state == HALF_OPEN and now - probe_at < self.cooldown:
+                return False
+            self._write(cursor, engine, HALF_OPEN, failures, opened_at, now)
+            return True
+        return self.store.transaction(check)
+
+    def is_open(self, engine):
+        """ Method to check without probing whether the requests to the engine fail fast """
+        state, failures, opened_at, probe_at = self.store.transaction(
+            lambda cursor: self._read(cursor, engine))
+        now = time.time()
+        if state == OPEN:
+            return now - opened_at < self.cooldown
+        return state == HALF_OPEN and now - probe_at < self.cooldown
+
+    def record_success(self, engine):
+        """ Method to close the breaker of an engine which answered """
+        self.store.transaction(lambda cursor: self._write(cursor, engine, CLOSED, 0))
+
+    def reset(self, engine):
+        """ Method to close the breaker of an engine by hand """
+        self.record_success(engine)
+
+    def record_failure(self, engine):
+        """ Method to count a failure of an engine, opening its breaker at the threshold """
+        def count(cursor):
+            state, failures, opened_at, probe_at = self._read(cursor, engine)
+            failures += 1
+            if state == HALF_OPEN or failures >= self.failure_threshold:
+                self._write(cursor, engine, OPEN, failures, time.time())
+            else:
+                self._write(cursor, engine, state, failures, opened_at, probe_at)
+        self.store.transaction(count)
+
+    def states(self):
+        """ Method to get the state, failures in a row and seconds until the probe of every engine """
+        def read(cursor):
+            cursor.execute('SELECT engine, state, failures, opened_at FROM ocr_breakers ORDER BY engine')
+            return cursor.fetchall()
+        now = time.time()
+        return {engine: {'state': state, 'failures': failures,
+                         'retry_in': max(opened_at + self.cooldown - now, 0) if state == OPEN else 0}
+                for engine, state, failures, opened_at in self.store.transaction(read)}
+
+
+class OutcomeCounter:
+    """
+    Class to count the receipts sent in every mode, enhanced or plain, and
+    the requests every engine answered and parsed for them, added up across
+    the processes sharing the store
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def add_receipt(self, mode):
+        """ Method to count a receipt sent in the mode """
+        self.store.transaction(lambda cursor: cursor.execute(
+            'INSERT INTO ocr_receipts (mode, receipts) VALUES (?, 1) '
+            'ON CONFLICT (mode) DO UPDATE SET receipts = receipts + 1', (mode,)))
+
+    def add_attempt(self, mode, engine, parsed):
+        """ Method to count a request an engine answered for a receipt sent in the mode """
+        self.store.transaction(lambda cursor: cursor.execute(
+            'INSERT INTO ocr_parses (mode, engine, attempts, parsed) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT (mode, engine) DO UPDATE SET attempts = attempts + 1, '
+            'parsed = parsed + excluded.parsed', (mode, engine, int(parsed))))
+
+    def counts(self, modes):
+        """ Method to get the receipts and the attempts and parses per engine of the modes """
+        def read(cursor):
+            cursor.execute('SELECT mode, receipts FROM ocr_receipts')
+            receipts = dict(cursor.fetchall())
+            cursor.execute('SELECT mode, engine, attempts, parsed FROM ocr_parses ORDER BY engine')
+            return receipts, cursor.fetchall()
+        receipts, parses = self.store.transaction(read)
+        counts = {mode: {'receipts': receipts.get(mode, 0), 'engines': {}} for mode in modes}
+        for mode, engine, attempts, parsed in parses:
+            if mode in counts:
+                counts[mode]['engines'][engine] = {'attempts': attempts, 'parsed': parsed}
+        return counts
+
+    def reset(self):
+        """ Method to start the counts over, e.g. when the enhancement changed """
+        def clear(cursor):
+            cursor.execute('DELETE FROM ocr_receipts')
+            cursor.execute('DELETE FROM ocr_parses')
+        self.store.transaction(clear)
+
+
+class CacheCounter:
+    """
+    Class to count the hits and misses of the OCR result cache and the
+    queries coalesced with another, added up across the processes sharing
+    the store
+    """
+    names = ('hits', 'misses', 'coalesced')
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, name):
+        """ Method to count a hit, miss or coalesced query """
+        self.store.transaction(lambda cursor: cursor.execute(
+            'INSERT INTO ocr_cache_counts (name, count) VALUES (?, 1) '
+            'ON CONFLICT (name) DO UPDATE SET count = count + 1', (name,)))
+
+    def counts(self):
+        """ Method to get the counts and the share of the receipts answered from the cache """
+        def read(cursor):
+            cursor.execute('SELECT name, count FROM ocr_cache_counts')
+            return dict(cursor.fetchall())
+        stored = self.store.transaction(read)
+        counts = {name: stored.get(name, 0) for name in self.names}
+        looked_up = sum(counts.values())
+        counts['hit_rate'] = (counts['hits'] + counts['coalesced']) / looked_up if looked_up else None
+        return counts
+
+    def reset(self):
+        """ Method to start the counts over """
+        self.store.transaction(lambda cursor: cursor.execute('DELETE FROM ocr_cache_counts'))
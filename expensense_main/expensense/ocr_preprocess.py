@@ -0,0 +1,256 @@
+"""
+Preparation of the receipts sent to the OCR API. Phone photos are brought
+down to a resolution the OCR engines read well and re-encoded as grayscale
+JPEGs within a size budget, which also drops their metadata. A receipt sent
+as it was uploaded has its metadata stripped as well. They can also be
+enhanced first, cropped to the receipt, straightened and binarized, so the
+first engine reads more of them.
+"""
+
+import os
+import struct
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from expensense.signature_matching import read_receipt
+
+# JPEG segments kept when the metadata of a receipt is stripped, the JFIF
+# header and the Adobe colour transform decoding depends on. The other
+# application segments hold EXIF, XMP, IPTC and the like
+JPEG_APP0 = 0xE0
+JPEG_APP14 = 0xEE
+JPEG_COMMENT = 0xFE
+JPEG_START_OF_SCAN = 0xDA
+# markers which stand alone, without a length
+JPEG_STANDALONE = {0x01} | set(range(0xD0, 0xD8))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG chunks of text, EXIF and the modification time
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'}
+
+# EXIF tag of the rotation a viewer applies to the image
+EXIF_ORIENTATION = 0x0112
+
+# longest side in pixels receipts are sent at
+OCR_MAX_SIDE = 2000
+
+# size in bytes the receipts sent have to fit in, OCR.space rejects bigger files
+OCR_MAX_BYTES = 1024 * 1024
+
+# JPEG qualities tried from the best down before the receipt is scaled down
+JPEG_QUALITIES = (85, 75, 65, 55, 45)
+
+# ratio the sides are scaled by when the lowest quality does not fit the budget
+SHRINK_RATIO = 0.75
+
+# skew angles in degrees searched, the step between them and the smallest
+# one which is corrected
+MAX_SKEW_ANGLE = 15
+SKEW_STEP = 0.5
+MIN_SKEW_ANGLE = 0.5
+
+# longest side in pixels the skew is estimated at
+SKEW_WORKING_SIZE = 800
+
+# neighbourhood in pixels and offset of the adaptive binarization
+BINARIZE_BLOCK_SIZE = 31
+BINARIZE_OFFSET = 15
+
+
+def normalize_contrast(img):
+    """ Method to even out the contrast of a grayscale receipt across uneven lighting """
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe.apply(img)
+
+
+def crop_border(img, margin=10):
+    """
+    Method to crop a photo to the receipt in it, the biggest bright region,
+    the image is kept as it is when no such region stands out
+    """
+    _, mask = cv2.threshold(cv2.GaussianBlur(img, (5, 5), 0), 0, 255,
+                            cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return img
+    x, y, width, height = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    # a small region is text on a light background rather than the receipt
+    if width * height < 0.2 * img.shape[0] * img.shape[1]:
+        return img
+    top, left = max(y - margin, 0), max(x - margin, 0)
+    return img[top:y + height + margin, left:x + width + margin]
+
+
+def skew_angle(img):
+    """
+    Method to estimate the angle in degrees a receipt has to be rotated by
+    to straighten its text, the angle whose rows of ink are the most uneven,
+    lines of text alternating with the gaps between them
+    """
+    scale = min(SKEW_WORKING_SIZE / max(img.shape[:2]), 1.0)
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # a local threshold marks the letters but not big dark areas around the receipt
+    ink = cv2.adaptiveThreshold(small, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+                                BINARIZE_BLOCK_SIZE, BINARIZE_OFFSET)
+    height, width = ink.shape
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-MAX_SKEW_ANGLE, MAX_SKEW_ANGLE + SKEW_STEP / 2, SKEW_STEP):
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        rows = cv2.warpAffine(ink, rotation, (width, height), flags=cv2.INTER_NEAREST).sum(axis=1)
+        score = float(np.var(rows))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def deskew(img):
+    """ Method to rotate a receipt so its lines of text are horizontal """
+    angle = skew_angle(img)
+    if abs(angle) < MIN_SKEW_ANGLE:
+        return img
+    height, width = img.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(img, rotation, (width, height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def binarize(img):
+    """ Method to turn a receipt black and white with a threshold following the lighting """
+    return cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                 BINARIZE_BLOCK_SIZE, BINARIZE_OFFSET)
+
+
+def enhance_receipt(img):
+    """ Method to crop, straighten and binarize a grayscale receipt for the OCR """
+    img = normalize_contrast(img)
+    img = crop_border(img)
+    img = deskew(img)
+    return binarize(img)
+
+
+def encode_jpeg(img, quality):
+    """ Method to encode an image as a JPEG of the given quality """
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('Unable to encode image')
+    return buffer.tobytes()
+
+
+def encode_png(img):
+    """ Method to encode an image as a PNG, which keeps binarized receipts small and sharp """
+    ok, buffer = cv2.imencode('.png', img)
+    if not ok:
+        raise ValueError('Unable to encode image')
+    return buffer.tobytes()
+
+
+def strip_jpeg_metadata(data):
+    """ Method to get the bytes of a JPEG without its metadata segments, None when it can not be parsed """
+    kept = [data[:2]]
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # fill byte before a marker
+            position += 1
+            continue
+        if marker in JPEG_STANDALONE:
+            kept.append(data[position:position + 2])
+            position += 2
+            continue
+        if marker == JPEG_START_OF_SCAN:
+            # the image data follows, metadata only comes before it
+            kept.append(data[position:])
+            return b''.join(kept)
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        end = position + 2 + length
+        if length < 2 or end > len(data):
+            return None
+        metadata = (0xE0 <= marker <= 0xEF and marker not in (JPEG_APP0, JPEG_APP14)) or marker == JPEG_COMMENT
+        if not metadata:
+            kept.append(data[position:end])
+        position = end
+    return None
+
+
+def strip_png_metadata(data):
+    """ Method to get the bytes of a PNG without its metadata chunks, None when it can not be parsed """
+    kept = [PNG_SIGNATURE]
+    position = len(PNG_SIGNATURE)
+    while position + 12 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        end = position + 12 + length
+        if end > len(data):
+            return None
+        if chunk_type not in PNG_METADATA_CHUNKS:
+            kept.append(data[position:end])
+        position = end
+        if chunk_type == b'IEND':
+            return b''.join(kept)
+    return None
+
+
+def strip_metadata(data):
+    """
+    Method to get the bytes of a JPEG or PNG receipt without its metadata,
+    None for other formats, files which can not be parsed and photos whose
+    EXIF rotates them, which are only upright once decoded and re-encoded
+    """
+    if data.startswith(b'\xff\xd8'):
+        stripped = strip_jpeg_metadata(data)
+    elif data.startswith(PNG_SIGNATURE):
+        stripped = strip_png_metadata(data)
+    else:
+        return None
+    if stripped is None:
+        return None
+    try:
+        orientation = Image.open(BytesIO(data)).getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return None
+    return stripped if orientation == 1 else None
+
+
+def compress_receipt(receipt, max_side=OCR_MAX_SIDE, max_bytes=OCR_MAX_BYTES, enhance=False):
+    """
+    Method to get the bytes of a receipt given as a path or encoded bytes as
+    a grayscale JPEG with its longer side no bigger than max_side and at most
+    max_bytes big. A receipt which is smaller as it is and already fits is
+    kept as it is, without its metadata. An enhanced receipt is sent as a
+    PNG when that fits. Returns the file name and bytes to send
+    """
+    if isinstance(receipt, (bytes, bytearray)):
+        name, original = 'receipt.jpg', bytes(receipt)
+    else:
+        name = os.path.basename(receipt)
+        with open(receipt, 'rb') as f:
+            original = f.read()
+
+    img, _ = read_receipt(original, max_size=max_side)
+    if enhance:
+        img = enhance_receipt(img)
+        compressed = encode_png(img)
+        if not max_bytes or len(compressed) <= max_bytes:
+            return f'{os.path.splitext(name)[0]}.png', compressed
+
+    while True:
+        for quality in JPEG_QUALITIES:
+            compressed = encode_jpeg(img, quality)
+            if not max_bytes or len(compressed) <= max_bytes:
+                break
+        if not max_bytes or len(compressed) <= max_bytes or min(img.shape[:2]) < 100:
+            break
+        height, width = img.shape[:2]
+        img = cv2.resize(img, (round(width * SHRINK_RATIO), round(height * SHRINK_RATIO)),
+                         interpolation=cv2.INTER_AREA)
+
+    stripped = None if enhance else strip_metadata(original)
+    if stripped is not None and (not max_bytes or len(stripped) <= max_bytes) \
+            and len(stripped) <= len(compressed):
+        return name, stripped
+    return f'{os.path.splitext(name)[0]}.jpg', compressed
@@ -0,0 +1,102 @@
+"""
+Local stub of the OCR.space API, so the OCR client can be tested and load
+tested without network access. Run it with the ocr_stub_server management
+command and point OCR_ENDPOINT at it.
+"""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# response of an engine the stub was not given a response for
+UNPARSED_RESPONSE = {'OCRExitCode': 3, 'ParsedResults': []}
+
+
+def parsed_response(text):
+    """ Method to get a successful OCR API response with the given text """
+    return {'OCRExitCode': 1, 'ParsedResults': [{'ParsedText': text}]}
+
+
+class StubOcrHandler(BaseHTTPRequestHandler):
+    """ Class to answer OCR requests the way the OCR API does """
+    protocol_version = 'HTTP/1.1'
+    # the headers and body are sent in separate writes, do not wait for
+    # the acknowledgement of the headers before sending the body
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        """ Method to answer with the configured response of the requested engine """
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        match = re.search(rb'name="OCREngine"\r\n\r\n(\d)', body)
+        engine = int(match.group(1)) if match else 1
+        with self.server.requested:
+            self.server.engines_called.append(engine)
+            self.server.bytes_received += len(body)
+            self.server.requested.notify_all()
+        hold = self.server.holds.get(engine)
+        if hold is not None:
+            hold.wait()
+        delay = self.server.delays.get(engine, 0)
+        if self.server.bandwidth:
+            # stand in for the upload over a link of the given bandwidth
+            delay += len(body) / self.server.bandwidth
+        time.sleep(delay)
+
+        data = self.server.responses.get(engine, UNPARSED_RESPONSE)
+        content = json.dumps(data).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting for a delayed response
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOcrServer(ThreadingHTTPServer):
+    """
+    Class to serve the stub OCR API. The responses and delays in seconds are
+    given per engine, the engines requested are kept in engines_called.
+    Requests are slowed down as if uploaded with the bandwidth in bytes per
+    second when one is given. An engine given a threading.Event in holds
+    does not answer until the event is set
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, responses=None, delays=None, bandwidth=None):
+        super().__init__((host, port), StubOcrHandler)
+        self.responses = responses or {}
+        self.delays = delays or {}
+        self.bandwidth = bandwidth
+        self.holds = {}
+        self.engines_called = []
+        self.bytes_received = 0
+        self.requested = threading.Condition()
+
+    @property
+    def endpoint(self):
+        """ Method to get the URL to post the receipts to """
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/parse/image'
+
+    def wait_for_requests(self, count, timeout=5):
+        """ Method to wait until count requests arrived, returns whether they did in time """
+        with self.requested:
+            return self.requested.wait_for(lambda: len(self.engines_called) >= count, timeout)
+
+    def start(self):
+        """ Method to serve the requests in a background thread """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Method to stop serving and close the socket """
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,228 @@
+"""
+Bulk export of the expenses to Parquet for the BI pipelines. The expenses are
+joined with their user, team, company and category into typed columns and
+written in record batches of a fixed size to a dataset partitioned by company
+and month, company_id=<id>/month=<yyyy-mm>/part-<run>.parquet. An incremental
+export only writes the expenses saved since the watermark of the last one, so
+an expense changed since it was exported appears in several parts, the one
+with the latest updated_at is current. Renaming the user, team, company or
+category of expenses marks them as saved, so they are exported again with the
+new names. Deleted expenses are not exported.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from expensense.export import ChunkBuffer
+from expensense.models import Expense
+from expensense.report import ITERATOR_CHUNK_SIZE, STATUS_LABELS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # the parquet export is optional
+    pa = pq = None
+
+# columns of the parquet files and the fields of the expenses they are read
+# from, the company is the partition so its id is not a column
+COLUMNS = (
+    ('expense_id', 'id'),
+    ('expense_date', 'expense_date'),
+    ('expense_name', 'expense_name'),
+    ('amount', 'amount'),
+    ('status', 'status'),
+    ('category', 'category__category_name'),
+    ('user_id', 'user_id'),
+    ('username', 'user_id__username'),
+    ('team_id', 'user_id__team_id'),
+    ('team', 'user_id__team__team_name'),
+    ('company', 'user_id__company__company'),
+    ('created_at', 'created_at'),
+    ('manager_approved_at', 'manager_approved_at'),
+    ('admin_approved_at', 'admin_approved_at'),
+    ('updated_at', 'updated_at'),
+)
+COLUMN_NAMES = [name for name, field in COLUMNS]
+STATUS_INDEX = COLUMN_NAMES.index('status')
+DATE_INDEX = COLUMN_NAMES.index('expense_date')
+
+# the watermark of a dataset is kept next to its partitions, readers of the
+# dataset skip files starting with an underscore
+WATERMARK_FILE = '_watermark.json'
+
+# an expense saved just before an export may commit after it read the
+# changed expenses, so incremental exports look back this far as well
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+
+def export_schema():
+    """ Method to get the arrow schema of the parquet files """
+    timestamp = pa.timestamp('us', tz='UTC')
+    return pa.schema([
+        ('expense_id', pa.int64()),
+        ('expense_date', pa.date32()),
+        ('expense_name', pa.string()),
+        # the precision and scale of Expense.amount
+        ('amount', pa.decimal128(10, 2)),
+        ('status', pa.string()),
+        ('category', pa.string()),
+        ('user_id', pa.int64()),
+        ('username', pa.string()),
+        ('team_id', pa.int64()),
+        ('team', pa.string()),
+        ('company', pa.string()),
+        ('created_at', timestamp),
+        ('manager_approved_at', timestamp),
+        ('admin_approved_at', timestamp),
+        ('updated_at', timestamp),
+    ])
+
+
+def changed_expenses(expenses=None, since=None, until=None):
+    """
+    Method to get the expenses saved after since and at the latest until
+    with their partition first, in the order of the partitions
+    """
+    if expenses is None:
+        expenses = Expense.objects.all()
+    if since is not None:
+        expenses = expenses.filter(updated_at__gt=since - WATERMARK_OVERLAP)
+    if until is not None:
+        expenses = expenses.filter(updated_at__lte=until)
+    fields = ['user_id__company_id'] + [field for name, field in COLUMNS]
+    return expenses.order_by('user_id__company_id', 'expense_date', 'id').values_list(*fields)
+
+
+def partition_path(company_id, expense_date):
+    """ Method to get the directory of the partition of an expense, relative to the dataset """
+    return os.path.join(f'company_id={company_id}', f'month={expense_date:%Y-%m}')
+
+
+def read_watermark(directory):
+    """ Method to get the watermark of the last export to a dataset, None when there was none """
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE)) as f:
+            return parse_datetime(json.load(f)['watermark'])
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(directory, watermark):
+    """ Method to save the watermark of an export to a dataset once it is complete """
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+        json.dump({'watermark': watermark.isoformat()}, f)
+    os.replace(f.name, os.path.join(directory, WATERMARK_FILE))
+
+
+class ParquetExporter:
+    """
+    Class to write rows of expenses to a dataset directory. The rows of a
+    partition are collected into record batches of batch_rows rows, every
+    batch becomes a row group of the partition's file
+    """
+
+    def __init__(self, directory, batch_rows=None, compression='snappy'):
+        if pa is None:
+            raise ImproperlyConfigured('The parquet export needs pyarrow installed')
+        self.directory = directory
+        self.batch_rows = batch_rows or settings.PARQUET_EXPORT_BATCH_ROWS
+        self.compression = compression
+        self.schema = export_schema()
+
+    def export(self, rows, run):
+        """
+        Method to write the rows, which come with their company id first and
+        in the order of the partitions, as the part named run of every
+        partition they are in. Returns the rows and files written
+        """
+        written = {'rows': 0, 'files': []}
+        writer = partition = None
+        columns = [[] for name in COLUMN_NAMES]
+
+        def flush():
+            """ Method to write the collected rows as a record batch """
+            if columns[0]:
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                    schema=self.schema))
+                for column in columns:
+                    column.clear()
+
+        try:
+            for company_id, *row in rows:
+                row_partition = partition_path(company_id, row[DATE_INDEX])
+                if row_partition != partition:
+                    if writer is not None:
+                        flush()
+                        writer.close()
+                    partition = row_partition
+                    os.makedirs(os.path.join(self.directory, partition), exist_ok=True)
+                    path = os.path.join(partition, f'part-{run}.parquet')
+                    writer = pq.ParquetWriter(os.path.join(self.directory, path), self.schema,
+                                              compression=self.compression)
+                    written['files'].append(path)
+
+                row[STATUS_INDEX] = STATUS_LABELS.get(row[STATUS_INDEX], '')
+                for column, value in zip(columns, row):
+                    column.append(value)
+                written['rows'] += 1
+                if len(columns[0]) == self.batch_rows:
+                    flush()
+            if writer is not None:
+                flush()
+        finally:
+            if writer is not None:
+                writer.close()
+        return written
+
+
+def export_dataset(directory, expenses=None, since=None, incremental=False, batch_rows=None):
+    """
+    Method to export the expenses saved after since to a dataset directory.
+    An incremental export continues from the watermark of the dataset and
+    moves it on once the export is complete. Returns what was exported
+    """
+    exporter = ParquetExporter(directory, batch_rows)
+    os.makedirs(directory, exist_ok=True)
+    if incremental and since is None:
+        since = read_watermark(directory)
+    watermark = timezone.now()
+
+    rows = changed_expenses(expenses, since, watermark).iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    written = exporter.export(rows, watermark.strftime('%Y%m%dT%H%M%S%fZ'))
+    if incremental:
+        write_watermark(directory, watermark)
+    written.update(since=since, watermark=watermark)
+    return written
+
+
+def dataset_zip_chunks(directory, block_size=1024 * 1024):
+    """
+    Method to get a zip of the files of a dataset directory in chunks,
+    removing the directory once it was read
+    """
+    buffer = ChunkBuffer(binary=True)
+    try:
+        # the parquet files are compressed already
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    with open(path, 'rb') as f, \
+                            archive.open(os.path.relpath(path, directory), 'w', force_zip64=True) as entry:
+                        for block in iter(lambda: f.read(block_size), b''):
+                            entry.write(block)
+                            yield buffer.take()
+        yield buffer.take()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,261 @@
+"""
+Extraction of the amount and date from the text the OCR read off a receipt.
+The text is scanned once with a precompiled pattern of the labels, dates and
+amounts on it. Every amount and date found is a candidate with a confidence,
+the amount from the label which most likely marks the total paid and the
+date in the clearest format are the best ones.
+"""
+
+import re
+from collections import namedtuple
+from datetime import date
+
+# an amount or date found on a receipt, the position is its offset in the text
+Candidate = namedtuple('Candidate', ['value', 'confidence', 'text', 'position'])
+
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+MONTH_PATTERN = (r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|'
+                 r'aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)')
+
+# confidence of an amount by the label before it on its line, the labels of
+# amounts which are not the total paid have a low one
+AMOUNT_LABELS = {
+    'grand total': 1.0,
+    'total due': 0.95,
+    'amount due': 0.95,
+    'balance due': 0.95,
+    'total amount': 0.95,
+    'amount payable': 0.95,
+    'total payable': 0.95,
+    'net payable': 0.95,
+    'total': 0.85,
+    'net total': 0.8,
+    'net amount': 0.8,
+    'amount': 0.7,
+    'sub total': 0.4,
+    'subtotal': 0.4,
+    'tax': 0.05,
+    'vat': 0.05,
+    'gst': 0.05,
+    'service charge': 0.05,
+    'tip': 0.05,
+    'change': 0.05,
+    'cash': 0.05,
+    'discount': 0.05,
+}
+DATE_LABELS = {'date', 'dated'}
+
+# confidence of amounts without a label, with and without a currency
+CURRENCY_CONFIDENCE = 0.3
+UNLABELLED_CONFIDENCE = 0.1
+# factors of the confidence of a label carried over from the line above and
+# of whole numbers, which are often quantities
+NEXT_LINE_FACTOR = 0.8
+WHOLE_NUMBER_FACTOR = 0.8
+
+# confidence of a date by its format
+ISO_DATE_CONFIDENCE = 0.9
+NAMED_MONTH_CONFIDENCE = 0.9
+DAY_FIRST_CONFIDENCE = 0.8
+MONTH_FIRST_CONFIDENCE = 0.5
+SHORT_YEAR_PENALTY = 0.1
+DATE_LABEL_BONUS = 0.1
+
+# receipts are not expected outside of these years
+MIN_YEAR = 1990
+MAX_YEAR = 2100
+
+DATE_PATTERN = r'''
+    (?<!\d)(?:
+        (?P<iso_year>\d{4})[-/.](?P<iso_month>\d{1,2})[-/.](?P<iso_day>\d{1,2})
+      | (?P<num_first>\d{1,2})(?P<num_sep>[-/.])(?P<num_second>\d{1,2})(?P=num_sep)(?P<num_year>\d{4}|\d{2})
+      | (?P<name_day>\d{1,2})(?:st|nd|rd|th)?[\s\-/]*(?P<name_month>MONTH)\.?[\s\-/,]*(?P<name_year>\d{4}|\d{2})
+      | (?P<lead_month>MONTH)\.?\s+(?P<lead_day>\d{1,2})(?:st|nd|rd|th)?,?\s+(?P<lead_year>\d{4})
+    )(?!\d)
+'''.replace('MONTH', MONTH_PATTERN)
+
+LABEL_PATTERN = r'''
+    \b(?:grand\s+total|total\s+due|amount\s+due|balance\s+due|total\s+amount|amount\s+payable
+      |total\s+payable|net\s+payable|net\s+total|net\s+amount|sub[\s\-]?total|total|amount
+      |tax|vat|gst|service\s+charge|tip|change|cash|discount|dated|date)\b
+'''
+
+AMOUNT_PATTERN = r'''
+    (?:(?P<currency>[$€£₹¥]|\b(?:USD|EUR|GBP|INR|AUD|CAD|Rs)\b\.?)\s?)?
+    (?<![\d.,])(?P<number>
+        \d{1,3}(?:,\d{3})+(?:\.\d{1,2})?
+      | \d{1,3}(?:\.\d{3})+,\d{1,2}
+      | \d{1,7}(?:[.,]\d{1,2})?
+    )(?![\d])
+'''
+
+# dates come first so their numbers are not read as amounts
+TOKEN_RE = re.compile(rf'''
+    (?P<date>{DATE_PATTERN})
+  | (?P<label>{LABEL_PATTERN})
+  | (?P<amount>{AMOUNT_PATTERN})
+  | (?P<newline>\n)
+''', re.IGNORECASE | re.VERBOSE)
+
+WHITESPACE_RE = re.compile(r'[\s\-]+')
+DECIMALS_RE = re.compile(r'[.,]\d{1,2}$')
+
+
+def parse_number(number):
+    """
+    Method to read an amount written with thousands separators and a decimal
+    point or comma, 1,234.50 and 1.234,50 are both 1234.5
+    """
+    if ',' in number and '.' in number:
+        thousands = ',' if number.rindex('.') > number.rindex(',') else '.'
+        number = number.replace(thousands, '')
+    elif ',' in number:
+        # a comma before the last three digits separates thousands
+        head, tail = number.rsplit(',', 1)
+        number = number.replace(',', '') if len(tail) == 3 else f'{head.replace(",", "")}.{tail}'
+    elif number.count('.') > 1:
+        number = number.replace('.', '')
+    return float(number.replace(',', '.'))
+
+
+def short_year(year):
+    """ Method to get the full year of a year written with two digits """
+    return 2000 + year if year < 100 else year
+
+
+def match_date(match):
+    """ Method to get the date and confidence of a matched date, None when it is no real date """
+    groups = match.groupdict()
+    if groups['iso_year']:
+        candidates = [((int(groups['iso_year']), int(groups['iso_month']), int(groups['iso_day'])),
+                       ISO_DATE_CONFIDENCE)]
+        year_text = groups['iso_year']
+    elif groups['num_first']:
+        first, second = int(groups['num_first']), int(groups['num_second'])
+        year = short_year(int(groups['num_year']))
+        # dates are written day first unless the first number cannot be a day
+        candidates = [((year, second, first), DAY_FIRST_CONFIDENCE),
+                      ((year, first, second), MONTH_FIRST_CONFIDENCE)]
+        year_text = groups['num_year']
+    elif groups['name_day']:
+        candidates = [((short_year(int(groups['name_year'])), MONTHS[groups['name_month'][:3].lower()],
+                        int(groups['name_day'])), NAMED_MONTH_CONFIDENCE)]
+        year_text = groups['name_year']
+    else:
+        candidates = [((int(groups['lead_year']), MONTHS[groups['lead_month'][:3].lower()],
+                        int(groups['lead_day'])), NAMED_MONTH_CONFIDENCE)]
+        year_text = groups['lead_year']
+
+    for (year, month, day), confidence in candidates:
+        if not MIN_YEAR <= year <= MAX_YEAR:
+            continue
+        try:
+            value = date(year, month, day)
+        except ValueError:
+            continue
+        if len(year_text) == 2:
+            confidence -= SHORT_YEAR_PENALTY
+        return value, confidence
+    return None
+
+
+def extract(text):
+    """
+    Method to find the amounts and dates on a receipt, returns both lists of
+    candidates with the most likely first
+    """
+    amounts = []
+    dates = []
+    label_confidence = None
+    carried_confidence = None
+    line_has_amount = False
+    line_has_date_label = False
+
+    for match in TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == 'newline':
+            # a label alone on its line is for the amount on the next one
+            carried_confidence = (label_confidence * NEXT_LINE_FACTOR
+                                  if label_confidence is not None and not line_has_amount else None)
+            label_confidence = None
+            line_has_amount = line_has_date_label = False
+
+        elif kind == 'label':
+            label = WHITESPACE_RE.sub(' ', match.group('label').strip().lower())
+            if label in DATE_LABELS:
+                line_has_date_label = True
+            else:
+                label_confidence = AMOUNT_LABELS[label]
+
+        elif kind == 'date':
+            found = match_date(match)
+            if found:
+                value, confidence = found
+                if line_has_date_label:
+                    confidence = min(confidence + DATE_LABEL_BONUS, 1.0)
+                dates.append(Candidate(value, confidence, match.group('date'), match.start()))
+
+        else:
+            number = match.group('number')
+            if label_confidence is not None:
+                confidence = label_confidence
+            elif carried_confidence is not None:
+                confidence = carried_confidence
+            elif match.group('currency'):
+                confidence = CURRENCY_CONFIDENCE
+            else:
+                confidence = UNLABELLED_CONFIDENCE
+            if not DECIMALS_RE.search(number):
+                confidence *= WHOLE_NUMBER_FACTOR
+            line_has_amount = True
+            amounts.append(Candidate(parse_number(number), confidence,
+                                     match.group('amount').strip(), match.start()))
+
+    # the last of equally likely totals is the final one, the first of
+    # equally likely dates the one of the purchase
+    amounts.sort(key=lambda candidate: (-candidate.confidence, -candidate.position))
+    dates.sort(key=lambda candidate: (-candidate.confidence, candidate.position))
+    return amounts, dates
+
+
+def find_amount(string):
+    """ Method to find the most likely total amount in a string, None when there is none """
+    amounts, dates = extract(string)
+    return amounts[0].value if amounts else None
+
+
+def find_date(string):
+    """ Method to find the most likely date in a string as day, month and year, or 0, 0, 0 """
+    amounts, dates = extract(string)
+    if not dates:
+        return 0, 0, 0
+    return dates[0].value.day, dates[0].value.month, dates[0].value.year
+
+
+def parse_text(text, candidates=3):
+    """
+    Method to find the amount and date in the text of a receipt, with their
+    confidence and the most likely candidates for both
+    """
+    amounts, dates = extract(text)
+    amount = amounts[0] if amounts else None
+    found_date = dates[0].value if dates else None
+    return {
+        "amount": amount.value if amount else 0,
+        "date": {
+            "day": found_date.day if found_date else 0,
+            "month": found_date.month if found_date else 0,
+            "year": found_date.year if found_date else 0,
+        },
+        "confidence": {
+            "amount": amount.confidence if amount else 0,
+            "date": dates[0].confidence if dates else 0,
+        },
+        "candidates": {
+            "amounts": [{"value": candidate.value, "confidence": candidate.confidence,
+                         "text": candidate.text} for candidate in amounts[:candidates]],
+            "dates": [{"value": candidate.value.isoformat(), "confidence": candidate.confidence,
+                       "text": candidate.text} for candidate in dates[:candidates]],
+        },
+    }
@@ -1,117 +1,279 @@
-from django.http import HttpResponse
+import os
+import tempfile
+from xml.sax.saxutils import escape
 
-from reportlab.lib.pagesizes import letter, A4
+from django.http import FileResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Frame, PageTemplate
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from reportlab.platypus.flowables import PageBreak
+from reportlab.pdfbase.pdfmetrics import stringWidth
 
 from django.db.models import Q
-from io import BytesIO
 from expensense.models import Expense
+from expensense.report_cache import get_report_cache, report_key, report_scope, scope_version
 from django.utils import timezone
 
+# columns of the expense table and their widths in points, which add up to
+# the width of the body of an A4 page
+COLUMNS = (
+    ('S. No', 35),
+    ('Expense Date', 55),
+    ('Expense Name', 105),
+    ('Amount', 50),
+    ('Category', 60),
+    ('Expense By', 66),
+    ('Status', 80),
+)
+HEADER = [name for name, width in COLUMNS]
+COLUMN_WIDTHS = [width for name, width in COLUMNS]
+
+# rows of single line cells have a fixed height so reportlab does not
+# measure every cell, only the rows with a wrapped text are measured
+FONT_NAME = 'Helvetica'
+FONT_SIZE = 8
+HEADER_HEIGHT = 24
+ROW_HEIGHT = 16
+CELL_PADDING = 6
+
+# styles are built once and shared by every report
+STYLES = getSampleStyleSheet()
+FOOTER_STYLE = ParagraphStyle('FooterStyle', textColor=colors.gray, alignment=1)
+FOOTER_TEXT = "Generated by ExpenSense - All rights reserved"
+CELL_STYLE = ParagraphStyle('CellStyle', fontName=FONT_NAME, fontSize=FONT_SIZE,
+                            leading=FONT_SIZE + 2, alignment=1)
+HEADER_BACKGROUND = colors.HexColor('#234E70')
+TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), HEADER_BACKGROUND),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTNAME', (0, 1), (-1, -1), FONT_NAME),
+    ('FONTSIZE', (0, 0), (-1, -1), FONT_SIZE),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+STATUS_LABELS = dict(Expense.status_choice)
+
+# the only fields of the expenses and their relations the report reads
+REPORT_FIELDS = ('expense_date', 'expense_name', 'amount', 'status',
+                 'category__category_name', 'user_id__username')
+
+# rows fetched from the database at a time
+ITERATOR_CHUNK_SIZE = 2000
+
+
+def visible_expenses(user):
+    """
+    Method to get the expenses the user may see, all the company's for an
+    admin, the team's for a manager and their own for an employee
+    """
+    if user.role == 'ADM':
+        scope = Q(user_id__company=user.company)
+    elif user.role == 'MNG':
+        scope = Q(user_id__company=user.company) & Q(user_id__team=user.team)
+    elif user.role == 'EMP':
+        scope = Q(user_id=user)
+    else:
+        return Expense.objects.none()
+    return Expense.objects.filter(scope)
+
+
+def scoped_expenses(user, start_date, end_date):
+    """ Method to get the expenses of a timeframe the user may see, newest first """
+    return visible_expenses(user).filter(expense_date__gte=start_date,
+                                         expense_date__lte=end_date).order_by('-expense_date', '-id')
+
+
+def cell_text(text, width):
+    """
+    Method to get a text as a cell of a column of the given width, a text too
+    wide for one line is wrapped over several lines of the cell
+    """
+    if stringWidth(text, FONT_NAME, FONT_SIZE) <= width - CELL_PADDING:
+        return text
+    return Paragraph(escape(text), CELL_STYLE)
+
+
+def report_rows(expenses):
+    """
+    Method to get the table rows of the expenses, which are read in chunks
+    together with their category and user so every row is one query
+    """
+    expenses = expenses.select_related('category', 'user_id').only(*REPORT_FIELDS)
+    for index, expense in enumerate(expenses.iterator(chunk_size=ITERATOR_CHUNK_SIZE)):
+        category = expense.category.category_name if expense.category else ''
+        yield [str(index + 1), expense.expense_date.strftime("%d/%m/%Y"),
+               cell_text(expense.expense_name, COLUMN_WIDTHS[2]), str(expense.amount),
+               cell_text(category, COLUMN_WIDTHS[4]), cell_text(expense.user_id.username, COLUMN_WIDTHS[5]),
+               STATUS_LABELS.get(expense.status, '')]
+
+
+def report_tables(rows, rows_per_table):
+    """
+    Method to get the rows as tables of at most rows_per_table rows, each
+    with the header, which repeats on every page a table is split over
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == rows_per_table:
+            yield expense_table(chunk)
+            chunk = []
+    if chunk:
+        yield expense_table(chunk)
 
-def generate_pdf(request, start_date, end_date):
-    """ Method to generate pdf """
-    # get the expense for specefic timeframe, company and role
 
-    if request.user.role == 'ADM':
-        expenses = Expense.objects.filter(user_id__company=request.user.company,
-                                            expense_date__gte=start_date,
-                                            expense_date__lte=end_date).order_by('-expense_date')
-    elif request.user.role == 'MNG':
-        query_1 = Q(user_id__company=request.user.company)
-        query_2 = Q(user_id__team=request.user.team)
-        expenses = Expense.objects.filter(Q(query_1 & query_2),
-                                            expense_date__gte=start_date,
-                                            expense_date__lte=end_date).order_by('-expense_date')
-    elif request.user.role == 'EMP':
-        expenses = Expense.objects.filter(user_id=request.user,
-                                            expense_date__gte=start_date,
-                                            expense_date__lte=end_date).order_by('-expense_date')
+def expense_table(rows):
+    """ Method to get a table of expense rows below the header """
+    heights = [None if any(isinstance(cell, Paragraph) for cell in row) else ROW_HEIGHT for row in rows]
+    table = Table([HEADER] + rows, colWidths=COLUMN_WIDTHS, rowHeights=[HEADER_HEIGHT] + heights,
+                  repeatRows=1)
+    table.setStyle(TABLE_STYLE)
+    return table
 
 
-    buffer = BytesIO()
+class FlowableStream:
+    """
+    Class to hand reportlab the flowables of a generator as a list it takes
+    them from the front of, so only the ones being laid out are in memory
+    """
 
-    # Create a pdf document using reportlab
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    def __init__(self, flowables):
+        self._flowables = iter(flowables)
+        self._buffer = []
 
+    def _fill(self, count):
+        """ Method to take flowables from the generator until count of them are buffered """
+        while len(self._buffer) < count:
+            try:
+                self._buffer.append(next(self._flowables))
+            except StopIteration:
+                return
+
+    def __len__(self):
+        self._fill(1)
+        return len(self._buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is None:
+                self._fill(float('inf'))
+            else:
+                self._fill(index.stop)
+            return self._buffer[index]
+        self._fill(index + 1)
+        return self._buffer[index]
+
+    def __setitem__(self, index, value):
+        # reportlab puts the rest of split flowables back in front
+        self._buffer[index] = value
+
+    def __delitem__(self, index):
+        self._fill(index.stop if isinstance(index, slice) else index + 1)
+        del self._buffer[index]
+
+    def insert(self, index, value):
+        self._buffer.insert(index, value)
+
+
+def build_report(output, rows, company_name, generated_by, start_date, end_date):
+    """
+    Method to write the expense report with the given table rows to a file
+    object. The rows are laid out one page sized table at a time as they
+    are read
+    """
+    doc = SimpleDocTemplate(output, pagesize=A4)
 
     def footer(canvas, doc):
         """ Method to create a footer with footer text and page number"""
         page_number = canvas.getPageNumber()
-        footer_style = ParagraphStyle('FooterStyle')
-        footer_style.textColor = colors.gray
-        footer_style.alignment = 1
-        footer_text = "Generated by ExpenSense - All rights reserved"
-        p = Paragraph(footer_text, footer_style)
-        w, h = p.wrap(doc.width, doc.bottomMargin)
+        p = Paragraph(FOOTER_TEXT, FOOTER_STYLE)
+        p.wrap(doc.width, doc.bottomMargin)
         p.drawOn(canvas, doc.leftMargin, 0.75 * inch)
         canvas.drawString(7 * inch, 0.75 * inch, f"Page {page_number}")
-    
+
     # Create a Frame for the body content and set the footer function for the PageTemplate
     body_frame = Frame(doc.leftMargin, doc.topMargin, doc.width, doc.height, id='body')
     body_template = PageTemplate(id='body_template', frames=[body_frame], onPage=footer)
     doc.addPageTemplates([body_template])
 
-    # Create a Frame for the footer
-    footer_frame = Frame(doc.leftMargin, doc.bottomMargin - 1.5 * inch, doc.width, inch, id='footer')
-    footer_template = PageTemplate(id='footer_template', frames=[footer_frame], onPage=footer)
-    doc.addPageTemplates([footer_template])
-
-    # Create a table to display expenses
-    data = [['S. No','Expense Date', 'Expense Name',
-                'Amount','Category', 'Expense By', 'Status']]
-    
-
-    # loop through the expense queryset and append it in the data list
-    for index, expense in enumerate(expenses):
-        data.append([str(index+1), expense.expense_date.strftime("%d/%m/%Y"), expense.expense_name, str(
-            expense.amount), expense.category, expense.user_id.username, expense.get_status_display()])
-
-    # set the table styles
-    custom_background_color = colors.HexColor('#234E70')
-    table = Table(data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), custom_background_color),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-
-
-    elements = []
-    styles = getSampleStyleSheet()
-
-    # Title
-    elements.append(Paragraph("Expense Report", styles['Title']))
-    elements.append(Spacer(1, 20))
-
-    # detail paragraph
-    company = request.user.company
-    elements.append(Paragraph(f'<b>Company Name:</b> {company.company}'))
-    elements.append(Paragraph(f'<b>Start Date:</b> {start_date.strftime("%d/%m/%Y")}'))
-    elements.append(Paragraph(f'<b>End Date:</b> {end_date.strftime("%d/%m/%Y")}'))
-    elements.append(Paragraph(f'<b>Date Generated:</b> {timezone.now().strftime("%d/%m/%Y")}'))
-    elements.append(Paragraph(f'<b>Generated By:</b> {request.user.first_name} {request.user.last_name}'))
-    elements.append(Spacer(1, 20))
-
-    # table
-    elements.append(table)
-    elements.append(Spacer(1, 20))
+    # as many single line rows as fit in the frame, which is padded by 6
+    # points at the top and bottom, make up a table, a table with wrapped
+    # texts is split over the pages by reportlab
+    rows_per_table = int((doc.height - 12 - HEADER_HEIGHT) // ROW_HEIGHT)
+
+    def flowables():
+        """ Method to get the title, details and tables of the report in order """
+        # Title
+        yield Paragraph("Expense Report", STYLES['Title'])
+        yield Spacer(1, 20)
+
+        # detail paragraph
+        yield Paragraph(f'<b>Company Name:</b> {company_name}')
+        yield Paragraph(f'<b>Start Date:</b> {start_date.strftime("%d/%m/%Y")}')
+        yield Paragraph(f'<b>End Date:</b> {end_date.strftime("%d/%m/%Y")}')
+        yield Paragraph(f'<b>Date Generated:</b> {timezone.now().strftime("%d/%m/%Y")}')
+        yield Paragraph(f'<b>Generated By:</b> {generated_by}')
+        yield Spacer(1, 20)
+
+        # tables
+        yield from report_tables(rows, rows_per_table)
+        yield Spacer(1, 20)
 
     # build the docuement
-    doc.build(elements)
+    doc.build(FlowableStream(flowables()))
 
-    buffer.seek(0)
 
-    # Create a response object
-    response = HttpResponse(buffer, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="expense_report_{start_date}_{end_date}.pdf'
+def generate_pdf(request, start_date, end_date):
+    """
+    Method to generate pdf. Reports are cached until the expenses they show
+    change, a client which has the current one is told so with a 304
+    """
+    user = request.user
+    company_name = user.company.company
+    generated_by = f'{user.first_name} {user.last_name}'
+    scope = report_scope(user)
+    key = report_key(scope, scope_version(scope), start_date, end_date, company_name, generated_by)
+    etag = f'W/"{key}"'
 
-    return response
\ No newline at end of file
+    # a cached report was last modified when it was generated
+    cache = get_report_cache()
+    path = cache.get(key)
+    try:
+        last_modified = int(os.path.getmtime(path)) if path else None
+    except FileNotFoundError:
+        path = last_modified = None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+        return response
+
+    def write_report(output):
+        """ Method to write the report of the expense for specefic timeframe, company and role """
+        expenses = scoped_expenses(user, start_date, end_date)
+        build_report(output, report_rows(expenses), company_name, generated_by, start_date, end_date)
+
+    path = path or cache.put(key, write_report)
+    try:
+        report = open(path, 'rb')
+    except FileNotFoundError:
+        # another process removed the report to make room, build it again
+        report = tempfile.TemporaryFile()
+        write_report(report)
+        report.seek(0)
+
+    # Create a response object
+    response = FileResponse(report, as_attachment=True, content_type='application/pdf',
+                            filename=f'expense_report_{start_date}_{end_date}.pdf')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(os.fstat(report.fileno()).st_mtime)
+    # the browser keeps the report but asks whether it is still current
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,143 @@
+"""
+On-disk cache of the generated expense reports. A report is kept by the
+company, team or user whose expenses it shows, its timeframe and the version
+of those expenses, which every change of them bumps, so a cached report is
+never stale. The reports used least recently are removed once the cache
+grows past its size limit.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from expensense.models import ReportVersion
+
+# fields of an expense the reports show, saving any other does not change them
+REPORTED_FIELDS = {'expense_date', 'expense_name', 'amount', 'status', 'category', 'user_id'}
+
+# fields of a user which change the reports their expenses are shown in
+REPORTED_USER_FIELDS = {'username', 'team', 'company'}
+
+
+def report_scope(user):
+    """ Method to get the scope of the expenses in the reports of a user """
+    if user.role == 'ADM':
+        return f'company-{user.company_id}'
+    if user.role == 'MNG':
+        return f'team-{user.team_id}'
+    return f'user-{user.id}'
+
+
+def expense_scopes(user):
+    """ Method to get the scopes the expenses of a user are reported in """
+    scopes = [f'user-{user.id}']
+    if user.company_id:
+        scopes.append(f'company-{user.company_id}')
+    if user.team_id:
+        scopes.append(f'team-{user.team_id}')
+    return scopes
+
+
+def scope_version(scope):
+    """ Method to get the version of the expenses of a scope """
+    version = ReportVersion.objects.filter(scope=scope).values_list('version', flat=True).first()
+    return version or 0
+
+
+def bump_scopes(scopes):
+    """ Method to bump the versions of the scopes """
+    for scope in scopes:
+        if not ReportVersion.objects.filter(scope=scope).update(version=F('version') + 1):
+            ReportVersion.objects.get_or_create(scope=scope, defaults={'version': 1})
+
+
+def bump_versions(*users):
+    """ Method to bump the versions of every scope the expenses of the users are reported in """
+    bump_scopes({scope for user in users for scope in expense_scopes(user)})
+
+
+def report_key(scope, version, start_date, end_date, *details):
+    """ Method to get the key of a report, the details are whatever else it shows """
+    parts = [scope, str(version), start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')]
+    return hashlib.sha256('|'.join(parts + list(details)).encode()).hexdigest()[:40]
+
+
+class ReportCache:
+    """
+    Class to keep reports as files in a directory of at most max_bytes. The
+    access time of a file is when it was last served, which decides the
+    reports removed first, its modification time is when it was generated
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        """ Method to get the path of the file of a report """
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def get(self, key):
+        """ Method to get the path of a cached report and mark it used, None when it is not cached """
+        path = self.path(key)
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        """
+        Method to cache the report written to a file object by write and
+        return its path. The file appears once it is complete
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            try:
+                write(f)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        path = self.path(key)
+        os.replace(f.name, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """ Method to remove the least recently used reports until the cache fits its size """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pdf') and entry.path != keep:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for atime, size, path in entries)
+        if keep and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        for atime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def size(self):
+        """ Method to get the bytes of the cached reports """
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith('.pdf'))
+
+
+def get_report_cache():
+    """ Method to get the report cache configured in the settings """
+    return ReportCache(settings.REPORT_CACHE_DIR, settings.REPORT_CACHE_MAX_BYTES)
@@ -0,0 +1,141 @@
+"""
+Background generation of the expense reports asked for with the form. The
+request only queues the job and shows its status page, so a report of years
+of expenses does not hold a web worker past the proxy timeouts. The report
+is downloaded from the job until it expires.
+"""
+
+import logging
+import secrets
+import tempfile
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from expensense.job_pool import JobPool
+from expensense.models import ReportJob, User
+from expensense.report import build_report, report_rows, scoped_expenses
+
+logger = logging.getLogger(__name__)
+
+
+class ReportLimitExceeded(Exception):
+    """ Exception raised when a user already has as many reports being generated as allowed """
+
+
+def run_job(job_id):
+    """ Method to generate the report of a job and store it on the job """
+    try:
+        job = ReportJob.objects.select_related('user__company').get(id=job_id)
+    except ReportJob.DoesNotExist:
+        # the job expired before it ran
+        return
+    # a job only moves on from the state it is expected in, one failed as
+    # stale in the meantime stays failed
+    if not ReportJob.objects.filter(id=job_id, status=ReportJob.pending).update(
+            status=ReportJob.running, started_at=timezone.now()):
+        return
+
+    user = job.user
+    try:
+        with tempfile.TemporaryFile() as output:
+            expenses = scoped_expenses(user, job.start_date, job.end_date)
+            build_report(output, report_rows(expenses), user.company.company,
+                         f'{user.first_name} {user.last_name}', job.start_date, job.end_date)
+            output.seek(0)
+            job.report.save(f'expense_report_{job.start_date}_{job.end_date}.pdf', File(output),
+                            save=False)
+        status, error = ReportJob.done, None
+    except Exception:
+        logger.exception('Report job %s failed', job_id)
+        status, error = ReportJob.failed, 'The report could not be generated'
+
+    updated = ReportJob.objects.filter(id=job_id, status=ReportJob.running).update(
+        status=status, error=error, report=job.report.name or None, finished_at=timezone.now())
+    if not updated and job.report:
+        # the job expired or was failed as stale while the report was being generated
+        job.report.delete(save=False)
+
+
+class ReportJobPool(JobPool):
+    """ Class to manage the threads generating the reports """
+    job = staticmethod(run_job)
+    thread_name_prefix = 'report-job'
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ Method to get the pool configured in the settings """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ReportJobPool(settings.REPORT_JOB_WORKERS, settings.REPORT_JOB_QUEUE_DEPTH)
+        return _pool
+
+
+def fail_stale_jobs():
+    """
+    Method to fail the jobs queued or running for longer than the timeout,
+    whose process died or restarted, so they do not count against the
+    reports a user may generate at once. Returns how many
+    """
+    cutoff = timezone.now() - timedelta(minutes=settings.REPORT_JOB_TIMEOUT_MINUTES)
+    return ReportJob.objects.filter(
+        Q(status=ReportJob.pending, created_at__lt=cutoff) |
+        Q(status=ReportJob.running, started_at__lt=cutoff)
+    ).update(status=ReportJob.failed, finished_at=timezone.now(),
+             error='The report generation was interrupted, try again')
+
+
+def expire_jobs(hours=None):
+    """ Method to delete the jobs older than the expiry with their reports, returns how many """
+    fail_stale_jobs()
+    if hours is None:
+        hours = settings.REPORT_JOB_EXPIRY_HOURS
+    cutoff = timezone.now() - timedelta(hours=hours)
+    deleted = 0
+    for job in ReportJob.objects.filter(created_at__lt=cutoff).iterator():
+        if job.report:
+            job.report.delete(save=False)
+        job.delete()
+        deleted += 1
+    return deleted
+
+
+def submit_job(user, start_date, end_date):
+    """
+    Method to queue the report of the expenses of a timeframe a user may
+    see. It runs within the request when the pool is disabled and fails
+    right away when the queue is full. Raises ReportLimitExceeded when the
+    user already has REPORT_JOBS_PER_USER reports being generated
+    """
+    expire_jobs()
+    with transaction.atomic():
+        # the user's row is locked so concurrent requests of the user count
+        # the jobs one after the other
+        User.objects.select_for_update().filter(id=user.id).exists()
+        active = user.report_jobs.filter(status__in=[ReportJob.pending, ReportJob.running]).count()
+        if active >= settings.REPORT_JOBS_PER_USER:
+            raise ReportLimitExceeded(f'You already have {active} reports being generated, '
+                                      f'wait for one of them to finish')
+
+        job = ReportJob.objects.create(token=secrets.token_urlsafe(32), user=user,
+                                       start_date=start_date, end_date=end_date)
+    pool = get_pool()
+    if pool.submit(job.id) is None:
+        if not pool.size:
+            run_job(job.id)
+        else:
+            ReportJob.objects.filter(id=job.id).update(
+                status=ReportJob.failed, finished_at=timezone.now(),
+                error='Too many reports are being generated, try again later')
+        job.refresh_from_db()
+    return job
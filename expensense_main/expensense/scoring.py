@@ -0,0 +1,158 @@
+"""
+Background calculation of the signature similarity of logged expenses. The
+image processing runs in a pool of worker processes so the request logging
+the expense does not have to wait for it.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import connection
+
+from expensense.models import Expense
+from expensense.signature_matching import cascade_similarity, warm_up
+
+logger = logging.getLogger(__name__)
+
+
+class SignatureScoringPool:
+    """ Class to manage the worker processes calculating signature similarity """
+
+    def __init__(self, size, queue_depth):
+        self.size = size
+        self.queue_depth = queue_depth
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(queue_depth, 1))
+
+    def _get_executor(self):
+        """ Method to start the worker processes on first use """
+        with self._lock:
+            if self._executor is None:
+                # spawn the workers so they do not inherit the server's
+                # threads and database connections, warm_up imports
+                # cv2/skimage before the first receipt is queued
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_up)
+            return self._executor
+
+    def start(self):
+        """
+        Method to start the worker processes up front, so the first expenses
+        logged do not wait for them to be spawned and warmed up
+        """
+        if not self.size:
+            return
+        executor = self._get_executor()
+        # workers are spawned as tasks arrive, a task per worker starts them all
+        for _ in range(self.size):
+            executor.submit(os.getpid)
+
+    def submit(self, receipt, signature, **options):
+        """
+        Method to queue a similarity calculation, returns a future of the
+        score and deciding stage or None when the pool is disabled or its queue
+        is full. The options are passed on to cascade_similarity
+        """
+        if not self.size or not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._get_executor().submit(cascade_similarity, receipt, signature, **options)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """ Method to stop the worker processes after the queued work is done """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ Method to get the pool configured in the settings """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SignatureScoringPool(settings.SIGNATURE_POOL_SIZE,
+                                         settings.SIGNATURE_POOL_QUEUE_DEPTH)
+            # let the queued expenses finish when the server stops
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def similarity_options():
+    """ Method to get the cascade_similarity options configured in the settings """
+    return {
+        'threshold': settings.SIGNATURE_APPROVAL_THRESHOLD,
+        'band': settings.SIGNATURE_CASCADE_BAND,
+        'prescreen_size': settings.SIGNATURE_PRESCREEN_SIZE,
+        'max_size': settings.SIGNATURE_MAX_WORKING_SIZE,
+    }
+
+
+def store_similarity(expense_id, similarity, stage=None):
+    """
+    Method to save the calculated similarity of an expense and the stage
+    which decided it, saving it runs the auto approval of the expense with
+    the new score
+    """
+    try:
+        expense = Expense.objects.get(id=expense_id)
+    except Expense.DoesNotExist:
+        # the expense was deleted while it was being scored
+        return
+    expense.similarity = similarity
+    expense.similarity_stage = stage
+    expense.similarity_pending = False
+    expense.save(update_fields=['similarity', 'similarity_stage', 'similarity_pending'])
+
+
+def _store_result(expense_id, future):
+    """ Method to save the result of a finished background calculation """
+    try:
+        similarity, stage = future.result()
+    except Exception:
+        logger.exception('Signature similarity failed for expense %s', expense_id)
+        similarity, stage = None, None
+    try:
+        store_similarity(expense_id, similarity, stage)
+    finally:
+        # the callback runs on the pool's thread, do not keep its connection
+        connection.close()
+
+
+def score_expense(expense, signature_path):
+    """
+    Method to calculate the similarity between the stored receipt of a saved
+    expense and the signature of the employee. The expense is expected to be
+    saved as similarity_pending
+    """
+    options = similarity_options()
+    future = get_pool().submit(expense.receipt.path, signature_path, **options)
+    if future is None:
+        # the pool is disabled or busy, score it within the request instead
+        try:
+            similarity, stage = cascade_similarity(expense.receipt.path, signature_path, **options)
+        except Exception:
+            logger.exception('Signature similarity failed for expense %s', expense.id)
+            similarity, stage = None, None
+        store_similarity(expense.id, similarity, stage)
+    else:
+        future.add_done_callback(partial(_store_result, expense.id))
+    return future
@@ -1,13 +1,23 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_save
-from expensense.models import Expense, ApprovalConditions
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from expensense.duplicates import hashes_changed
+from expensense.models import Category, Company, Expense, ApprovalConditions, Team, User
+from expensense.report_cache import REPORTED_FIELDS, REPORTED_USER_FIELDS, bump_versions
+from expensense.signature_matching import enroll_signature, template_is_current
 from django.utils import timezone
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(post_save, sender=Expense)
 def auto_approve_expense(sender, instance, **kwargs):
     """ Method to auto approve expense requests """
     # print('Auto Approved called')
+    if instance.similarity is None:
+        # nothing to decide on until the signature similarity is known
+        return
     try:
         #query to get the manager and admin condition for the employee's team and company
         manager_condition = ApprovalConditions.objects.get(user__role = 'MNG',
@@ -18,9 +28,11 @@ def auto_approve_expense(sender, instance, **kwargs):
                                                          team = instance.user_id.team,
                                                          company = instance.user_id.company)
         # approve the request if the expense amount is lesser than in approval
-        #  condition and is pending and the signature similarity is more than 80%
+        #  condition and is pending and the signature similarity is more than
+        #  the threshold (80%)
+        threshold = settings.SIGNATURE_APPROVAL_THRESHOLD
         if (manager_condition and (float(instance.amount) <= manager_condition.max_amount)
-             and (int(instance.status)==Expense.pending) and (float(instance.similarity)>80)):
+             and (int(instance.status)==Expense.pending) and (float(instance.similarity)>threshold)):
             # Auto approve for manager
             instance.manager_approved_at = timezone.now()
             instance.manager_auto_approved = True
@@ -28,10 +40,11 @@ def auto_approve_expense(sender, instance, **kwargs):
             instance.save()
             manager_condition = None
         # approve the request if the expense amount is lesser than in approval
-        #  condition and is manager approved and the signature similarity is more than 80%
+        #  condition and is manager approved and the signature similarity is more than
+        #  the threshold (80%)
         elif (admin_condition and (int(instance.status) == Expense.manager_approved)
                and (float(instance.amount) <= admin_condition.max_amount) and 
-               float(instance.similarity)>80):
+               float(instance.similarity)>threshold):
             # Auto approve for admin
             instance.admin_approved_at = timezone.now()
             instance.admin_auto_approved = True
@@ -41,3 +54,122 @@ def auto_approve_expense(sender, instance, **kwargs):
         
     except ApprovalConditions.DoesNotExist:
         pass
+
+
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Expense)
+def bump_report_versions(sender, instance, update_fields=None, **kwargs):
+    """ Method to invalidate the cached reports showing a changed expense """
+    if update_fields is not None and not REPORTED_FIELDS.intersection(update_fields):
+        # e.g. the similarity saved by the scoring pool
+        return
+    bump_versions(instance.user_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def bump_category_report_versions(sender, instance, created=False, **kwargs):
+    """ Method to invalidate the cached reports showing the name of a renamed or deleted category """
+    if created:
+        return
+    bump_versions(*User.objects.filter(expenses__category=instance).distinct()
+                  .only('id', 'company_id', 'team_id'))
+
+
+@receiver(pre_save, sender=User)
+def remember_reported_user(sender, instance, update_fields=None, **kwargs):
+    """ Method to keep the user as it was saved before, to tell which reports it changes """
+    instance._reported_user = None
+    if instance.pk and (update_fields is None or REPORTED_USER_FIELDS.intersection(update_fields)):
+        instance._reported_user = (User.objects.filter(pk=instance.pk)
+                                   .only('id', 'username', 'company_id', 'team_id').first())
+
+
+@receiver(post_save, sender=User)
+def bump_user_report_versions(sender, instance, **kwargs):
+    """
+    Method to invalidate the cached reports showing the expenses of a user
+    who was renamed or moved to another team or company, before and after,
+    and have the expenses exported again
+    """
+    before = getattr(instance, '_reported_user', None)
+    if before is None:
+        return
+    if (before.username, before.company_id, before.team_id) == \
+            (instance.username, instance.company_id, instance.team_id):
+        return
+    if instance.expenses.exists():
+        bump_versions(before, instance)
+        touch_expenses(instance.expenses.all())
+
+
+# fields of the related models the parquet export writes with the expenses,
+# and the lookup from an expense to the model
+EXPORTED_FIELDS = {
+    Category: (('category_name',), 'category'),
+    Team: (('team_name', 'company_id'), 'user_id__team'),
+    Company: (('company',), 'user_id__company'),
+}
+
+
+def touch_expenses(expenses):
+    """
+    Method to mark the expenses as saved now, so the next incremental export
+    writes them again with the names they are exported with
+    """
+    expenses.update(updated_at=timezone.now())
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Team)
+@receiver(pre_save, sender=Company)
+def remember_exported_fields(sender, instance, **kwargs):
+    """ Method to keep the exported fields as they were saved before, to tell if they change """
+    fields, lookup = EXPORTED_FIELDS[sender]
+    instance._exported_fields = None
+    if instance.pk:
+        instance._exported_fields = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Team)
+@receiver(post_save, sender=Company)
+def touch_renamed_expenses(sender, instance, created, **kwargs):
+    """ Method to have the expenses of a renamed category, team or company exported again """
+    fields, lookup = EXPORTED_FIELDS[sender]
+    before = getattr(instance, '_exported_fields', None)
+    if created or before is None or before == tuple(getattr(instance, field) for field in fields):
+        return
+    touch_expenses(Expense.objects.filter(**{lookup: instance}))
+
+
+@receiver(pre_delete, sender=Category)
+def touch_uncategorized_expenses(sender, instance, **kwargs):
+    """ Method to have the expenses of a deleted category exported again without it """
+    touch_expenses(Expense.objects.filter(category=instance))
+
+
+@receiver(post_delete, sender=Expense)
+def reload_receipt_hashes(sender, instance, **kwargs):
+    """ Method to have every process reload the receipt hashes so deleted expenses are not matched """
+    if instance.receipt_hash:
+        hashes_changed(instance.user_id.company_id)
+
+
+@receiver(post_save, sender=User)
+def enroll_user_signature(sender, instance, update_fields=None, **kwargs):
+    """ Method to store the signature template when the signature changes """
+    if update_fields is not None and 'signature' not in update_fields:
+        # e.g. the last_login update on every login
+        return
+    if not instance.signature:
+        return
+
+    signature_path = instance.signature.path
+    if template_is_current(signature_path):
+        return
+    try:
+        enroll_signature(signature_path)
+    except (OSError, ValueError):
+        # the matcher decodes the signature itself when there is no template
+        logger.exception('Could not store the signature template of %s', instance.username)
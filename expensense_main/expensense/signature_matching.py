@@ -7,37 +7,119 @@ https://github.com/omrawal/Signature-Matching/blob/main/signature.py
 
 import cv2
 import numpy as np
+from io import BytesIO
+from PIL import Image
+from scipy import ndimage
 from skimage import measure, morphology
 from skimage.measure import regionprops
 from skimage.metrics import structural_similarity as ssim
 import os
 
-def calculate_similarity(receipt_path, signature_path):
-    """ 
-    Method to calculate the signature similarity between receipt submitted and
-    signature stored of the employee
+# size both images are brought to before running the similarity algorithm
+COMPARISON_SIZE = (300, 300)
+
+# parameters of the structural similarity, the same defaults skimage uses
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# number of receipts compared at once by the batch scoring
+SSIM_CHUNK_SIZE = 64
+
+# suffix of the normalized signature template stored next to the signature
+TEMPLATE_SUFFIX = '.template.npy'
+
+# stages of the cascade matcher which can decide a score
+PRESCREEN_STAGE = 'prescreen'
+FULL_STAGE = 'full'
+
+# decoders which scale the image down while reading it, by reduction factor
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
+
+def read_image(source, flags=cv2.IMREAD_GRAYSCALE):
     """
+    Method to read an image from a file path, raw encoded bytes or an already
+    decoded numpy array. Decoded colour arrays are expected in BGR order, the
+    same as cv2 returns them.
+    """
+    if isinstance(source, np.ndarray):
+        img = source
+        if flags == cv2.IMREAD_GRAYSCALE and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        elif flags == cv2.IMREAD_COLOR and img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    else:
+        img = cv2.imread(os.fspath(source), flags)
 
-    # Read the input receipt image
-    receipt_img = cv2.imread(receipt_path, 0)
-    receipt_img = cv2.threshold(receipt_img, 127, 255, cv2.THRESH_BINARY)[1]  # Ensure binary
-    
-    # Connected component analysis by scikit-learn framework
-    blobs = receipt_img > receipt_img.mean()
-    blobs_labels = measure.label(blobs, background=1)
-    
-    the_biggest_component = 0
-    total_area = 0
-    counter = 0
-    for region in regionprops(blobs_labels):
-        if region.area > 10:
-            total_area += region.area
-            counter += 1
-        if region.area >= 250:
-            if region.area > the_biggest_component:
-                the_biggest_component = region.area
-    
-    # the parameters are used to remove small size connected pixels outliar 
+    if img is None:
+        raise ValueError('Unable to decode image')
+    return img
+
+
+def image_size(source):
+    """ Method to get the width and height of an encoded image from its header """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    try:
+        with Image.open(source) as img:
+            return img.size
+    except (OSError, ValueError):
+        return None
+
+
+def read_receipt(source, max_size=None):
+    """
+    Method to read a receipt in grayscale with its longer side no bigger than
+    max_size pixels. Encoded images are decoded at a reduced resolution where
+    possible and the rest is scaled down by area. Returns the image and the
+    ratio of its area to the original one, None reads it at full resolution
+    """
+    if not max_size:
+        return read_image(source, cv2.IMREAD_GRAYSCALE), 1.0
+
+    if isinstance(source, np.ndarray):
+        img = read_image(source, cv2.IMREAD_GRAYSCALE)
+        original_area = img.shape[0] * img.shape[1]
+    else:
+        size = image_size(source)
+        flags = cv2.IMREAD_GRAYSCALE
+        if size:
+            # the largest reduction which keeps the image above max_size
+            for factor, reduced_flags in REDUCED_GRAYSCALE_FLAGS.items():
+                if max(size) // factor >= max_size:
+                    flags = reduced_flags
+                    break
+        img = read_image(source, flags)
+        if size is None:
+            size = img.shape[::-1]
+        original_area = size[0] * size[1]
+
+    height, width = img.shape[:2]
+    ratio = max_size / max(height, width)
+    if ratio < 1:
+        img = cv2.resize(img, (max(round(width * ratio), 1), max(round(height * ratio), 1)),
+                         interpolation=cv2.INTER_AREA)
+
+    return img, (img.shape[0] * img.shape[1]) / original_area
+
+
+def outlier_thresholds(areas, area_scale=1.0):
+    """
+    Method to calculate the small and big outlier thresholds from the areas
+    of the connected components found on a receipt. The area_scale is the
+    ratio of the receipt's area to the one it was captured at, the fixed
+    pixel counts of the thresholds are scaled by it
+    """
+    areas = np.asarray(areas)
+
+    # the parameters are used to remove small size connected pixels outliar
     constant_parameter_1 = 8
     constant_parameter_2 = 25
     constant_parameter_3 = 10
@@ -47,55 +129,301 @@ def calculate_similarity(receipt_path, signature_path):
 
     # experimental-based ratio calculation
     # a4_small_size_outliar_constant is used as a threshold value to remove connected outliar connected pixels
+    counted = areas[areas > 10 * area_scale]
+    average = int(counted.sum()) / len(counted)
+    a4_small_size_outliar_constant = ((average / constant_parameter_1) * constant_parameter_2) + constant_parameter_3 * area_scale
 
-    average = total_area / counter
-    a4_small_size_outliar_constant = ((average / constant_parameter_1) * constant_parameter_2) + constant_parameter_3
-    
     # experimental-based ratio calculation, modify it for your cases
     # a4_big_size_outliar_constant is used as a threshold value to remove outliar connected pixels
     a4_big_size_outliar_constant = a4_small_size_outliar_constant * constant_parameter_4
-    
+
+    return a4_small_size_outliar_constant, a4_big_size_outliar_constant
+
+
+def binarize_receipt(receipt_img):
+    """ Method to get the mask of the blobs on a grayscale receipt """
+    receipt_img = cv2.threshold(receipt_img, 127, 255, cv2.THRESH_BINARY)[1]  # Ensure binary
+    return receipt_img > receipt_img.mean()
+
+
+def finish_signature(pre_version):
+    """
+    Method to turn the filtered component labels into the final binary
+    signature image. The labels used to be written to a png, which saturates
+    them to 8 bits, keep doing the same so the otsu threshold sees the same
+    pixel values
+    """
+    if pre_version.dtype != np.uint8:
+        pre_version = np.clip(pre_version, 0, 255).astype(np.uint8)
+    return cv2.threshold(pre_version, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+
+
+def extract_signature_skimage(receipt_img, area_scale=1.0):
+    """
+    Reference implementation of the receipt clean up using scikit-image, kept
+    to check the results of the faster engines against
+    """
+    # Connected component analysis by scikit-learn framework
+    blobs = binarize_receipt(receipt_img)
+    blobs_labels = measure.label(blobs, background=1)
+
+    areas = [region.area for region in regionprops(blobs_labels)]
+    a4_small_size_outliar_constant, a4_big_size_outliar_constant = outlier_thresholds(areas, area_scale)
+
     # remove the connected pixels are smaller than a4_small_size_outliar_constant
     pre_version = morphology.remove_small_objects(blobs_labels, a4_small_size_outliar_constant)
     component_sizes = np.bincount(pre_version.ravel())
     too_small = component_sizes > a4_big_size_outliar_constant
     too_small_mask = too_small[pre_version]
     pre_version[too_small_mask] = 0
-    cv2.imwrite('pre_version.png', pre_version)
-    
-    # Read the pre-version
-    pre_version_img = cv2.imread('pre_version.png', 0)
-    pre_version_img = cv2.threshold(pre_version_img, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-    cv2.imwrite("output.png", pre_version_img)
-    
-    # Read the signature image
-    signature_img = cv2.imread(signature_path)
+
+    return finish_signature(pre_version)
+
+
+def raster_order(labels, count):
+    """
+    Method to get the rank of every label in the order its first pixel is met
+    when scanning the image row by row, which is how scikit-image numbers them
+    """
+    flat = labels.ravel()
+    # the first pixel of a component is always the start of a run of labels
+    run_starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    run_starts = np.concatenate(([0], run_starts))
+    run_labels, first_run = np.unique(flat[run_starts], return_index=True)
+
+    ordered = run_labels[np.argsort(run_starts[first_run], kind='stable')]
+    ordered = ordered[ordered != 0]
+    rank = np.zeros(count, dtype=np.int64)
+    rank[ordered] = np.arange(1, len(ordered) + 1)
+    return rank
+
+
+def extract_signature_opencv(receipt_img, area_scale=1.0):
+    """
+    Method to clean up the receipt with a single connected component pass,
+    the labels and areas come from cv2 and both outlier filters are applied
+    through one lookup table
+    """
+    blobs = binarize_receipt(receipt_img)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(
+        np.logical_not(blobs).view(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+
+    areas = stats[:, cv2.CC_STAT_AREA]
+    a4_small_size_outliar_constant, a4_big_size_outliar_constant = outlier_thresholds(areas[1:], area_scale)
+
+    # keep the components which are neither too small nor too big
+    keep = (areas >= a4_small_size_outliar_constant) & (areas <= a4_big_size_outliar_constant)
+    keep[0] = False
+
+    # number the kept components the same way scikit-image does so that the
+    # saturated label image is the same for both engines
+    lookup = np.where(keep, np.minimum(raster_order(labels, count), 255), 0).astype(np.uint8)
+
+    return finish_signature(lookup[labels])
+
+
+# engines available to clean up the receipt, skimage is the reference
+ENGINES = {
+    'opencv': extract_signature_opencv,
+    'skimage': extract_signature_skimage,
+}
+DEFAULT_ENGINE = 'opencv'
+
+
+def extract_signature(receipt_img, engine=DEFAULT_ENGINE, area_scale=1.0):
+    """
+    Method to remove the printed text and noise from a grayscale receipt and
+    return a binary image which only has the signature strokes left, see
+    outlier_thresholds for the area_scale
+    """
+    try:
+        extract = ENGINES[engine]
+    except KeyError:
+        raise ValueError(f'Unknown signature engine: {engine}')
+    return extract(receipt_img, area_scale)
+
+
+def normalize_image(img):
+    """ Method to bring a grayscale image to the size used for comparison """
+    return cv2.resize(img, COMPARISON_SIZE)
+
+
+def decode_signature(signature):
+    """ Method to decode the signature of the employee ready for comparison """
+    signature_img = read_image(signature, cv2.IMREAD_COLOR)
     signature_img = cv2.cvtColor(signature_img, cv2.COLOR_BGR2GRAY)
-    signature_img = cv2.resize(signature_img, (300, 300))
-    
-    # Read the pre-processed receipt image
-    processed_receipt_img = cv2.imread('output.png')
-    # processed_receipt_img = cv2.imread(receipt_path)
-    processed_receipt_img = cv2.cvtColor(processed_receipt_img, cv2.COLOR_BGR2GRAY)
-    processed_receipt_img = cv2.resize(processed_receipt_img, (300, 300))
-    
-    # show images for debugging
-    # cv2.imshow('Signature Image', signature_img)
-    # cv2.imshow('Receipt Image', receipt_img)
-    # cv2.imshow('Processed Receipt Image', processed_receipt_img)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
+    return normalize_image(signature_img)
+
+
+def template_path(signature_path):
+    """ Method to get the path of the template stored for a signature """
+    return os.path.splitext(os.fspath(signature_path))[0] + TEMPLATE_SUFFIX
+
+
+def enroll_signature(signature_path):
+    """
+    Method to store the normalized signature next to the signature image so
+    it does not have to be decoded for every receipt. The template is written
+    to a temporary file first so readers never see a partial one
+    """
+    path = template_path(signature_path)
+    template = decode_signature(signature_path)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, template)
+    os.replace(temp_path, path)
+    return path
+
+
+def template_is_current(signature_path):
+    """ Method to check if a signature has a template which is not older than it """
+    try:
+        return (os.stat(template_path(signature_path)).st_mtime_ns >=
+                os.stat(signature_path).st_mtime_ns)
+    except OSError:
+        return False
+
+
+def load_template(signature_path):
+    """
+    Method to open the stored template of a signature as a read only memory
+    map, shared through the page cache by every worker. Returns None if there
+    is no template or it is older than the signature
+    """
+    if not template_is_current(signature_path):
+        return None
+    try:
+        return np.load(template_path(signature_path), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+
+def prepare_signature(signature):
+    """
+    Method to get the signature of the employee ready for comparison, the
+    enrolled template is used when the signature is given as a path
+    """
+    if isinstance(signature, (str, os.PathLike)):
+        template = load_template(signature)
+        if template is not None:
+            return template
+    return decode_signature(signature)
+
+
+def prepare_receipt(receipt, engine=DEFAULT_ENGINE, max_size=None):
+    """
+    Method to read a receipt and keep only its signature ready for comparison,
+    see read_receipt for the max_size
+    """
+    receipt_img, area_scale = read_receipt(receipt, max_size)
+    return normalize_image(extract_signature(receipt_img, engine, area_scale))
+
+
+def calculate_similarity(receipt_path, signature_path, engine=DEFAULT_ENGINE, max_size=None):
+    """
+    Method to calculate the signature similarity between receipt submitted and
+    signature stored of the employee. Both the receipt and the signature can be
+    given as a file path, encoded image bytes or a decoded numpy array, every
+    intermediate stage is kept in memory so concurrent calls are independent.
+    The engine selects the receipt clean up implementation from ENGINES and
+    max_size limits the resolution the receipt is processed at
+    """
+
+    # Remove everything but the signature from the receipt
+    processed_receipt_img = prepare_receipt(receipt_path, engine, max_size)
+
+    # Read the signature image
+    signature_img = prepare_signature(signature_path)
 
     # Run structural similarity algorithm to find to similarity value
     similarity_value = ssim(signature_img, processed_receipt_img) * 100
-    # Clean up by deleting the temporary files
-    if os.path.exists('pre_version.png'):
-        os.remove('pre_version.png')
-    if os.path.exists('output.png'):
-        os.remove('output.png')
 
     return similarity_value
 
+
+def cascade_similarity(receipt, signature, threshold=80, band=None, prescreen_size=512,
+                       engine=DEFAULT_ENGINE, max_size=None):
+    """
+    Method to calculate the similarity in two stages. The receipt is first
+    scored at prescreen_size, and only if that score is within band of the
+    approval threshold it is scored again at max_size. Returns the score and
+    the stage which decided it, a band of None always runs the full stage
+    """
+    signature_img = prepare_signature(signature)
+
+    if band is not None:
+        receipt_img, area_scale = read_receipt(receipt, prescreen_size)
+        processed_receipt_img = normalize_image(extract_signature(receipt_img, engine, area_scale))
+        similarity_value = ssim(signature_img, processed_receipt_img) * 100
+        if area_scale == 1 and (not max_size or max_size >= prescreen_size):
+            # the receipt was small enough to be fully processed already
+            return similarity_value, FULL_STAGE
+        if abs(similarity_value - threshold) > band:
+            return similarity_value, PRESCREEN_STAGE
+
+    processed_receipt_img = prepare_receipt(receipt, engine, max_size)
+    return ssim(signature_img, processed_receipt_img) * 100, FULL_STAGE
+
+
+def batch_ssim(reference_img, images, chunk_size=SSIM_CHUNK_SIZE):
+    """
+    Method to calculate the structural similarity of one uint8 reference image
+    against a stack of uint8 images of the same size. It follows the skimage
+    defaults (uniform window, sample covariance) so the values match ssim, the
+    statistics of the reference are only calculated once and the images are
+    filtered a chunk at a time to bound the memory used
+    """
+    images = np.asarray(images)
+    win_size = SSIM_WIN_SIZE
+    pad = (win_size - 1) // 2
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+    c1 = (SSIM_K1 * 255) ** 2
+    c2 = (SSIM_K2 * 255) ** 2
+
+    # mean and variance of the reference window are shared by every image
+    x = reference_img.astype(np.float64)
+    ux = ndimage.uniform_filter(x, size=win_size)
+    vx = cov_norm * (ndimage.uniform_filter(x * x, size=win_size) - ux * ux)
+
+    # only filter along the image axes, not across the stack
+    window = (1, win_size, win_size)
+    scores = np.empty(len(images), dtype=np.float64)
+    for start in range(0, len(images), chunk_size):
+        y = images[start:start + chunk_size].astype(np.float64)
+        uy = ndimage.uniform_filter(y, size=window)
+        vy = cov_norm * (ndimage.uniform_filter(y * y, size=window) - uy * uy)
+        vxy = cov_norm * (ndimage.uniform_filter(x * y, size=window) - ux * uy)
+
+        s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+        scores[start:start + chunk_size] = s[:, pad:-pad, pad:-pad].mean(axis=(1, 2))
+
+    return scores
+
+
+def calculate_similarities(receipts, signature, engine=DEFAULT_ENGINE,
+                           chunk_size=SSIM_CHUNK_SIZE, max_size=None):
+    """
+    Method to calculate the similarity of many receipts against the same
+    signature. The signature is only read once and the normalized receipts are
+    compared in batches, the scores are returned in the order of the receipts
+    """
+    receipt_imgs = [prepare_receipt(receipt, engine, max_size) for receipt in receipts]
+    if not receipt_imgs:
+        return np.empty(0, dtype=np.float64)
+
+    signature_img = prepare_signature(signature)
+    return batch_ssim(signature_img, np.stack(receipt_imgs), chunk_size) * 100
+
+
+def warm_up():
+    """
+    Method to load the lazily imported modules and run the pipeline once, used
+    to get worker processes ready before the first receipt arrives
+    """
+    img = np.full((64, 64), 255, dtype=np.uint8)
+    cv2.circle(img, (32, 32), 10, 0, 2)
+    calculate_similarity(img, img)
+
 # Debug
 # if __name__ == '__main__':
 #     receipt_path = '../media/signature_test/signature_receipt_3.png'
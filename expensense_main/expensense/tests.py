@@ -1,5 +1,5 @@
 import importlib
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from django.test import TestCase, Client
 import os
 from django.conf import settings
@@ -8,6 +8,56 @@ from expensense.forms import *
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.core.files.uploadedfile import SimpleUploadedFile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import shutil
+import tempfile
+from django.test import override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from io import StringIO
+import cv2
+import numpy as np
+from expensense.signature_matching import (calculate_similarity, calculate_similarities, extract_signature,
+                                           cascade_similarity, decode_signature, load_template, read_receipt,
+                                           template_path, ENGINES, FULL_STAGE, PRESCREEN_STAGE)
+from django.apps import apps
+from expensense.apps import serves_requests
+from expensense.scoring import SignatureScoringPool
+from expensense.duplicates import (BKTree, dhash, find_duplicate, hamming_distance, hash_to_str,
+                                   hashes_changed, index as duplicate_index)
+from expensense.ocr_api import OcrBackend, OcrClient, RACING_POLICY, SEQUENTIAL_POLICY
+from expensense.ocr_cache import OcrResultCache
+from expensense.ocr_api import results as ocr_results
+from expensense.ocr_backends import RecordedBackend, TesseractBackend
+from expensense.ocr_stub import StubOcrServer, parsed_response
+from expensense.ocr_jobs import OcrJobPool, run_job
+from expensense.ocr_limits import CLOSED, OPEN, CircuitBreaker, LimitStore, RateLimiter
+from PIL import Image, PngImagePlugin
+from expensense.ocr_preprocess import compress_receipt, crop_border, enhance_receipt, skew_angle
+from expensense.receipt_parser import find_amount, find_date, parse_number, parse_text
+from reportlab.platypus import Paragraph
+from expensense.report import ROW_HEIGHT, build_report, cell_text, report_rows, report_tables, scoped_expenses
+from expensense.report_cache import ReportCache, report_scope, scope_version
+from expensense.report_jobs import ReportJobPool, run_job as report_run_job
+from expensense.export import ROWS_PER_CHUNK, csv_chunks, xlsx_cell, xlsx_chunks
+from xml.etree import ElementTree
+import csv
+import zipfile
+from unittest import skipUnless
+from decimal import Decimal
+from django.utils.dateparse import parse_datetime
+from expensense.parquet_export import (changed_expenses, dataset_zip_chunks, export_dataset, pa, pq,
+                                       partition_path, read_watermark, write_watermark)
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+import datetime
+import io
+import expensense.ocr_api
+import json
+import threading
+import time
 
 FAILURE_HEADER = f"{os.linesep}TEST FAILURE{os.linesep}"
 FAILURE_FOOTER = f"{os.linesep}"
@@ -969,4 +1019,2125 @@ class LogoutViewTest(TestCase):
                          Response code is not 302{FAILURE_FOOTER}")
         self.assertRedirects(response, '/expensense/login/?next=/expensense/logout/', 
                              msg_prefix= f"{FAILURE_HEADER} the redictection \
-                                is not to login{FAILURE_FOOTER}")
\ No newline at end of file
+                                is not to login{FAILURE_FOOTER}")
+
+class SignatureMatchingTest(TestCase):
+    """ Class for signature matching test cases """
+    def setUp(self):
+        """ Method to set up the sample receipts and the signature """
+        self.sample_dir = os.path.join(settings.MEDIA_ROOT, 'signature_test')
+        self.receipts = [os.path.join(self.sample_dir, name) for name in
+                         sorted(os.listdir(self.sample_dir))]
+        self.signature_path = self.receipts[0]
+
+    def test_path_bytes_and_array_inputs_match(self):
+        """ Test that every supported input type gives the same score """
+        for receipt in self.receipts:
+            from_path = calculate_similarity(receipt, self.signature_path)
+            with open(receipt, 'rb') as f:
+                from_bytes = calculate_similarity(f.read(), self.signature_path)
+            from_array = calculate_similarity(cv2.imread(receipt, 0), self.signature_path)
+
+            self.assertEqual(from_path, from_bytes, f"{FAILURE_HEADER}Bytes \
+                             input score differs from path input{FAILURE_FOOTER}")
+            self.assertEqual(from_path, from_array, f"{FAILURE_HEADER}Array \
+                             input score differs from path input{FAILURE_FOOTER}")
+
+    def test_no_intermediate_files_written(self):
+        """ Test that no intermediate images are left in the working directory """
+        before = set(os.listdir(os.getcwd()))
+        calculate_similarity(self.receipts[1], self.signature_path)
+
+        self.assertEqual(before, set(os.listdir(os.getcwd())), f"{FAILURE_HEADER}\
+                         Signature matching wrote files to the working \
+                            directory{FAILURE_FOOTER}")
+
+    def test_concurrent_scoring(self):
+        """ Test that parallel scorings give the same result as sequential ones """
+        jobs = self.receipts * 8
+        expected = [calculate_similarity(receipt, self.signature_path) for receipt in jobs]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            scores = list(executor.map(
+                lambda receipt: calculate_similarity(receipt, self.signature_path), jobs))
+
+        self.assertEqual(scores, expected, f"{FAILURE_HEADER}Concurrent \
+                         scores differ from sequential scores{FAILURE_FOOTER}")
+
+    def test_engines_match_reference(self):
+        """ Test that every engine gives the same clean up as the skimage reference """
+        # a synthetic receipt with a lot of specks on top of the samples
+        synthetic = np.full((600, 800), 230, dtype=np.uint8)
+        rng = np.random.default_rng(0)
+        for x, y, r in zip(rng.integers(0, 800, 2000), rng.integers(0, 600, 2000),
+                           rng.integers(1, 4, 2000)):
+            cv2.circle(synthetic, (int(x), int(y)), int(r), 0, -1)
+        cv2.putText(synthetic, 'TOTAL 12.50', (50, 300), cv2.FONT_HERSHEY_SIMPLEX, 2, 0, 3)
+
+        images = [cv2.imread(receipt, 0) for receipt in self.receipts] + [synthetic]
+        for engine in ENGINES:
+            for img in images:
+                self.assertTrue(np.array_equal(extract_signature(img, engine),
+                                               extract_signature(img, 'skimage')),
+                                f"{FAILURE_HEADER}{engine} engine differs from the \
+                                    reference{FAILURE_FOOTER}")
+
+    def test_batch_scores_match_single_scores(self):
+        """ Test that batch scoring returns the single call scores in input order """
+        receipts = self.receipts + self.receipts[::-1]
+        expected = [calculate_similarity(receipt, self.signature_path) for receipt in receipts]
+
+        scores = calculate_similarities(receipts, self.signature_path, chunk_size=2)
+
+        self.assertEqual(len(scores), len(receipts))
+        for score, single in zip(scores, expected):
+            self.assertAlmostEqual(score, single, places=9, msg=f"{FAILURE_HEADER}Batch \
+                                   score differs from single score{FAILURE_FOOTER}")
+        self.assertEqual(len(calculate_similarities([], self.signature_path)), 0)
+
+    def test_reduced_resolution_receipt(self):
+        """ Test that big receipts are read at the maximum working size """
+        photo = cv2.resize(cv2.imread(self.receipts[1]), (4000, 2250))
+        photo_bytes = cv2.imencode('.jpg', photo)[1].tobytes()
+
+        img, area_scale = read_receipt(photo_bytes, max_size=1000)
+
+        self.assertEqual(max(img.shape), 1000, f"{FAILURE_HEADER}Receipt was \
+                         not reduced to the working size{FAILURE_FOOTER}")
+        self.assertAlmostEqual(area_scale, img.shape[0] * img.shape[1] / (4000 * 2250))
+        self.assertLess(abs(calculate_similarity(photo_bytes, self.signature_path, max_size=2048) -
+                            calculate_similarity(photo_bytes, self.signature_path)), 1)
+
+    def test_small_receipt_not_reduced(self):
+        """ Test that receipts within the working size keep their score """
+        for receipt in self.receipts:
+            self.assertEqual(calculate_similarity(receipt, self.signature_path, max_size=2048),
+                             calculate_similarity(receipt, self.signature_path))
+
+    def test_cascade_stages(self):
+        """ Test which stage of the cascade matcher decides the score """
+        photo = cv2.resize(cv2.imread(self.receipts[1]), (4000, 2250))
+        photo_bytes = cv2.imencode('.jpg', photo)[1].tobytes()
+        full = calculate_similarity(photo_bytes, self.signature_path, max_size=2048)
+
+        self.assertEqual(cascade_similarity(photo_bytes, self.signature_path, max_size=2048),
+                         (full, FULL_STAGE), f"{FAILURE_HEADER}Cascade without a band \
+                            did not run the full stage{FAILURE_FOOTER}")
+        self.assertEqual(cascade_similarity(photo_bytes, self.signature_path, band=100,
+                                            max_size=2048), (full, FULL_STAGE))
+
+        score, stage = cascade_similarity(photo_bytes, self.signature_path, threshold=200,
+                                          band=5, max_size=2048)
+        self.assertEqual(stage, PRESCREEN_STAGE, f"{FAILURE_HEADER}Score far from the \
+                         threshold was not decided by the pre-screen{FAILURE_FOOTER}")
+        self.assertNotEqual(score, full)
+
+        # small receipts are fully processed by the pre-screen already
+        self.assertEqual(cascade_similarity(self.receipts[2], self.signature_path, band=5),
+                         (calculate_similarity(self.receipts[2], self.signature_path), FULL_STAGE))
+
+    def test_unknown_engine(self):
+        """ Test that an unknown engine is rejected """
+        with self.assertRaises(ValueError):
+            calculate_similarity(self.receipts[0], self.signature_path, engine='unknown')
+
+
+class SignatureScoringTest(TestCase):
+    """ Class for background signature scoring test cases """
+    def setUp(self):
+        """ Method to set up an employee with a signature and approval conditions """
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        sample_dir = os.path.join(settings.BASE_DIR, 'media', 'signature_test')
+        with open(os.path.join(sample_dir, 'signature_receipt_3.png'), 'rb') as f:
+            self.receipt_bytes = f.read()
+        with open(os.path.join(sample_dir, 'signature_receipt.jpg'), 'rb') as f:
+            signature_bytes = f.read()
+
+        self.company = Company.objects.create(company='Company1', company_budget=1000)
+        self.team = Team.objects.create(company=self.company, team_name='Team1')
+        self.category = Category.objects.create(category_name='Travel')
+        self.company.categories.add(self.category)
+        self.user = User.objects.create_user(username='testemployee', password='testpassword',
+                                             role='EMP', company=self.company, team=self.team)
+        self.user.signature = SimpleUploadedFile('signature.jpg', signature_bytes)
+        self.user.save()
+
+        for username, role in (('testmanager', 'MNG'), ('testadmin', 'ADM')):
+            approver = User.objects.create_user(username=username, password='testpassword',
+                                                role=role, company=self.company, team=self.team)
+            ApprovalConditions.objects.create(company=self.company, team=self.team,
+                                              user=approver, max_amount=100)
+
+    def tearDown(self):
+        """ Method to remove the uploaded files """
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def log_expense(self):
+        """ Method to log an expense through the view """
+        self.client.login(username='testemployee', password='testpassword')
+        return self.client.post(reverse('expensense:log_expense'), {
+            'expense_name': 'Taxi',
+            'amount': '10.00',
+            'expense_date': '2023-08-01',
+            'category': self.category.id,
+            'receipt': SimpleUploadedFile('receipt.png', self.receipt_bytes),
+        })
+
+    def test_pool_matches_inline_score(self):
+        """ Test that the worker processes give the same score as the request """
+        pool = SignatureScoringPool(1, 4)
+        try:
+            receipt_path = os.path.join(settings.BASE_DIR, 'media', 'signature_test',
+                                        'signature_receipt_3.png')
+            future = pool.submit(receipt_path, self.user.signature.path, band=5)
+            self.assertEqual(future.result(timeout=120),
+                             cascade_similarity(receipt_path, self.user.signature.path, band=5),
+                             f"{FAILURE_HEADER}Pool score differs from inline \
+                                score{FAILURE_FOOTER}")
+        finally:
+            pool.shutdown()
+
+    def test_disabled_or_full_pool_is_not_used(self):
+        """ Test that a disabled or full pool hands the work back to the caller """
+        self.assertIsNone(SignatureScoringPool(0, 4).submit(b'', b''))
+
+        pool = SignatureScoringPool(1, 1)
+        pool._slots.acquire()
+        self.assertIsNone(pool.submit(b'', b''), f"{FAILURE_HEADER}Full pool \
+                          accepted more work{FAILURE_FOOTER}")
+        pool.shutdown()
+
+    def test_started_pool_spawns_workers(self):
+        """ Test that starting the pool spawns its workers before any expense is logged """
+        pool = SignatureScoringPool(2, 4)
+        try:
+            pool.start()
+            self.assertEqual(len(pool._executor._processes), 2, f"{FAILURE_HEADER}Pool \
+                             was not started with all its workers{FAILURE_FOOTER}")
+        finally:
+            pool.shutdown()
+
+    def test_pool_started_when_serving(self):
+        """ Test that the pool is only started in processes serving requests """
+        for argv, environ, serving in ((['/venv/bin/gunicorn', 'expensense_main.wsgi'], {}, True),
+                                       (['/venv/lib/gunicorn/__main__.py', 'expensense_main.wsgi'], {}, True),
+                                       (['uwsgi'], {}, True),
+                                       (['manage.py', 'runserver'], {'RUN_MAIN': 'true'}, True),
+                                       (['manage.py', 'runserver'], {}, False),
+                                       (['manage.py', 'runserver', '--noreload'], {}, True),
+                                       (['manage.py', 'migrate'], {}, False),
+                                       (['/venv/bin/django-admin', 'migrate'], {}, False),
+                                       (['/venv/bin/pytest'], {}, False),
+                                       (['/venv/bin/celery', 'worker'], {}, False),
+                                       (['script.py'], {}, False),
+                                       ([], {}, False)):
+            with patch('sys.argv', argv), patch.dict(os.environ, environ), \
+                    patch('expensense.scoring.get_pool') as mock_get_pool:
+                if 'RUN_MAIN' not in environ:
+                    os.environ.pop('RUN_MAIN', None)
+                self.assertEqual(serves_requests(), serving)
+                apps.get_app_config('expensense').ready()
+                self.assertEqual(mock_get_pool.return_value.start.called, serving,
+                                 f"{FAILURE_HEADER}Pool start wrong for {argv}{FAILURE_FOOTER}")
+
+    @patch('expensense.scoring.get_pool', return_value=SignatureScoringPool(0, 1))
+    def test_log_expense_scores_signature(self, mock_get_pool):
+        """ Test that a logged expense gets its similarity and is auto approved """
+        response = self.log_expense()
+
+        self.assertEqual(response.status_code, 302, f"{FAILURE_HEADER}\
+                         Response code is not 302{FAILURE_FOOTER}")
+        expense = Expense.objects.get(user_id=self.user)
+        self.assertFalse(expense.similarity_pending)
+        self.assertIsNotNone(expense.similarity)
+        self.assertEqual(float(expense.similarity), round(calculate_similarity(
+            expense.receipt.path, self.user.signature.path), 2))
+        self.assertEqual(expense.similarity_stage, 'full')
+
+    @patch('expensense.scoring.get_pool')
+    def test_log_expense_pending_until_scored(self, mock_get_pool):
+        """ Test that the expense is saved as pending and approved once scored """
+        future = Future()
+        mock_get_pool.return_value.submit.return_value = future
+        self.log_expense()
+
+        expense = Expense.objects.get(user_id=self.user)
+        self.assertTrue(expense.similarity_pending, f"{FAILURE_HEADER}Expense \
+                        is not pending before scoring{FAILURE_FOOTER}")
+        self.assertEqual(expense.status, Expense.pending)
+
+        with patch('expensense.scoring.connection'):
+            future.set_result((95, 'prescreen'))
+
+        expense.refresh_from_db()
+        self.assertFalse(expense.similarity_pending)
+        self.assertEqual(float(expense.similarity), 95)
+        self.assertEqual(expense.similarity_stage, 'prescreen')
+        self.assertEqual(expense.status, Expense.admin_approved, f"{FAILURE_HEADER}\
+                         Expense was not auto approved after scoring{FAILURE_FOOTER}")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class SignatureTemplateTest(TestCase):
+    """ Class for signature template enrollment test cases """
+    def setUp(self):
+        """ Method to set up an employee with a signature """
+        sample_dir = os.path.join(settings.BASE_DIR, 'media', 'signature_test')
+        self.receipt_path = os.path.join(sample_dir, 'signature_receipt_3.png')
+        with open(os.path.join(sample_dir, 'signature_receipt.jpg'), 'rb') as f:
+            self.signature_bytes = f.read()
+
+        company = Company.objects.create(company='Company1', company_budget=1000)
+        self.user = User.objects.create_user(username='testemployee', password='testpassword',
+                                             company=company)
+        self.user.signature = SimpleUploadedFile('signature.jpg', self.signature_bytes)
+        self.user.save()
+
+    def tearDown(self):
+        """ Method to remove the uploaded files """
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def test_template_created_on_save(self):
+        """ Test that saving a signature stores a memory mapped template """
+        template = load_template(self.user.signature.path)
+
+        self.assertIsInstance(template, np.memmap, f"{FAILURE_HEADER}Template \
+                              was not stored on save{FAILURE_FOOTER}")
+        self.assertTrue(np.array_equal(template, decode_signature(self.signature_bytes)))
+        self.assertEqual(calculate_similarity(self.receipt_path, self.user.signature.path),
+                         calculate_similarity(self.receipt_path, self.signature_bytes),
+                         f"{FAILURE_HEADER}Template score differs from decoded \
+                            signature score{FAILURE_FOOTER}")
+
+    def test_template_regenerated_on_signature_change(self):
+        """ Test that a new signature gets its own template """
+        with open(self.receipt_path, 'rb') as f:
+            self.user.signature = SimpleUploadedFile('signature.png', f.read())
+        self.user.save()
+
+        self.assertTrue(np.array_equal(load_template(self.user.signature.path),
+                                       decode_signature(self.receipt_path)),
+                        f"{FAILURE_HEADER}Template was not regenerated{FAILURE_FOOTER}")
+
+    def test_stale_template_ignored(self):
+        """ Test that a template older than its signature is not used """
+        signature_path = self.user.signature.path
+        stat = os.stat(template_path(signature_path))
+        os.utime(signature_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        self.assertIsNone(load_template(signature_path))
+
+    @patch('expensense.signals.enroll_signature')
+    def test_login_does_not_enroll(self, mock_enroll):
+        """ Test that saving other fields does not rebuild the template """
+        os.remove(template_path(self.user.signature.path))
+        self.client.login(username='testemployee', password='testpassword')
+
+        mock_enroll.assert_not_called()
+
+
+
+class BenchmarkCommandTest(TestCase):
+    """ Class for the benchmark command test cases """
+
+    def test_unknown_benchmark(self):
+        """ Test that unknown benchmark names are rejected """
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'unknown', stdout=StringIO(), stderr=StringIO())
+
+    def test_results_are_json(self):
+        """ Test that the results are written out as JSON """
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+        stdout = StringIO()
+        call_command('benchmark', 'batch_similarity', sizes=[2], output=output,
+                     stdout=stdout, stderr=StringIO())
+
+        with open(output) as f:
+            results = json.load(f)
+        shutil.rmtree(os.path.dirname(output))
+
+        self.assertEqual(results, json.loads(stdout.getvalue()))
+        self.assertEqual(results['batch_similarity']['results'][0]['receipts'], 2)
+        self.assertEqual(results['batch_similarity']['results'][0]['max_score_difference'], 0)
+
+    def test_pdf_report_reads_the_database(self):
+        """ Test that the report benchmark builds the report of expenses it adds and rolls them back """
+        stdout = StringIO()
+        call_command('benchmark', 'pdf_report', sizes=[60], stdout=stdout, stderr=StringIO())
+
+        result = json.loads(stdout.getvalue())['pdf_report']['results'][0]
+        self.assertEqual(result['rows'], 60)
+        self.assertGreaterEqual(result['pages'], 2)
+        self.assertIn('legacy_seconds', result)
+        self.assertFalse(Expense.objects.exists(), f"{FAILURE_HEADER}Benchmark expenses \
+                         were left behind{FAILURE_FOOTER}")
+
+    def test_signature_config_runs_in_spawned_process(self):
+        """ Test that a matcher configuration runs in a process which does not set django up """
+        from expensense.benchmarks import run_signature_config, synthetic_corpus
+        corpus, signature = synthetic_corpus(1, ((400, 550),))
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            run = executor.submit(run_signature_config, {'engine': 'opencv'}, corpus, signature).result()
+
+        self.assertEqual(len(run['scores']), 1)
+        self.assertGreater(run['peak_traced_bytes'], 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RescoreExpensesCommandTest(TestCase):
+    """ Class for the rescore_expenses command test cases """
+    def setUp(self):
+        """ Method to set up expenses of two teams with stale similarities """
+        sample_dir = os.path.join(settings.BASE_DIR, 'media', 'signature_test')
+        with open(os.path.join(sample_dir, 'signature_receipt_3.png'), 'rb') as f:
+            receipt_bytes = f.read()
+        with open(os.path.join(sample_dir, 'signature_receipt.jpg'), 'rb') as f:
+            signature_bytes = f.read()
+        self.checkpoint = os.path.join(settings.MEDIA_ROOT, 'checkpoint.json')
+
+        company = Company.objects.create(company='Company1', company_budget=1000)
+        self.teams = [Team.objects.create(company=company, team_name=f'Team{i}') for i in range(2)]
+        self.expenses = []
+        for team in self.teams:
+            user = User.objects.create_user(username=f'employee{team.id}', password='testpassword',
+                                            company=company, team=team)
+            user.signature = SimpleUploadedFile('signature.jpg', signature_bytes)
+            user.save()
+            for day in (1, 2):
+                self.expenses.append(Expense.objects.create(
+                    user_id=user, expense_name='Taxi', amount=10,
+                    expense_date=f'2023-08-0{day}', similarity=1,
+                    receipt=SimpleUploadedFile('receipt.png', receipt_bytes)))
+        self.expected = round(calculate_similarity(self.expenses[0].receipt.path,
+                                                   user.signature.path), 2)
+
+    def tearDown(self):
+        """ Method to remove the uploaded files """
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def rescore(self, **options):
+        """ Method to run the command in this process """
+        call_command('rescore_expenses', workers=0, chunk_size=1, checkpoint=self.checkpoint,
+                     stdout=StringIO(), stderr=StringIO(), **options)
+
+    def similarities(self):
+        """ Method to get the stored similarities in id order """
+        return [float(expense.similarity) for expense in Expense.objects.order_by('id')]
+
+    def test_filters(self):
+        """ Test that only the filtered expenses are rescored """
+        self.rescore(team=self.teams[1].id, start_date='2023-08-02')
+
+        self.assertEqual(self.similarities(), [1, 1, 1, self.expected], f"{FAILURE_HEADER}\
+                         Wrong expenses were rescored{FAILURE_FOOTER}")
+        self.assertFalse(os.path.exists(self.checkpoint), f"{FAILURE_HEADER}Checkpoint \
+                         was left behind after a complete run{FAILURE_FOOTER}")
+
+    def test_resume(self):
+        """ Test that a resumed run continues after the checkpoint """
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'filters': {}, 'last_id': self.expenses[1].id, 'scored': 2, 'failed': 0}, f)
+
+        self.rescore(resume=True)
+
+        self.assertEqual(self.similarities(), [1, 1, self.expected, self.expected],
+                         f"{FAILURE_HEADER}Resumed run did not continue after the \
+                            checkpoint{FAILURE_FOOTER}")
+
+    def test_resume_with_other_filters(self):
+        """ Test that a checkpoint is not resumed with different filters """
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'filters': {}, 'last_id': 0, 'scored': 0, 'failed': 0}, f)
+
+        with self.assertRaises(CommandError):
+            self.rescore(resume=True, team=self.teams[0].id)
+
+    def test_process_pool(self):
+        """ Test that scoring in worker processes gives the same results """
+        call_command('rescore_expenses', workers=1, chunk_size=3, checkpoint=self.checkpoint,
+                     stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(self.similarities(), [self.expected] * 4)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class DuplicateReceiptTest(TestCase):
+    """ Class for duplicate receipt detection test cases """
+    def setUp(self):
+        """ Method to set up employees of two companies """
+        sample_dir = os.path.join(settings.BASE_DIR, 'media', 'signature_test')
+        self.receipts = [os.path.join(sample_dir, name) for name in sorted(os.listdir(sample_dir))]
+        duplicate_index.clear()
+
+        self.users = []
+        for i in range(2):
+            company = Company.objects.create(company=f'Company{i}', company_budget=1000)
+            company.categories.add(Category.objects.create(category_name=f'Travel{i}'))
+            self.users.append(User.objects.create_user(
+                username=f'employee{i}', password='testpassword', company=company))
+
+    def tearDown(self):
+        """ Method to remove the uploaded files """
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def log_expense(self, user, receipt_bytes):
+        """ Method to log an expense through the view and return it """
+        self.client.login(username=user.username, password='testpassword')
+        self.client.post(reverse('expensense:log_expense'), {
+            'expense_name': 'Taxi',
+            'amount': '10.00',
+            'expense_date': '2023-08-01',
+            'category': user.company.categories.get().id,
+            'receipt': SimpleUploadedFile('receipt.png', receipt_bytes),
+        })
+        return Expense.objects.latest('id')
+
+    def test_hash_survives_reencoding(self):
+        """ Test that a re-encoded and resized receipt gets a close hash """
+        img = cv2.imread(self.receipts[1])
+        resized = cv2.imencode('.jpg', cv2.resize(img, (960, 540)), [cv2.IMWRITE_JPEG_QUALITY, 70])[1]
+
+        original = dhash(self.receipts[1])
+        self.assertLessEqual(hamming_distance(original, dhash(resized.tobytes())), 6,
+                             f"{FAILURE_HEADER}Re-encoded receipt hash is not close\
+                                {FAILURE_FOOTER}")
+        for other in (self.receipts[0], self.receipts[2]):
+            self.assertGreater(hamming_distance(original, dhash(other)), 6)
+
+    def test_bk_tree_matches_brute_force(self):
+        """ Test that the BK-tree finds the same hashes as comparing all of them """
+        rng = np.random.default_rng(0)
+        hashes = [int(value) for value in rng.integers(0, 2 ** 63, 500)]
+        tree = BKTree()
+        for item, value in enumerate(hashes):
+            tree.add(value, item)
+
+        for query in hashes[:20]:
+            expected = sorted((hamming_distance(query, value), item)
+                              for item, value in enumerate(hashes)
+                              if hamming_distance(query, value) <= 20)
+            self.assertEqual(tree.search(query, 20), expected)
+
+    def test_resubmitted_receipt_flagged(self):
+        """ Test that a re-submitted receipt is flagged within the company only """
+        with open(self.receipts[1], 'rb') as f:
+            receipt_bytes = f.read()
+
+        first = self.log_expense(self.users[0], receipt_bytes)
+        second = self.log_expense(self.users[0], receipt_bytes)
+        other_company = self.log_expense(self.users[1], receipt_bytes)
+
+        self.assertIsNone(first.duplicate_of)
+        self.assertEqual(second.duplicate_of, first, f"{FAILURE_HEADER}Re-submitted \
+                         receipt was not flagged{FAILURE_FOOTER}")
+        self.assertIsNone(other_company.duplicate_of, f"{FAILURE_HEADER}Receipt of \
+                          another company was flagged{FAILURE_FOOTER}")
+
+    def test_deleted_expense_not_matched(self):
+        """ Test that a receipt is not flagged as a duplicate of a deleted expense """
+        with open(self.receipts[1], 'rb') as f:
+            receipt_bytes = f.read()
+        first = self.log_expense(self.users[0], receipt_bytes)
+        second = self.log_expense(self.users[0], receipt_bytes)
+        # deleted by another process, whose signals do not reach this one
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {Expense._meta.db_table} WHERE id IN (%s, %s)',
+                           [first.id, second.id])
+
+        self.assertIsNone(find_duplicate(self.users[0].company_id, first.receipt_hash, 6))
+        self.assertIsNone(self.log_expense(self.users[0], receipt_bytes).duplicate_of)
+
+    def test_deleting_expense_drops_index(self):
+        """ Test that deleting an expense reloads the receipt hashes of the process """
+        first = self.log_expense(self.users[0], self.read_receipt(1))
+        first.delete()
+
+        self.assertIsNone(self.log_expense(self.users[0], self.read_receipt(1)).duplicate_of)
+
+    def test_backfilled_hashes_are_matched(self):
+        """ Test that hashes backfilled below the loaded expenses are searched """
+        with open(self.receipts[1], 'rb') as f:
+            receipt_bytes = f.read()
+        stored = Expense.objects.create(user_id=self.users[0], expense_name='Taxi', amount=10,
+                                        expense_date='2023-08-01',
+                                        receipt=SimpleUploadedFile('receipt.png', receipt_bytes))
+        self.log_expense(self.users[0], self.read_receipt(0))
+        receipt_hash = hash_to_str(dhash(self.receipts[1]))
+        # backfilled by another process, which bumps the version of the hashes
+        Expense.objects.filter(id=stored.id).update(receipt_hash=receipt_hash)
+        hashes_changed(self.users[0].company_id)
+
+        self.assertEqual(find_duplicate(self.users[0].company_id, receipt_hash, 6), stored.id)
+
+    def test_lookup_does_not_count_hashes(self):
+        """ Test that a lookup reads the version and the new hashes, not the company's hashes """
+        first = self.log_expense(self.users[0], self.read_receipt(1))
+        self.log_expense(self.users[0], self.read_receipt(0))
+        company_id = self.users[0].company_id
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(find_duplicate(company_id, first.receipt_hash, 6), first.id)
+        self.assertFalse(any('COUNT' in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(len(queries), 3, f"{FAILURE_HEADER}Lookup did not only read the version, \
+                         new hashes and matches{FAILURE_FOOTER}")
+
+    def test_delete_with_backfill_reloads(self):
+        """ Test that a delete and a backfill which keep the number of hashes reload the tree """
+        first = self.log_expense(self.users[0], self.read_receipt(1))
+        stored = Expense.objects.create(user_id=self.users[0], expense_name='Taxi', amount=10,
+                                        expense_date='2023-08-01',
+                                        receipt=SimpleUploadedFile('receipt.png', self.read_receipt(0)))
+        self.assertEqual(find_duplicate(self.users[0].company_id, first.receipt_hash, 6), first.id)
+
+        first.delete()
+        call_command('hash_receipts', stdout=StringIO(), stderr=StringIO())
+
+        stored.refresh_from_db()
+        self.assertEqual(find_duplicate(self.users[0].company_id, stored.receipt_hash, 6), stored.id)
+
+    def read_receipt(self, number):
+        """ Method to read the bytes of a sample receipt """
+        with open(self.receipts[number], 'rb') as f:
+            return f.read()
+
+    def test_backfill_command(self):
+        """ Test that the backfill hashes stored receipts and flags the duplicates """
+        with open(self.receipts[1], 'rb') as f:
+            receipt_bytes = f.read()
+        for i in range(2):
+            Expense.objects.create(user_id=self.users[0], expense_name='Taxi', amount=10,
+                                   expense_date='2023-08-01',
+                                   receipt=SimpleUploadedFile('receipt.png', receipt_bytes))
+
+        call_command('hash_receipts', flag=True, stdout=StringIO(), stderr=StringIO())
+
+        first, second = Expense.objects.order_by('id')
+        self.assertEqual(first.receipt_hash, hash_to_str(dhash(self.receipts[1])))
+        self.assertIsNone(first.duplicate_of)
+        self.assertEqual(second.duplicate_of, first)
+
+
+class StubOcrTestCase(TestCase):
+    """ Class to run a local stub of the OCR API for the test cases """
+
+    def setUp(self):
+        """ Method to start the stub server and a client pointed at it """
+        self.server = StubOcrServer().start()
+        self.endpoint = self.server.endpoint
+
+        self.receipt = os.path.join(settings.BASE_DIR, 'media', 'signature_test',
+                                    sorted(os.listdir(os.path.join(settings.BASE_DIR, 'media',
+                                                                   'signature_test')))[0])
+
+    def tearDown(self):
+        """ Method to stop the stub server """
+        self.server.stop()
+
+    def make_client(self, **options):
+        """ Method to get a client of the stub server """
+        client = OcrClient(api_key='test-key', endpoint=self.endpoint, **options)
+        self.addCleanup(client.close)
+        return client
+
+
+class OcrClientTest(StubOcrTestCase):
+    """ Class for the pooled OCR client test cases """
+
+    def test_engines_tried_in_turn(self):
+        """ Test that the engines are tried until one of them parses the receipt """
+        self.server.responses[2] = parsed_response('Total 12.50 Date 05/08/2023')
+        client = self.make_client()
+
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result['amount'], 12.5)
+        self.assertEqual(result['date'], {'day': 5, 'month': 8, 'year': 2023})
+        self.assertEqual(self.server.engines_called, [1, 2])
+
+    def test_connections_reused(self):
+        """ Test that the requests are sent over one keep-alive connection """
+        client = self.make_client()
+        for i in range(3):
+            client.results(self.receipt)
+
+        metrics = client.metrics()
+        self.assertEqual(metrics['requests_sent'], 9)
+        self.assertEqual(metrics['connections_opened'], 1, f"{FAILURE_HEADER}A connection \
+                         was opened for every request{FAILURE_FOOTER}")
+        self.assertEqual(metrics['connections_reused'], 8)
+        self.assertEqual(metrics['engines'][1]['requests'], 3)
+
+    def test_success_rates_kept_per_enhancement(self):
+        """ Test that the engine calls and success rates are kept for enhanced and plain receipts """
+        self.server.responses[2] = parsed_response('Total 12.50 Date 05/08/2023')
+        client = self.make_client()
+        with patch.object(client, 'enhance_rate', 1):
+            client.results(self.receipt)
+        client.results(self.receipt)
+        client.results(self.receipt, engines=(2,))
+
+        enhancement = client.metrics()['enhancement']
+        self.assertEqual(enhancement['enhanced']['receipts'], 1)
+        self.assertEqual(enhancement['enhanced']['calls_per_receipt'], 2)
+        self.assertEqual(enhancement['plain']['receipts'], 2)
+        self.assertEqual(enhancement['plain']['calls_per_receipt'], 1.5)
+        self.assertEqual(enhancement['plain']['engines'][1]['success_rate'], 0)
+        self.assertEqual(enhancement['plain']['engines'][2]['success_rate'], 1)
+
+    def test_receipt_compressed_once(self):
+        """ Test that the receipt is compressed once and sent smaller to every engine """
+        client = self.make_client()
+        client.results(self.receipt)
+
+        sent = client.metrics()['engines']
+        self.assertEqual(sent[1]['bytes_sent'], sent[3]['bytes_sent'])
+        self.assertLess(sent[1]['bytes_sent'], os.path.getsize(self.receipt))
+        self.assertLess(self.server.bytes_received, 3 * os.path.getsize(self.receipt))
+
+    def hold_engines(self, *engines):
+        """
+        Method to keep the engines from answering until the end of the test,
+        they are let go before the clients made earlier are closed
+        """
+        for engine in engines:
+            self.server.holds[engine] = threading.Event()
+            self.addCleanup(self.server.holds[engine].set)
+
+    def test_deadline_bounds_slow_engine(self):
+        """ Test that an engine which does not answer cannot hold the call past its deadline """
+        client = self.make_client(read_timeout=30, deadline=0.5)
+        self.hold_engines(1)
+
+        # the engine only answers once the test is over, so the call returning
+        # at all means the deadline ended it
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result, {'error': 'timeout'})
+        self.assertEqual(client.metrics()['engines'][1]['errors'], 1)
+
+    def test_racing_returns_first_parsed_result(self):
+        """ Test that racing takes the fastest engine parsing the receipt """
+        self.server.responses = {1: parsed_response('Total 99.00'),
+                                 2: parsed_response('Total 99.00'),
+                                 3: parsed_response('Total 12.50 Date 05/08/2023')}
+        client = self.make_client(policy=RACING_POLICY)
+        self.hold_engines(1, 2)
+
+        # the other engines only answer once the test is over, so the call
+        # returning at all means it did not wait for them
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result['amount'], 12.5)
+        self.assertTrue(self.server.wait_for_requests(3), f"{FAILURE_HEADER}The engines \
+                        were not raced{FAILURE_FOOTER}")
+        self.assertEqual(sorted(self.server.engines_called), [1, 2, 3])
+
+    def test_racing_skips_failed_engines(self):
+        """ Test that racing ignores a faster engine which does not parse the receipt """
+        self.server.delays = {2: 0.2}
+        self.server.responses = {2: parsed_response('Total 12.50 Date 05/08/2023')}
+        client = self.make_client(policy=RACING_POLICY)
+
+        self.assertEqual(json.loads(client.results(self.receipt))['amount'], 12.5)
+        self.assertEqual(json.loads(client.results(self.receipt, engines=(1, 3))),
+                         {'error': 'partial parse'})
+
+    def test_sequential_policy_overrides_client(self):
+        """ Test that the policy of a call overrides the one of the client """
+        self.server.responses = {1: parsed_response('Total 12.50 Date 05/08/2023')}
+        client = self.make_client(policy=RACING_POLICY)
+
+        client.results(self.receipt, policy=SEQUENTIAL_POLICY)
+
+        self.assertEqual(self.server.engines_called, [1])
+        with self.assertRaises(ValueError):
+            client.results(self.receipt, policy='fastest')
+
+
+OCR_CACHE_SETTINGS = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'ocr': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempfile.mkdtemp(), 'OPTIONS': {'MAX_ENTRIES': 2}},
+}
+
+
+class OcrLimitsTest(StubOcrTestCase):
+    """ Class for the shared OCR rate limiter and circuit breakers test cases """
+
+    def setUp(self):
+        """ Method to set up a database for the limits and an endpoint nothing listens on """
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.limits_path = os.path.join(temp_dir, 'ocr_limits.sqlite3')
+        self.server.responses[1] = parsed_response('Total 12.50 Date 05/08/2023')
+        unused = StubOcrServer()
+        self.down_endpoint = unused.endpoint
+        unused.server_close()
+
+    def test_tokens_shared_between_stores(self):
+        """ Test that limiters on separate connections to the database share the tokens """
+        first = RateLimiter(LimitStore(self.limits_path), rate=0.1, burst=2)
+        second = RateLimiter(LimitStore(self.limits_path), rate=0.1, burst=2)
+
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.acquire(), f"{FAILURE_HEADER}The bucket was not shared{FAILURE_FOOTER}")
+        self.assertEqual(first.state()['limited'], 1)
+
+    def test_limiter_waits_for_refill(self):
+        """ Test that a request waits for a token within its timeout """
+        limiter = RateLimiter(LimitStore(self.limits_path), rate=20, burst=1)
+        limiter.acquire()
+
+        with patch('expensense.ocr_limits.time.sleep', wraps=time.sleep) as sleep:
+            self.assertTrue(limiter.acquire(timeout=1))
+        self.assertTrue(sleep.called, f"{FAILURE_HEADER}The token was taken without waiting \
+                        for the refill{FAILURE_FOOTER}")
+        self.assertLessEqual(sleep.call_args[0][0], 1 / 20)
+
+    def test_rate_limited_engines_not_sent(self):
+        """ Test that the engines are not queried once the quota is used up """
+        self.server.responses.clear()
+        client = self.make_client(limits_path=self.limits_path, rate_limit=0.1, rate_burst=1)
+
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result, {'error': 'OCR rate limited'})
+        self.assertEqual(self.server.engines_called, [1])
+
+    def test_breaker_opens_and_fails_fast(self):
+        """ Test that engines which keep failing are not sent requests until the cooldown """
+        client = OcrClient(api_key='test-key', endpoint=self.down_endpoint,
+                           limits_path=self.limits_path, breaker_threshold=2, breaker_cooldown=60)
+        self.addCleanup(client.close)
+        for _ in range(2):
+            self.assertEqual(json.loads(client.results(self.receipt)), {'error': 'OCR request failed'})
+
+        client.endpoint = self.endpoint
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result, {'error': 'OCR engine unavailable'})
+        self.assertEqual(self.server.engines_called, [])
+        self.assertEqual({engine: state['state'] for engine, state in client.metrics()['breakers'].items()},
+                         {1: OPEN, 2: OPEN, 3: OPEN})
+
+    def test_breaker_probes_after_cooldown(self):
+        """ Test that a probe is let through after the cooldown and closes the breaker """
+        client = OcrClient(api_key='test-key', endpoint=self.down_endpoint,
+                           limits_path=self.limits_path, breaker_threshold=1, breaker_cooldown=0.2)
+        self.addCleanup(client.close)
+        client.results(self.receipt)
+        time.sleep(0.3)
+
+        client.endpoint = self.endpoint
+        result = json.loads(client.results(self.receipt))
+
+        self.assertEqual(result['amount'], 12.5)
+        self.assertEqual(client.metrics()['breakers'][1]['state'], CLOSED)
+
+    def test_failed_probe_reopens(self):
+        """ Test that a failed probe keeps the breaker open for another cooldown """
+        breaker = CircuitBreaker(LimitStore(self.limits_path), failure_threshold=3, cooldown=0.1)
+        for _ in range(3):
+            breaker.record_failure(1)
+        time.sleep(0.15)
+
+        self.assertTrue(breaker.allow(1))
+        self.assertFalse(breaker.allow(1), f"{FAILURE_HEADER}More than one probe was let \
+                         through{FAILURE_FOOTER}")
+        breaker.record_failure(1)
+        self.assertTrue(breaker.is_open(1))
+
+    def test_success_rates_shared_between_clients(self):
+        """ Test that clients sharing the database add up the enhanced and plain receipts """
+        clients = [self.make_client(limits_path=self.limits_path) for i in range(2)]
+        with patch.object(clients[0], 'enhance_rate', 1):
+            clients[0].results(self.receipt)
+        clients[1].results(self.receipt)
+
+        for client in clients:
+            enhancement = client.metrics()['enhancement']
+            self.assertEqual(enhancement['enhanced']['receipts'], 1)
+            self.assertEqual(enhancement['plain']['receipts'], 1)
+            self.assertEqual(enhancement['plain']['engines'][1]['success_rate'], 1)
+            self.assertEqual(enhancement['plain']['calls_per_receipt'], 1)
+
+        with override_settings(OCR_LIMITS_PATH=self.limits_path):
+            call_command('ocr_limits', reset_enhancement=True, stdout=StringIO())
+        self.assertEqual(clients[0].metrics()['enhancement']['plain']['receipts'], 0)
+
+    def test_command_shows_and_resets(self):
+        """ Test that the ocr_limits command shows the states and closes breakers """
+        breaker = CircuitBreaker(LimitStore(self.limits_path), failure_threshold=1)
+        breaker.record_failure(2)
+        stdout = StringIO()
+
+        with override_settings(OCR_LIMITS_PATH=self.limits_path):
+            call_command('ocr_limits', reset=[2], stdout=stdout)
+
+        self.assertIn('"state": "closed"', stdout.getvalue())
+        self.assertFalse(breaker.is_open(2))
+
+
+class TesseractBackendTest(TestCase):
+    """ Class for the tesseract OCR backend test cases, with pytesseract patched """
+
+    def setUp(self):
+        """ Method to patch pytesseract and read the receipts on a thread of this process """
+        self.pytesseract = Mock()
+        patcher = patch('expensense.ocr_backends.pytesseract', self.pytesseract)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = TesseractBackend(timeout=5)
+        # the worker processes would not see the patched pytesseract
+        self.backend._executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.backend.close)
+
+    def test_receipt_parsed(self):
+        """ Test that the text tesseract reads is parsed for the amount and date """
+        self.pytesseract.image_to_string.return_value = 'Total 12.50\nDate 05/08/2023'
+
+        result = json.loads(self.backend.results('receipt.png'))
+
+        self.assertEqual(result['amount'], 12.5)
+        self.assertEqual(result['date'], {'day': 5, 'month': 8, 'year': 2023})
+        self.pytesseract.image_to_string.assert_called_once_with('receipt.png', config='', timeout=5)
+
+    def test_empty_text_is_partial_parse(self):
+        """ Test that a receipt tesseract reads no text on fails to parse """
+        self.pytesseract.image_to_string.return_value = '  \n'
+        self.assertEqual(json.loads(self.backend.results('receipt.png')), {'error': 'partial parse'})
+
+    def test_killed_tesseract_times_out(self):
+        """ Test that tesseract killed by its timeout fails the receipt with a timeout """
+        self.pytesseract.image_to_string.side_effect = RuntimeError('Tesseract process timeout')
+        with self.assertLogs('expensense.ocr_backends', 'WARNING'):
+            self.assertEqual(json.loads(self.backend.results('receipt.png')), {'error': 'timeout'})
+
+    def test_waiting_receipt_times_out(self):
+        """ Test that a receipt not read within the timeout fails with a timeout """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.pytesseract.image_to_string.side_effect = lambda *args, **kwargs: release.wait(5) and ''
+        self.backend.timeout = 0.1
+
+        with self.assertLogs('expensense.ocr_backends', 'WARNING'):
+            self.assertEqual(json.loads(self.backend.results('receipt.png')), {'error': 'timeout'})
+
+    def test_tesseract_error_fails(self):
+        """ Test that a receipt tesseract can not read fails without raising """
+        self.pytesseract.image_to_string.side_effect = OSError('tesseract is not installed')
+        with self.assertLogs('expensense.ocr_backends', 'WARNING'):
+            self.assertEqual(json.loads(self.backend.results('receipt.png')), {'error': 'OCR request failed'})
+
+    def test_missing_pytesseract(self):
+        """ Test that the backend tells pytesseract is missing """
+        with patch('expensense.ocr_backends.pytesseract', None):
+            with self.assertRaises(ImproperlyConfigured):
+                TesseractBackend()
+
+
+@override_settings(CACHES=OCR_CACHE_SETTINGS)
+class OcrResultCacheTest(TestCase):
+    """ Class for the OCR result cache test cases """
+
+    def setUp(self):
+        """ Method to set up receipts and a query counting its calls """
+        self.temp_dir = tempfile.mkdtemp()
+        self.receipts = []
+        for i in range(2):
+            path = os.path.join(self.temp_dir, f'receipt{i}.png')
+            with open(path, 'wb') as f:
+                f.write(f'receipt {i}'.encode())
+            self.receipts.append(path)
+        self.calls = []
+        self.response = json.dumps({'amount': 12.5, 'date': {'day': 5, 'month': 8, 'year': 2023}})
+
+    def tearDown(self):
+        """ Method to remove the receipts and the cached results """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        shutil.rmtree(OCR_CACHE_SETTINGS['ocr']['LOCATION'], ignore_errors=True)
+
+    def query(self, receipt):
+        """ Method standing in for the OCR API """
+        self.calls.append(receipt)
+        return self.response
+
+    def test_same_receipt_parsed_once(self):
+        """ Test that a receipt with the same content is answered from the cache """
+        cache = OcrResultCache(query=self.query)
+        copy = os.path.join(self.temp_dir, 'copy.png')
+        shutil.copy(self.receipts[0], copy)
+
+        self.assertEqual(cache.results(self.receipts[0]), self.response)
+        self.assertEqual(cache.results(copy), self.response)
+        cache.results(self.receipts[1])
+
+        self.assertEqual(self.calls, [self.receipts[0], self.receipts[1]])
+        self.assertEqual(cache.counters(), {'hits': 1, 'misses': 2, 'coalesced': 0, 'hit_rate': 1 / 3})
+
+    def test_counters_shared_between_processes(self):
+        """ Test that caches sharing a limits database add up their counters for the command """
+        limits_path = os.path.join(self.temp_dir, 'ocr_limits.sqlite3')
+        caches_ = [OcrResultCache(query=self.query, limits_path=limits_path) for i in range(2)]
+        for cache in caches_:
+            cache.results(self.receipts[0])
+
+        self.assertEqual(caches_[0].counters(), {'hits': 1, 'misses': 1, 'coalesced': 0,
+                                                 'hit_rate': 0.5})
+        stdout = StringIO()
+        with override_settings(OCR_LIMITS_PATH=limits_path):
+            call_command('ocr_limits', reset_cache=True, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue().split('\n', 1)[1])['result_cache']['misses'], 0)
+
+    def test_failed_parse_not_cached(self):
+        """ Test that a receipt which was not parsed is queried again """
+        cache = OcrResultCache(query=self.query)
+        self.response = json.dumps({'error': 'partial parse'})
+
+        cache.results(self.receipts[0])
+        cache.results(self.receipts[0])
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_requests_coalesced(self):
+        """ Test that concurrent requests for a receipt share one query """
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_query(receipt):
+            started.set()
+            release.wait(5)
+            return self.query(receipt)
+
+        cache = OcrResultCache(query=slow_query)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leader = executor.submit(cache.results, self.receipts[0])
+            started.wait(5)
+            followers = [executor.submit(cache.results, self.receipts[0]) for i in range(3)]
+            while cache.counters()['coalesced'] < 3:
+                time.sleep(0.01)
+            release.set()
+            responses = [future.result(5) for future in [leader] + followers]
+
+        self.assertEqual(responses, [self.response] * 4)
+        self.assertEqual(len(self.calls), 1, f"{FAILURE_HEADER}Concurrent requests were \
+                         not coalesced{FAILURE_FOOTER}")
+
+
+class OcrBackendTest(StubOcrTestCase):
+    """ Class for the pluggable OCR backend test cases """
+
+    def setUp(self):
+        """ Method to start the stub server and reset the configured backend """
+        super().setUp()
+        self.recordings = os.path.join(tempfile.mkdtemp(), 'recordings.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.recordings))
+        expensense.ocr_api._backend = None
+        self.addCleanup(setattr, expensense.ocr_api, '_backend', None)
+
+    def other_receipt(self):
+        """ Method to get a receipt which was not recorded """
+        path = os.path.join(os.path.dirname(self.recordings), 'other.png')
+        with open(path, 'wb') as f:
+            f.write(b'other receipt')
+        return path
+
+    def test_recorded_backend_records_source(self):
+        """ Test that the recorded backend records the responses of its source """
+        self.server.responses[1] = parsed_response('Total 12.50 Date 05/08/2023')
+        backend = RecordedBackend(self.recordings, source=self.make_client())
+        expected = backend.results(self.receipt)
+
+        replay = RecordedBackend(self.recordings)
+        self.assertEqual(replay.results(self.receipt), expected)
+        self.assertEqual(json.loads(replay.results(self.other_receipt())),
+                         {'error': 'not recorded'})
+        self.assertEqual(self.server.engines_called, [1], f"{FAILURE_HEADER}The recording \
+                         was not replayed{FAILURE_FOOTER}")
+
+    def test_recorded_backend_skips_failures(self):
+        """ Test that a response the source failed with is not recorded and read again """
+        class FlakyBackend(OcrBackend):
+            responses = [json.dumps({'error': 'timeout'}), json.dumps({'amount': 12.5, 'date': None})]
+
+            def results(self, receipt):
+                return self.responses.pop(0)
+
+        backend = RecordedBackend(self.recordings, source=FlakyBackend())
+
+        self.assertEqual(json.loads(backend.results(self.receipt)), {'error': 'timeout'})
+        self.assertFalse(os.path.exists(self.recordings))
+        self.assertEqual(json.loads(backend.results(self.receipt))['amount'], 12.5)
+        self.assertEqual(json.loads(RecordedBackend(self.recordings).results(self.receipt))['amount'], 12.5)
+
+    def test_backend_must_read_receipts(self):
+        """ Test that a backend which does not implement results can not be created """
+        class IncompleteBackend(OcrBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend()
+
+    def test_results_use_configured_backend(self):
+        """ Test that results goes through the backend chosen in the settings """
+        self.server.responses[1] = parsed_response('Total 7.25 Date 01/02/2023')
+        RecordedBackend(self.recordings, source=self.make_client()).results(self.receipt)
+
+        with override_settings(OCR_BACKEND='expensense.ocr_backends.RecordedBackend',
+                               OCR_BACKEND_OPTIONS={'recordings': self.recordings}):
+            result = json.loads(ocr_results(self.receipt))
+
+        self.assertEqual(result['amount'], 7.25)
+        self.assertIsInstance(expensense.ocr_api._backend, RecordedBackend)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), CACHES=OCR_CACHE_SETTINGS)
+class ReceiptUploadTest(TestCase):
+    """ Class for the upload once receipt token test cases """
+
+    def setUp(self):
+        """ Method to set up an employee and a stand in for the OCR API """
+        company = Company.objects.create(company='Company', company_budget=1000)
+        self.category = Category.objects.create(category_name='Travel')
+        company.categories.add(self.category)
+        self.user = User.objects.create_user(username='employee', password='testpassword',
+                                             company=company)
+        self.client.login(username='employee', password='testpassword')
+        duplicate_index.clear()
+
+        with open(os.path.join(settings.BASE_DIR, 'media', 'signature_test',
+                               sorted(os.listdir(os.path.join(settings.BASE_DIR, 'media',
+                                                              'signature_test')))[1]), 'rb') as f:
+            self.receipt_bytes = f.read()
+        self.calls = []
+        self.response = {'amount': 12.5, 'date': {'day': 5, 'month': 8, 'year': 2023}}
+        patcher = patch('expensense.ocr_cache.result_cache.query', side_effect=self.query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # count the cache hits within the test rather than in the limits database
+        patcher = patch('expensense.ocr_cache.result_cache.counts', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # run the OCR jobs within the request unless a test queues them
+        self.pool = OcrJobPool(0, 1)
+        patcher = patch('expensense.ocr_jobs.get_pool', side_effect=lambda: self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """ Method to remove the uploaded files and cached results """
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(OCR_CACHE_SETTINGS['ocr']['LOCATION'], ignore_errors=True)
+
+    def query(self, receipt):
+        """ Method standing in for the OCR API """
+        self.calls.append(receipt)
+        return json.dumps(self.response)
+
+    def preview(self):
+        """ Method to upload the receipt for the OCR preview and return its data """
+        response = self.client.post(reverse('expensense:ocr_api'), {
+            'file': SimpleUploadedFile('receipt.png', self.receipt_bytes)})
+        return response, response.json()
+
+    def log_expense(self, **data):
+        """ Method to submit the expense form with the given receipt fields """
+        return self.client.post(reverse('expensense:log_expense'), {
+            'expense_name': 'Taxi',
+            'amount': '12.50',
+            'expense_date': '2023-08-05',
+            'category': self.category.id,
+            **data,
+        })
+
+    def test_expense_logged_with_token(self):
+        """ Test that the expense keeps the file stored by the OCR preview """
+        response, data = self.preview()
+        upload = ReceiptUpload.objects.get()
+        self.assertEqual(data['status'], ReceiptUpload.ocr_done)
+        self.assertEqual(data['amount'], 12.5)
+        self.assertEqual(data['receipt_token'], upload.token)
+
+        self.log_expense(receipt_token=data['receipt_token'])
+
+        expense = Expense.objects.get()
+        self.assertEqual(expense.receipt.name, upload.receipt.name, f"{FAILURE_HEADER}The \
+                         receipt was stored again{FAILURE_FOOTER}")
+        self.assertEqual(expense.receipt_hash, hash_to_str(dhash(self.receipt_bytes)))
+        self.assertTrue(os.path.exists(expense.receipt.path))
+        self.assertFalse(ReceiptUpload.objects.exists())
+
+    def test_same_receipt_parsed_once(self):
+        """ Test that previewing the same receipt twice queries the OCR API once """
+        self.preview()
+        self.preview()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(ReceiptUpload.objects.count(), 2)
+
+    def test_token_of_other_user_rejected(self):
+        """ Test that a receipt uploaded by another user cannot be claimed """
+        response, data = self.preview()
+        other = User.objects.create_user(username='other', password='testpassword',
+                                         company=self.user.company)
+        self.client.login(username='other', password='testpassword')
+
+        self.log_expense(receipt_token=data['receipt_token'])
+
+        self.assertFalse(Expense.objects.exists())
+        self.assertTrue(ReceiptUpload.objects.exists())
+
+    def test_expense_logged_with_file(self):
+        """ Test that the receipt can still be submitted with the form """
+        self.log_expense(receipt=SimpleUploadedFile('receipt.png', self.receipt_bytes))
+
+        self.assertEqual(Expense.objects.get().receipt_hash, hash_to_str(dhash(self.receipt_bytes)))
+
+    def test_receipt_which_is_not_an_image_rejected(self):
+        """ Test that a file which is not an image is not stored for the OCR preview """
+        response = self.client.post(reverse('expensense:ocr_api'), {
+            'file': SimpleUploadedFile('receipt.png', b'<script>alert(1)</script>')})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        self.assertFalse(ReceiptUpload.objects.exists())
+
+    @override_settings(RECEIPT_MAX_UPLOAD_SIZE=1024)
+    def test_large_receipt_rejected(self):
+        """ Test that a receipt over the size limit is not stored """
+        response, data = self.preview()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ReceiptUpload.objects.exists())
+        self.assertEqual(self.calls, [])
+
+    def test_job_polled_until_done(self):
+        """ Test that the upload returns at once and the status is polled for the result """
+        self.pool = OcrJobPool(1, 1)
+        queued = []
+        with patch.object(self.pool, 'submit', side_effect=lambda upload_id: queued.append(upload_id)
+                          or Future()):
+            response, data = self.preview()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['status'], ReceiptUpload.ocr_pending)
+        self.assertEqual(self.calls, [], f"{FAILURE_HEADER}The upload waited for the \
+                         OCR{FAILURE_FOOTER}")
+        self.assertEqual(self.client.get(data['status_url']).json()['status'],
+                         ReceiptUpload.ocr_pending)
+
+        run_job(queued[0])
+        status = self.client.get(data['status_url']).json()
+        self.assertEqual(status['status'], ReceiptUpload.ocr_done)
+        self.assertEqual(status['date'], self.response['date'])
+
+    def test_full_queue_fails_job(self):
+        """ Test that an upload is not read while the queue is full """
+        self.pool = OcrJobPool(1, 1)
+        with patch.object(self.pool, 'submit', return_value=None):
+            response, data = self.preview()
+
+        self.assertEqual(data['status'], ReceiptUpload.ocr_failed)
+        self.assertIn('error', data)
+        self.assertEqual(self.calls, [])
+
+    def test_status_of_other_user_hidden(self):
+        """ Test that the status of an upload of another user is not found """
+        response, data = self.preview()
+        User.objects.create_user(username='other', password='testpassword',
+                                 company=self.user.company)
+        self.client.login(username='other', password='testpassword')
+
+        self.assertEqual(self.client.get(data['status_url']).status_code, 404)
+
+
+class OcrPreprocessTest(TestCase):
+    """ Class for the preparation of the receipts sent to the OCR API test cases """
+
+    def setUp(self):
+        """ Method to set up a phone camera sized photo of a sample receipt """
+        sample_dir = os.path.join(settings.BASE_DIR, 'media', 'signature_test')
+        self.receipts = [os.path.join(sample_dir, name) for name in sorted(os.listdir(sample_dir))]
+        img = cv2.imread(self.receipts[1])
+        img = cv2.resize(img, (4000, round(img.shape[0] * 4000 / img.shape[1])))
+        self.photo = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+    def test_photo_compressed_within_budget(self):
+        """ Test that a photo is sent as a smaller grayscale JPEG within the budget """
+        name, content = compress_receipt(self.photo, max_side=2000, max_bytes=200 * 1024)
+
+        img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(name, 'receipt.jpg')
+        self.assertLessEqual(len(content), 200 * 1024)
+        self.assertEqual(img.ndim, 2, f"{FAILURE_HEADER}The receipt was not converted to \
+                         grayscale{FAILURE_FOOTER}")
+        self.assertLessEqual(max(img.shape), 2000)
+
+    def test_small_budget_shrinks_receipt(self):
+        """ Test that the receipt is scaled down when the lowest quality does not fit """
+        name, content = compress_receipt(self.photo, max_side=2000, max_bytes=20 * 1024)
+
+        img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertLessEqual(len(content), 20 * 1024)
+        self.assertLess(max(img.shape), 2000)
+
+    def test_small_receipt_kept(self):
+        """ Test that a receipt which is smaller as it was uploaded is kept """
+        img = np.full((1000, 800), 255, dtype=np.uint8)
+        cv2.putText(img, 'TOTAL 12.50', (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'scan.png')
+        cv2.imwrite(path, img)
+
+        name, content = compress_receipt(path)
+
+        self.assertEqual(name, 'scan.png')
+        with open(path, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+    def small_scan(self, **save_options):
+        """ Method to get a small scan saved by PIL with the options, e.g. its metadata """
+        img = np.full((1000, 800), 255, dtype=np.uint8)
+        cv2.putText(img, 'TOTAL 12.50', (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+        output = io.BytesIO()
+        Image.fromarray(img).save(output, **save_options)
+        return output.getvalue()
+
+    def exif(self, orientation):
+        """ Method to get EXIF with a camera and the orientation """
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'
+        exif[0x0112] = orientation
+        return exif.tobytes()
+
+    def test_kept_receipt_metadata_stripped(self):
+        """ Test that a receipt kept as it was uploaded is sent without its metadata """
+        jpeg = self.small_scan(format='JPEG', quality=30, exif=self.exif(1), comment=b'secret place')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Location', 'secret place')
+        png = self.small_scan(format='PNG', pnginfo=info)
+
+        for original, name in ((jpeg, 'receipt.jpg'), (png, 'receipt.jpg')):
+            sent_name, content = compress_receipt(original)
+            self.assertEqual(sent_name, name)
+            self.assertLess(len(content), len(original), f"{FAILURE_HEADER}The receipt was \
+                            not kept{FAILURE_FOOTER}")
+            self.assertNotIn(b'PhoneMaker', content)
+            self.assertNotIn(b'secret place', content)
+            np.testing.assert_array_equal(cv2.imdecode(np.frombuffer(content, np.uint8), 0),
+                                          cv2.imdecode(np.frombuffer(original, np.uint8), 0))
+
+    def test_rotated_receipt_reencoded(self):
+        """ Test that a photo rotated by its EXIF is re-encoded rather than sent without it """
+        original = self.small_scan(format='JPEG', quality=30, exif=self.exif(6))
+
+        name, content = compress_receipt(original)
+
+        self.assertNotIn(b'PhoneMaker', content)
+        self.assertEqual(cv2.imdecode(np.frombuffer(content, np.uint8), 0).shape,
+                         cv2.imdecode(np.frombuffer(original, np.uint8), 0).shape)
+
+    def skewed_receipt(self, angle):
+        """ Method to draw a receipt lying rotated by the angle on a dark table """
+        paper = np.full((1100, 800), 235, dtype=np.uint8)
+        for line in range(20):
+            cv2.putText(paper, f'ITEM {line}  {line * 3}.50', (60, 80 + line * 45),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, 20, 2)
+        table = np.full((1600, 1400), 60, dtype=np.uint8)
+        table[250:1350, 300:1100] = paper
+        rotation = cv2.getRotationMatrix2D((700, 800), angle, 1.0)
+        return cv2.warpAffine(table, rotation, (1400, 1600), borderValue=60)
+
+    def test_skew_estimated(self):
+        """ Test that the rotation which straightens a receipt is found """
+        for angle in (-7, 0, 5):
+            self.assertAlmostEqual(skew_angle(self.skewed_receipt(angle)), -angle, delta=0.5)
+
+    def test_enhanced_receipt_cropped_straightened_binarized(self):
+        """ Test that the enhancement crops the table away and straightens the text """
+        img = enhance_receipt(self.skewed_receipt(5))
+
+        self.assertEqual(set(np.unique(img)), {0, 255})
+        self.assertLess(img.shape[0] * img.shape[1], 0.6 * 1600 * 1400, f"{FAILURE_HEADER}The \
+                        receipt was not cropped{FAILURE_FOOTER}")
+        self.assertAlmostEqual(skew_angle(img), 0, delta=0.5)
+
+    def test_text_on_white_not_cropped(self):
+        """ Test that a scan without a background around the receipt is kept whole """
+        img = np.full((1000, 800), 255, dtype=np.uint8)
+        cv2.putText(img, 'TOTAL 12.50', (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+
+        self.assertEqual(crop_border(img).shape, img.shape)
+
+
+class ReceiptParserTest(TestCase):
+    """ Class for the extraction of the amount and date from the OCR text test cases """
+
+    def test_stored_texts_parsed(self):
+        """ Test that the amount and date of every stored OCR text are found """
+        with open(os.path.join(settings.BASE_DIR, 'media', 'ocr_test', 'receipt_texts.json')) as f:
+            corpus = json.load(f)
+
+        for receipt in corpus:
+            self.assertEqual(find_amount(receipt['text']), receipt['amount'], f"{FAILURE_HEADER}Wrong \
+                             amount found in {receipt['text']!r}{FAILURE_FOOTER}")
+            self.assertEqual(list(find_date(receipt['text'])), receipt['date'], f"{FAILURE_HEADER}Wrong \
+                             date found in {receipt['text']!r}{FAILURE_FOOTER}")
+
+    def test_date_formats(self):
+        """ Test that the common date formats are read """
+        self.assertEqual(find_date('05/08/2023'), (5, 8, 2023))
+        self.assertEqual(find_date('2023-08-05'), (5, 8, 2023))
+        self.assertEqual(find_date('5 Aug 2023'), (5, 8, 2023))
+        self.assertEqual(find_date('August 5, 2023'), (5, 8, 2023))
+        self.assertEqual(find_date('05.08.23'), (5, 8, 2023))
+        self.assertEqual(find_date('08/25/2023'), (25, 8, 2023))
+        self.assertEqual(find_date('Total 12.50'), (0, 0, 0))
+
+    def test_impossible_dates_skipped(self):
+        """ Test that numbers which are no real date are not read as one """
+        self.assertEqual(find_date('Ref 45/67/2023 Date 01/02/2023'), (1, 2, 2023))
+
+    def test_grand_total_preferred(self):
+        """ Test that the grand total wins over the subtotal, tax and change """
+        text = 'Subtotal 100.00\nTax 8.00\nGrand Total $108.00\nCash 120.00\nChange 12.00'
+
+        self.assertEqual(find_amount(text), 108.0)
+
+    def test_label_on_line_above(self):
+        """ Test that an amount on the line below its label is found """
+        self.assertEqual(find_amount('TOTAL\n12.00\nThank you'), 12.0)
+
+    def test_thousands_separators(self):
+        """ Test that amounts with thousands separators and decimal commas are read """
+        self.assertEqual(parse_number('1,234.50'), 1234.5)
+        self.assertEqual(parse_number('1.234,50'), 1234.5)
+        self.assertEqual(parse_number('18,90'), 18.9)
+        self.assertEqual(parse_number('1,050'), 1050.0)
+        self.assertEqual(find_amount('Total EUR 1.234,50'), 1234.5)
+
+    def test_candidates_with_confidence(self):
+        """ Test that the other candidates are returned in order of confidence """
+        data = parse_text('Subtotal 10.00\nTotal 11.00\nDate 05/08/2023')
+
+        self.assertEqual(data['amount'], 11.0)
+        self.assertEqual(data['date'], {'day': 5, 'month': 8, 'year': 2023})
+        self.assertEqual([c['value'] for c in data['candidates']['amounts']], [11.0, 10.0])
+        self.assertGreater(data['confidence']['amount'], data['candidates']['amounts'][1]['confidence'])
+        self.assertEqual(data['candidates']['dates'][0]['value'], '2023-08-05')
+
+    def test_nothing_found(self):
+        """ Test that a text without an amount or date parses to zeros """
+        data = parse_text('Thank you for shopping')
+
+        self.assertEqual(data['amount'], 0)
+        self.assertEqual(data['date'], {'day': 0, 'month': 0, 'year': 0})
+        self.assertEqual(data['candidates'], {'amounts': [], 'dates': []})
+
+
+class ExpenseReportTestCase(TestCase):
+    """ Class to set up a company with expenses for the report test cases """
+
+    def setUp(self):
+        """ Method to set up an admin, a manager and employees of two teams with expenses """
+        self.company = Company.objects.create(company='Company', company_budget=1000)
+        self.category = Category.objects.create(category_name='Travel')
+        teams = [Team.objects.create(company=self.company, team_name=f'Team{i}') for i in range(2)]
+        self.admin = User.objects.create_user(username='admin', password='testpassword', role='ADM',
+                                              company=self.company)
+        self.manager = User.objects.create_user(username='manager', password='testpassword', role='MNG',
+                                                company=self.company, team=teams[0])
+        self.employees = [User.objects.create_user(username=f'employee{i}', password='testpassword',
+                                                   company=self.company, team=team)
+                          for i, team in enumerate(teams)]
+        self.start_date, self.end_date = datetime.date(2023, 1, 1), datetime.date(2023, 12, 31)
+
+        # the reports are cached in a directory of the test
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        settings_override = override_settings(REPORT_CACHE_DIR=self.cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def add_expenses(self, user, count):
+        """ Method to add expenses in 2023 for a user """
+        Expense.objects.bulk_create([
+            Expense(user_id=user, expense_name=f'Expense {i}', amount='10.50', category=self.category,
+                    expense_date=datetime.date(2023, i % 12 + 1, 1), receipt='receipt.png')
+            for i in range(count)])
+
+
+class ExpenseReportTest(ExpenseReportTestCase):
+    """ Class for the expense report PDF test cases """
+
+    def report_queries(self, user):
+        """ Method to get the rows of the report of a user and the queries it took """
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(report_rows(scoped_expenses(user, self.start_date, self.end_date)))
+        return rows, len(queries)
+
+    def test_queries_do_not_grow_with_rows(self):
+        """ Test that the category and user of the expenses are not queried per row """
+        self.add_expenses(self.employees[0], 3)
+        rows, few_queries = self.report_queries(self.admin)
+        self.add_expenses(self.employees[0], 30)
+        more_rows, many_queries = self.report_queries(self.admin)
+
+        self.assertEqual(len(more_rows), 33)
+        self.assertEqual(few_queries, many_queries, f"{FAILURE_HEADER}The report queries grow with \
+                         the expenses{FAILURE_FOOTER}")
+        self.assertEqual(more_rows[0][4:6], ['Travel', 'employee0'])
+
+    def test_expenses_scoped_by_role(self):
+        """ Test that admins see the company, managers their team and employees their own """
+        self.add_expenses(self.employees[0], 2)
+        self.add_expenses(self.employees[1], 3)
+        self.add_expenses(self.manager, 1)
+
+        self.assertEqual(scoped_expenses(self.admin, self.start_date, self.end_date).count(), 6)
+        self.assertEqual(scoped_expenses(self.manager, self.start_date, self.end_date).count(), 3)
+        self.assertEqual(scoped_expenses(self.employees[1], self.start_date, self.end_date).count(), 3)
+
+    def test_rows_split_into_tables(self):
+        """ Test that the rows are laid out as tables of a page each with the header """
+        rows = [[str(i), '01/01/2023', 'Taxi', '1.00', 'Travel', 'employee0', 'Pending']
+                for i in range(100)]
+
+        tables = list(report_tables(iter(rows), 40))
+
+        self.assertEqual([len(table._cellvalues) for table in tables], [41, 41, 21])
+        self.assertEqual(tables[1]._cellvalues[0][0], 'S. No')
+        self.assertEqual(tables[2].repeatRows, 1)
+
+    def test_report_spans_pages(self):
+        """ Test that a long report is written over several pages """
+        rows = ([str(i), '01/01/2023', 'Taxi', '1.00', 'Travel', 'employee0', 'Pending']
+                for i in range(200))
+        output = io.BytesIO()
+
+        build_report(output, rows, 'Company', 'Ad Min', self.start_date, self.end_date)
+
+        self.assertTrue(output.getvalue().startswith(b'%PDF'))
+        self.assertGreaterEqual(output.getvalue().count(b'/Type /Page\n'), 5)
+
+    def test_long_text_wrapped(self):
+        """ Test that a text too wide for its column is wrapped in full, not cut """
+        name = 'A very long expense name for a dinner with clients & <partners>'
+        self.assertEqual(cell_text('Taxi', 100), 'Taxi')
+        self.assertIsInstance(cell_text(name, 100), Paragraph)
+
+        Expense.objects.create(user_id=self.employees[0], expense_name=name, amount='10.50',
+                               category=self.category, expense_date=datetime.date(2023, 1, 1),
+                               receipt='receipt.png')
+        rows, _ = self.report_queries(self.admin)
+        table = list(report_tables(iter(rows), 40))[0]
+        table.wrap(500, 800)
+
+        self.assertEqual(rows[0][2].getPlainText(), name)
+        self.assertGreater(table._rowHeights[1], ROW_HEIGHT, f"{FAILURE_HEADER}Wrapped \
+                           row was not made taller{FAILURE_FOOTER}")
+
+    def test_view_downloads_pdf(self):
+        """ Test that the monthly report link downloads the PDF """
+        self.add_expenses(self.employees[0], 5)
+        self.client.login(username='admin', password='testpassword')
+
+        response = self.client.get(reverse('expensense:generate_monthly_expense_pdf',
+                                           args=['2023-01-01', '2023-12-31']))
+
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+
+class ReportCacheTest(ExpenseReportTestCase):
+    """ Class for the cached expense report test cases """
+
+    def setUp(self):
+        """ Method to set up the expenses and log in the admin """
+        super().setUp()
+        self.add_expenses(self.employees[0], 5)
+        self.client.login(username='admin', password='testpassword')
+        self.url = reverse('expensense:generate_monthly_expense_pdf', args=['2023-01-01', '2023-12-31'])
+
+    def download(self, **headers):
+        """ Method to download the report, returns the response and whether it was built """
+        with patch('expensense.report.build_report', side_effect=build_report) as build:
+            response = self.client.get(self.url, **headers)
+            if response.status_code == 200:
+                b''.join(response.streaming_content)
+        return response, build.called
+
+    def test_repeat_download_served_from_cache(self):
+        """ Test that the report is only built for the first download """
+        first, built_first = self.download()
+        second, built_second = self.download()
+
+        self.assertTrue(built_first)
+        self.assertFalse(built_second, f"{FAILURE_HEADER}The cached report was built \
+                         again{FAILURE_FOOTER}")
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertIn('Last-Modified', second)
+
+    def test_current_report_not_modified(self):
+        """ Test that a client with the current report gets a 304 """
+        first, _ = self.download()
+
+        response, built = self.download(HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(built)
+
+    def test_unmodified_since_report_not_modified(self):
+        """ Test that a client asking if the report changed since it got it gets a 304 until it does """
+        first, _ = self.download()
+
+        response, built = self.download(HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304, f"{FAILURE_HEADER}If-Modified-Since \
+                         was ignored{FAILURE_FOOTER}")
+        self.assertFalse(built)
+
+        Expense.objects.filter(user_id=self.employees[0]).first().save()
+        response, built = self.download(HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(built)
+
+    def test_expense_change_invalidates(self):
+        """ Test that changing an expense of the scope builds the report again """
+        first, _ = self.download()
+        expense = Expense.objects.filter(user_id=self.employees[0]).first()
+        expense.amount = '99.00'
+        expense.save()
+
+        response, built = self.download(HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(built)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_unreported_change_keeps_version(self):
+        """ Test that saving a field the reports do not show keeps the version """
+        expense = Expense.objects.filter(user_id=self.employees[0]).first()
+        expense.save()
+        version = scope_version(report_scope(self.admin))
+
+        expense.similarity = 90
+        expense.save(update_fields=['similarity'])
+
+        self.assertEqual(scope_version(report_scope(self.admin)), version)
+        self.assertEqual(scope_version(report_scope(self.employees[1])), 0)
+
+    def test_category_rename_invalidates(self):
+        """ Test that renaming a category shown in the report builds the report again """
+        first, _ = self.download()
+        self.category.category_name = 'Trips'
+        self.category.save()
+
+        response, built = self.download(HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(built)
+
+    def test_user_rename_and_move_invalidate(self):
+        """ Test that renaming a user or moving them to another team changes both teams' reports """
+        employee = self.employees[0]
+        old_team, new_team = employee.team, self.employees[1].team
+        versions = lambda: [scope_version(f'team-{team.id}') for team in (old_team, new_team)]
+        before = versions()
+
+        employee.username = 'renamed'
+        employee.save()
+        renamed = versions()
+        employee.team = new_team
+        employee.save()
+        moved = versions()
+
+        self.assertEqual(renamed, [before[0] + 1, before[1]])
+        self.assertEqual(moved, [renamed[0] + 1, renamed[1] + 1])
+
+    def test_login_keeps_version(self):
+        """ Test that saving the last login of a user does not invalidate the reports """
+        version = scope_version(report_scope(self.admin))
+        self.client.login(username='employee0', password='testpassword')
+
+        self.assertEqual(scope_version(report_scope(self.admin)), version)
+
+    def test_least_recently_used_evicted(self):
+        """ Test that the report served longest ago is removed when the cache is full """
+        cache = ReportCache(self.cache_dir, max_bytes=250)
+        for key in ('a', 'b'):
+            cache.put(key, lambda f: f.write(b'x' * 100))
+            os.utime(cache.path(key), (time.time() - 100, time.time() - 100))
+        cache.get('a')
+
+        cache.put('c', lambda f: f.write(b'x' * 100))
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.size(), 200)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), REPORT_JOBS_PER_USER=2)
+class ReportJobTest(ExpenseReportTestCase):
+    """ Class for the reports generated in the background test cases """
+
+    def setUp(self):
+        """ Method to set up the expenses and generate the reports within the request """
+        super().setUp()
+        self.add_expenses(self.employees[0], 5)
+        self.client.login(username='admin', password='testpassword')
+        self.pool = ReportJobPool(0, 1)
+        patcher = patch('expensense.report_jobs.get_pool', side_effect=lambda: self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """ Method to remove the generated reports """
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def submit(self):
+        """ Method to submit the report form for 2023 """
+        return self.client.post(reverse('expensense:generate_expense_pdf'),
+                                {'start_date': '2023-01-01', 'end_date': '2023-12-31'})
+
+    def test_form_redirects_to_status_and_download(self):
+        """ Test that the form queues the report and its status page links the download """
+        response = self.submit()
+        job = ReportJob.objects.get()
+
+        self.assertRedirects(response, reverse('expensense:report_job', args=[job.token]))
+        status_page = self.client.get(response.url)
+        self.assertContains(status_page, reverse('expensense:report_download', args=[job.token]))
+        self.assertNotContains(status_page, 'http-equiv="refresh"')
+
+        download = self.client.get(reverse('expensense:report_download', args=[job.token]))
+        self.assertEqual(download['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(download.streaming_content).startswith(b'%PDF'))
+
+    def test_pending_job_refreshes(self):
+        """ Test that the status page of a report being generated refreshes """
+        job = ReportJob.objects.create(token='pending', user=self.admin, start_date=self.start_date,
+                                       end_date=self.end_date)
+
+        response = self.client.get(reverse('expensense:report_job', args=[job.token]))
+
+        self.assertContains(response, 'http-equiv="refresh"')
+        self.assertEqual(self.client.get(reverse('expensense:report_download',
+                                                 args=[job.token])).status_code, 404)
+
+    def test_per_user_limit(self):
+        """ Test that a user cannot queue more reports than allowed at once """
+        for i in range(2):
+            ReportJob.objects.create(token=f'running{i}', user=self.admin, status=ReportJob.running,
+                                     start_date=self.start_date, end_date=self.end_date)
+
+        response = self.submit()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'reports being generated')
+        self.assertEqual(ReportJob.objects.count(), 2)
+
+    def test_interrupted_jobs_do_not_count(self):
+        """ Test that jobs whose process died are failed and do not count against the limit """
+        for i in range(2):
+            ReportJob.objects.create(token=f'running{i}', user=self.admin, status=ReportJob.running,
+                                     start_date=self.start_date, end_date=self.end_date,
+                                     started_at=timezone.now() - timedelta(hours=1))
+
+        response = self.submit()
+
+        job = ReportJob.objects.latest('id')
+        self.assertRedirects(response, reverse('expensense:report_job', args=[job.token]))
+        self.assertEqual(ReportJob.objects.filter(status=ReportJob.failed).count(), 2)
+        self.assertIn('interrupted', ReportJob.objects.get(token='running0').error)
+
+    def test_status_of_interrupted_job_stops_refreshing(self):
+        """ Test that the status page of a job queued for too long shows it failed """
+        job = ReportJob.objects.create(token='queued', user=self.admin, start_date=self.start_date,
+                                       end_date=self.end_date)
+        ReportJob.objects.filter(id=job.id).update(created_at=timezone.now() - timedelta(hours=1))
+
+        response = self.client.get(reverse('expensense:report_job', args=[job.token]))
+
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, 'Try again')
+
+    def test_failed_job_is_not_run(self):
+        """ Test that a job failed as stale before it ran stays failed """
+        job = ReportJob.objects.create(token='stale', user=self.admin, status=ReportJob.failed,
+                                       start_date=self.start_date, end_date=self.end_date)
+
+        report_run_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.failed, f"{FAILURE_HEADER}A failed job was \
+                         run again{FAILURE_FOOTER}")
+        self.assertFalse(job.report)
+
+    def test_job_failed_while_running_stays_failed(self):
+        """ Test that a job failed as stale while its report was generated is not marked done """
+        job = ReportJob.objects.create(token='slow', user=self.admin, start_date=self.start_date,
+                                       end_date=self.end_date)
+
+        def fail_stale(*args):
+            ReportJob.objects.filter(id=job.id).update(status=ReportJob.failed)
+            return build_report(*args)
+
+        with patch('expensense.report_jobs.build_report', side_effect=fail_stale):
+            report_run_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.failed)
+        self.assertFalse(job.report)
+
+    def test_full_queue_fails_job(self):
+        """ Test that a report is failed right away when the queue is full """
+        self.pool = ReportJobPool(1, 1)
+        with patch.object(self.pool, 'submit', return_value=None):
+            self.submit()
+
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, ReportJob.failed)
+        self.assertIn('try again later', job.error)
+
+    def test_report_of_other_user_hidden(self):
+        """ Test that a report cannot be downloaded by another user """
+        self.submit()
+        job = ReportJob.objects.get()
+        self.client.login(username='employee0', password='testpassword')
+
+        response = self.client.get(reverse('expensense:report_download', args=[job.token]))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_expired_reports_deleted(self):
+        """ Test that the reports older than the expiry are deleted with their files """
+        self.submit()
+        job = ReportJob.objects.get()
+        path = job.report.path
+        ReportJob.objects.update(created_at=timezone.now() - timedelta(hours=25))
+
+        call_command('clear_report_jobs', stdout=StringIO())
+
+        self.assertFalse(ReportJob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+
+
+class ExpenseExportTest(ExpenseReportTestCase):
+    """ Class for the CSV and XLSX expense export test cases """
+
+    def export(self, file_format, username='admin', **params):
+        """ Method to get the export of a user for 2023 and its streamed content """
+        self.client.login(username=username, password='testpassword')
+        params = params or {'start_date': '2023-01-01', 'end_date': '2023-12-31'}
+        response = self.client.get(reverse('expensense:export_expenses', args=[file_format]), params)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def csv_rows(self, username='admin'):
+        """ Method to get the rows of the CSV export of a user """
+        response, content = self.export('csv', username)
+        return list(csv.reader(io.StringIO(content.decode())))
+
+    def test_csv_is_streamed(self):
+        """ Test that the CSV export is streamed with the header and a row per expense """
+        self.add_expenses(self.employees[0], 3)
+        response, content = self.export('csv')
+
+        self.assertTrue(response.streaming, f"{FAILURE_HEADER}The CSV export is not streamed{FAILURE_FOOTER}")
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('expenses_2023-01-01_2023-12-31.csv', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(rows[0][:4], ['Expense ID', 'Expense Date', 'Expense Name', 'Amount'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][3:], ['10.50', 'Travel', 'employee0', 'Team0', 'Pending'])
+
+    def test_exports_are_scoped_by_role(self):
+        """ Test that the exports hold the same expenses the reports of each role do """
+        self.add_expenses(self.employees[0], 2)
+        self.add_expenses(self.employees[1], 3)
+
+        self.assertEqual(len(self.csv_rows('admin')), 6)
+        self.assertEqual(len(self.csv_rows('manager')), 3)
+        self.assertEqual(len(self.csv_rows('employee1')), 4)
+
+    def test_csv_formulas_are_neutralized(self):
+        """ Test that names a spreadsheet would run as formulas are written as text """
+        Expense.objects.create(user_id=self.employees[0], expense_name='=HYPERLINK("http://x")',
+                               amount='-5.00', expense_date=datetime.date(2023, 3, 1),
+                               category=Category.objects.create(category_name='@SUM(A1)'),
+                               receipt='receipt.png')
+
+        row = self.csv_rows()[1]
+        self.assertEqual(row[2], '\'=HYPERLINK("http://x")')
+        self.assertEqual(row[4], "'@SUM(A1)")
+        self.assertEqual(row[3], '-5.00', f"{FAILURE_HEADER}A negative amount was quoted{FAILURE_FOOTER}")
+
+    def test_csv_chunks_hold_rows_per_chunk(self):
+        """ Test that the CSV is yielded a chunk of rows at a time """
+        chunks = list(csv_chunks([[i] for i in range(ROWS_PER_CHUNK * 2 + 1)]))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[1].count('\n'), ROWS_PER_CHUNK)
+
+    def test_xlsx_is_a_valid_workbook(self):
+        """ Test that the XLSX export is a zip whose worksheet holds the typed rows """
+        self.add_expenses(self.employees[0], 3)
+        response, content = self.export('xlsx')
+
+        self.assertTrue(response.streaming)
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            self.assertIsNone(workbook.testzip())
+            self.assertIn('[Content_Types].xml', workbook.namelist())
+            sheet = ElementTree.fromstring(workbook.read('xl/worksheets/sheet1.xml'))
+        namespace = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+        rows = sheet.findall('s:sheetData/s:row', namespace)
+
+        self.assertEqual(len(rows), 4)
+        cells = rows[1].findall('s:c', namespace)
+        self.assertEqual(cells[3].find('s:v', namespace).text, '10.50')
+        self.assertIsNone(cells[3].get('t'), f"{FAILURE_HEADER}The amount is not a number \
+                          cell{FAILURE_FOOTER}")
+
+    def test_xlsx_cells(self):
+        """ Test that dates are serial numbers and texts are escaped """
+        self.assertEqual(xlsx_cell(datetime.date(2023, 1, 1)), '<c s="1"><v>44927</v></c>')
+        self.assertIn('<t xml:space="preserve">a &amp; b</t>', xlsx_cell('a & b\x01'))
+        self.assertEqual(xlsx_cell(None), '<c/>')
+
+    def test_xlsx_chunks_stream_large_exports(self):
+        """ Test that the workbook is yielded in several chunks and still reads back """
+        rows = ([i, datetime.date(2023, 1, 1), f'Expense {i}', i] for i in range(ROWS_PER_CHUNK * 3))
+        chunks = list(xlsx_chunks(rows))
+
+        self.assertGreater(len(chunks), 3)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as workbook:
+            self.assertIsNone(workbook.testzip())
+
+    def test_invalid_export_requests(self):
+        """ Test that unknown formats are not found and missing dates are refused """
+        response, content = self.export('pdf')
+        self.assertEqual(response.status_code, 404)
+        response, content = self.export('csv', start_date='not a date')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_requires_login(self):
+        """ Test that an anonymous user is sent to the login """
+        response = self.client.get(reverse('expensense:export_expenses', args=['csv']))
+        self.assertEqual(response.status_code, 302)
+
+
+
+class ParquetExportTest(ExpenseReportTestCase):
+    """ Class for the parquet export test cases """
+
+    def setUp(self):
+        """ Method to set up the expenses and a directory for the dataset """
+        super().setUp()
+        self.add_expenses(self.employees[0], 3)
+        self.add_expenses(self.employees[1], 2)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def age_expenses(self, hours=2):
+        """ Method to make every expense look saved hours ago, update does not touch updated_at """
+        Expense.objects.update(updated_at=timezone.now() - datetime.timedelta(hours=hours))
+
+    def test_changed_expenses_since_watermark(self):
+        """ Test that only the expenses saved after the watermark are exported again """
+        self.age_expenses()
+        expense = Expense.objects.filter(user_id=self.employees[1]).first()
+        expense.amount = '12.00'
+        expense.save()
+
+        rows = list(changed_expenses(since=timezone.now() - datetime.timedelta(minutes=30)))
+        self.assertEqual([row[1] for row in rows], [expense.id])
+        self.assertEqual(len(changed_expenses()), 5)
+
+    def test_renames_export_expenses_again(self):
+        """ Test that renaming what the expenses are exported with has them exported again """
+        since = timezone.now() - datetime.timedelta(minutes=30)
+        team = self.employees[1].team
+        renames = (
+            (lambda: setattr(self.employees[0], 'username', 'renamed') or self.employees[0].save(), 3),
+            (lambda: setattr(team, 'team_name', 'Renamed') or team.save(), 2),
+            (lambda: setattr(self.category, 'category_name', 'Trips') or self.category.save(), 5),
+            (lambda: setattr(self.company, 'company', 'Renamed') or self.company.save(), 5),
+            (lambda: self.category.delete(), 5),
+        )
+        for rename, changed in renames:
+            self.age_expenses()
+            team.save()
+            self.assertEqual(len(changed_expenses(since=since)), 0, f"{FAILURE_HEADER}Saving \
+                             without a change exported expenses again{FAILURE_FOOTER}")
+            rename()
+            self.assertEqual(len(changed_expenses(since=since)), changed, f"{FAILURE_HEADER}\
+                             Renamed expenses were not exported again{FAILURE_FOOTER}")
+
+    def test_changed_expenses_in_partition_order(self):
+        """ Test that the rows come with their company first, ordered by date """
+        rows = list(changed_expenses())
+
+        self.assertTrue(all(row[0] == self.company.id for row in rows))
+        dates = [row[2] for row in rows]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_partition_path(self):
+        """ Test that the partitions are named by company and month """
+        self.assertEqual(partition_path(3, datetime.date(2023, 2, 14)),
+                         os.path.join('company_id=3', 'month=2023-02'))
+
+    def test_watermark_is_kept_in_the_dataset(self):
+        """ Test that the watermark is read back, and is missing before the first export """
+        self.assertIsNone(read_watermark(self.directory))
+        watermark = timezone.now()
+        write_watermark(self.directory, watermark)
+        self.assertEqual(read_watermark(self.directory), watermark)
+
+    def test_dataset_zip_chunks(self):
+        """ Test that the files of a dataset are zipped with their partitions and then removed """
+        partition = os.path.join(self.directory, 'company_id=1', 'month=2023-01')
+        os.makedirs(partition)
+        with open(os.path.join(partition, 'part-1.parquet'), 'wb') as f:
+            f.write(b'x' * 100)
+
+        content = b''.join(dataset_zip_chunks(self.directory, block_size=10))
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ['company_id=1/month=2023-01/part-1.parquet'])
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_invalid_since_is_refused(self):
+        """ Test that the endpoint refuses a since which is not a date and time """
+        self.client.login(username='admin', password='testpassword')
+        response = self.client.get(reverse('expensense:export_parquet'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_needs_pyarrow(self):
+        """ Test that the export tells pyarrow is missing rather than failing """
+        self.client.login(username='admin', password='testpassword')
+        with patch('expensense.parquet_export.pa', None):
+            response = self.client.get(reverse('expensense:export_parquet'))
+            with self.assertRaises(CommandError):
+                call_command('export_parquet', self.directory, stdout=StringIO())
+        self.assertEqual(response.status_code, 501)
+
+    def read_dataset(self, directory=None):
+        """ Method to read a dataset back with its partitions as columns, ordered by expense """
+        table = pq.read_table(directory or self.directory, partitioning='hive')
+        return table.sort_by('expense_id')
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_export_writes_typed_columns(self):
+        """ Test that the dataset reads back with decimal amounts, native dates and the joined names """
+        exported = export_dataset(self.directory)
+        table = self.read_dataset()
+
+        self.assertEqual(exported['rows'], 5)
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.schema.field('amount').type, pa.decimal128(10, 2))
+        self.assertEqual(table.schema.field('expense_date').type, pa.date32())
+        self.assertEqual(table.schema.field('created_at').type, pa.timestamp('us', tz='UTC'))
+        row = table.slice(0, 1).to_pylist()[0]
+        expense = Expense.objects.order_by('id').first()
+        self.assertEqual(row['amount'], Decimal('10.50'))
+        self.assertEqual(row['expense_date'], expense.expense_date)
+        self.assertEqual(row['updated_at'], expense.updated_at)
+        self.assertEqual((row['username'], row['team'], row['company'], row['category'], row['status']),
+                         ('employee0', 'Team0', 'Company', 'Travel', 'Pending'))
+        self.assertEqual(row['company_id'], self.company.id)
+        self.assertEqual(row['month'], '2023-01')
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_export_partitions_by_company_and_month(self):
+        """ Test that every company and month has its own file with its expenses only """
+        other = Company.objects.create(company='Other', company_budget=1000)
+        user = User.objects.create_user(username='other', password='testpassword', company=other)
+        self.add_expenses(user, 1)
+
+        exported = export_dataset(self.directory)
+
+        self.assertEqual(sorted(os.path.dirname(path) for path in exported['files']), sorted([
+            partition_path(self.company.id, datetime.date(2023, month, 1)) for month in (1, 2, 3)
+        ] + [partition_path(other.id, datetime.date(2023, 1, 1))]))
+        for path in exported['files']:
+            table = pq.read_table(os.path.join(self.directory, path))
+            months = {date.strftime('%Y-%m') for date in table.column('expense_date').to_pylist()}
+            self.assertEqual(len(months), 1)
+            self.assertIn(f'month={months.pop()}', path)
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_export_writes_fixed_size_batches(self):
+        """ Test that the rows of a partition are written in row groups of the batch size """
+        Expense.objects.bulk_create([
+            Expense(user_id=self.employees[0], expense_name=f'Taxi {i}', amount='3.00',
+                    expense_date=datetime.date(2023, 1, 2), receipt='receipt.png') for i in range(5)])
+
+        exported = export_dataset(self.directory, batch_rows=2)
+
+        path = next(path for path in exported['files'] if 'month=2023-01' in path)
+        metadata = pq.ParquetFile(os.path.join(self.directory, path)).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)],
+                         [2, 2, 2, 1])
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_incremental_export(self):
+        """ Test that an incremental export only writes the expenses changed since the last one """
+        self.age_expenses()
+        call_command('export_parquet', self.directory, '--incremental', stdout=StringIO())
+        first_watermark = read_watermark(self.directory)
+        self.assertEqual(self.read_dataset().num_rows, 5)
+
+        self.age_expenses()
+        expense = Expense.objects.order_by('id').first()
+        expense.amount = '20.00'
+        expense.save()
+        exported = export_dataset(self.directory, incremental=True)
+
+        self.assertEqual(exported['rows'], 1)
+        self.assertEqual(exported['since'], first_watermark)
+        self.assertGreater(read_watermark(self.directory), first_watermark)
+        # the changed expense is in the dataset twice, the latest row is current
+        rows = [row for row in self.read_dataset().to_pylist() if row['expense_id'] == expense.id]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(max(rows, key=lambda row: row['updated_at'])['amount'], Decimal('20.00'))
+
+        # nothing changed since, so the next export writes no files once the
+        # expenses are older than the overlap with the last export
+        self.age_expenses()
+        self.assertEqual(export_dataset(self.directory, incremental=True)['files'], [])
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_full_export_keeps_the_watermark(self):
+        """ Test that an export which is not incremental does not move the watermark """
+        export_dataset(self.directory)
+        self.assertIsNone(read_watermark(self.directory))
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_endpoint_streams_the_dataset_of_the_user(self):
+        """ Test that the endpoint zips the dataset of the expenses the user may see """
+        self.client.login(username='manager', password='testpassword')
+        response = self.client.get(reverse('expensense:export_parquet'))
+        content = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(parse_datetime(response['X-Export-Watermark']))
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            archive.extractall(self.directory)
+        table = self.read_dataset()
+        self.assertEqual(set(table.column('username').to_pylist()), {'employee0'})
+        self.assertEqual(table.num_rows, 3)
+
+        self.age_expenses()
+        since = timezone.now()
+        response = self.client.get(reverse('expensense:export_parquet'), {'since': since.isoformat()})
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist(), [])
@@ -13,6 +13,7 @@ urlpatterns = [
     path('dashboard/', DashboardView.as_view(), name='dashboard'),
     path('log_expense/', LogExpenseView.as_view(), name='log_expense'),
     path('log_expense/ocr_api/', OcrApiView.as_view(), name='ocr_api'),
+    path('log_expense/ocr_api/<str:token>/', OcrJobView.as_view(), name='ocr_job'),
     path('expenses/', AllExpenseView.as_view(), name='expenses'),
     path('approval_conditions/', ApprovalConditionView.as_view(), name='approval_conditions'),
     path('set_approval_conditions/', SetApprovalConditions.as_view(), name='set_approval_conditions'),
@@ -22,5 +23,9 @@ urlpatterns = [
     path('deny_expense/<int:expense_id>/', DenyExpenseView.as_view(), name='deny_expense'),
     path('generate_expense_pdf/', GenerateExpensePDFView.as_view(), name='generate_expense_pdf'),
     path('generate_expense_pdf/<str:start_date>/<str:end_date>/', GenerateExpensePDFView.as_view(), name='generate_monthly_expense_pdf'),
+    path('report_jobs/<str:token>/', ReportJobView.as_view(), name='report_job'),
+    path('report_jobs/<str:token>/download/', ReportDownloadView.as_view(), name='report_download'),
+    path('export_expenses/<str:file_format>/', ExportExpensesView.as_view(), name='export_expenses'),
+    path('export_parquet/', ParquetExportView.as_view(), name='export_parquet'),
     path('budgets/', BudgetView.as_view(), name='budget'),
 ]
\ No newline at end of file
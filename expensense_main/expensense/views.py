@@ -1,5 +1,5 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, Http404, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views import View
 from expensense.models import *
 from django.contrib.auth import login, authenticate, logout
@@ -10,13 +10,19 @@ from django.contrib.auth.hashers import make_password
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
-from expensense.ocr_api import results
+from expensense.ocr_jobs import job_status, start_job
 from django.utils.datastructures import MultiValueDictKeyError
 import tempfile
-from tempfile import NamedTemporaryFile
+import shutil
+import hashlib
+import secrets
 import os
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from expensense.signature_matching import calculate_similarity
+from expensense.scoring import score_expense
+from expensense.duplicates import dhash, find_duplicate, hash_to_str
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_datetime
 
 from django.core.paginator import Paginator
 from django.db.models import Q, Sum
@@ -24,6 +30,10 @@ from django.db.models.functions import TruncMonth
 
 from datetime import datetime, timedelta
 from expensense.report import generate_pdf
+from expensense.export import EXPORT_WRITERS, export_expenses
+from expensense.parquet_export import dataset_zip_chunks, export_dataset
+from expensense.report import visible_expenses
+from expensense.report_jobs import ReportLimitExceeded, fail_stale_jobs, submit_job
 
 
 class IndexView(View):
@@ -433,25 +443,33 @@ class LogExpenseView(View):
             elif request.user.role == 'ADM':
                 status = 2  # admin approved
             category_obj = Category.objects.get(id = request.POST.get('category'))
-            # run the signature matching before creating an expense object
             # query the user table
             user = User.objects.get(id = request.user.id)
-            receipt = request.FILES['receipt']
-            if user.signature and receipt:
-                with NamedTemporaryFile(delete=False) as temp_receipt_file:
-                    temp_receipt_file.write(receipt.read())
-                    temp_receipt_file.seek(0)
-                    similarity = calculate_similarity(temp_receipt_file.name, user.signature.path)
-                expense.similarity = similarity  # Save similarity to the expense instance
-            
-            # Update or create the expense instance
+            upload = expense_form.cleaned_data.get('receipt_upload')
+            if upload:
+                # the receipt was stored by the OCR preview, keep its file
+                expense.receipt = upload.receipt.name
+                expense.receipt_hash = upload.receipt_hash
+            else:
+                expense.receipt = request.FILES['receipt']
+                expense.receipt_hash = receipt_hash(expense.receipt)
+
+            # flag receipts which look like one already submitted in the company
+            if user.company_id and expense.receipt_hash:
+                expense.duplicate_of_id = find_duplicate(user.company_id, expense.receipt_hash,
+                                                         settings.RECEIPT_DUPLICATE_DISTANCE)
+
+            # Update or create the expense instance, the signature matching
+            # runs in the background once the receipt is stored
             expense.user_id = request.user
             expense.status = status
             expense.category = category_obj
-            expense.receipt = receipt  # Assign the receipt to the expense
+            expense.similarity_pending = bool(user.signature)
             expense.save()
-            # Delete the temporary file after using it
-            os.unlink(temp_receipt_file.name)
+            if upload:
+                upload.delete()
+            if user.signature:
+                score_expense(expense, user.signature.path)
             # once done redirect to dashboard
             return redirect(reverse('expensense:dashboard'))
         else:
@@ -460,32 +478,62 @@ class LogExpenseView(View):
         return self.get(request)
 
 
+def receipt_hash(receipt):
+    """ Method to get the perceptual hash of a receipt file, None when it cannot be decoded """
+    receipt.seek(0)
+    try:
+        return hash_to_str(dhash(receipt.read()))
+    except ValueError:
+        # an image format opencv cannot decode, it is not hashed
+        return None
+    finally:
+        receipt.seek(0)
+
+
 class OcrApiView(View):
     """ This class handles the API call from the template to get expense data from image"""
 
+    @method_decorator(login_required)
     def post(self, request):
-        """ method to handle the post request """
+        """
+        method to handle the post request, the receipt is stored once and
+        its OCR queued. The token returned is the id of the job the page
+        polls, and what the expense form submits instead of the receipt
+        """
         try:
-            # print(request.FILES['file'])
             file = request.FILES['file']
-
-            # save the file in a temp dir
-            temp_dir = tempfile.mkdtemp()
-            file_path = os.path.join(temp_dir, file.name)
-            with open(file_path, 'wb') as temp_dest:
-                for chunk in file.chunks():
-                    temp_dest.write(chunk)
-
-            # run the OCR API on the file
-            response = results(file_path)
-            # remove the temp file and dir
-            os.remove(file_path)
-            os.rmdir(temp_dir)
-            # return response as a json
-
-            return JsonResponse(response, safe=False)
         except MultiValueDictKeyError:
             return JsonResponse({'error': 'File not found in request'}, status=400)
+        if file.size > settings.RECEIPT_MAX_UPLOAD_SIZE:
+            return JsonResponse({'error': 'Receipt is too large'}, status=400)
+        form = ReceiptUploadForm(files=request.FILES)
+        if not form.is_valid():
+            return JsonResponse({'error': form.errors['file'][0]}, status=400)
+        file = form.cleaned_data['file']
+
+        digest = hashlib.sha256()
+        for chunk in file.chunks():
+            digest.update(chunk)
+        upload = ReceiptUpload(token=secrets.token_urlsafe(32), user=request.user,
+                               sha256=digest.hexdigest(), receipt_hash=receipt_hash(file))
+        upload.receipt = file
+        upload.save()
+
+        start_job(upload)
+        status = job_status(upload)
+        status['status_url'] = reverse('expensense:ocr_job', args=[upload.token])
+        return JsonResponse(status, status=202 if upload.ocr_status == ReceiptUpload.ocr_pending
+                            else 200)
+
+
+class OcrJobView(View):
+    """ Class to return the status of the OCR of an uploaded receipt """
+
+    @method_decorator(login_required)
+    def get(self, request, token):
+        """ Method to get the status, with the amount and date once it is done """
+        upload = get_object_or_404(ReceiptUpload, token=token, user=request.user)
+        return JsonResponse(job_status(upload))
 
 
 class AllExpenseView(View):
@@ -706,13 +754,18 @@ class GenerateExpensePDFView(View):
         form = GeneratePdfForm(request.POST)
 
         if form.is_valid():
-            # for valid form get the start and end date and generate the pdf
+            # for valid form get the start and end date and queue the pdf,
+            # which can take longer than the request may for long timeframes
             start_date = form.cleaned_data['start_date']
             end_date = form.cleaned_data['end_date']
 
-            response = generate_pdf(request, start_date, end_date)
+            try:
+                job = submit_job(request.user, start_date, end_date)
+            except ReportLimitExceeded as e:
+                return render(request, 'expensense/expense_pdf_form.html',
+                              {'form': form, 'error': str(e)})
 
-            return response
+            return redirect('expensense:report_job', token=job.token)
 
         return self.get(request)
 
@@ -730,6 +783,86 @@ class GenerateExpensePDFView(View):
         return response
 
 
+class ReportJobView(View):
+    """ Class to show the status of a report generated in the background """
+
+    @method_decorator(login_required)
+    def get(self, request, token):
+        """ Method to get the status page, which refreshes until the report is ready """
+        fail_stale_jobs()
+        job = get_object_or_404(ReportJob, token=token, user=request.user)
+        return render(request, 'expensense/report_job.html', {
+            'job': job,
+            'refresh': job.status in (ReportJob.pending, ReportJob.running),
+        })
+
+
+class ReportDownloadView(View):
+    """ Class to download a report generated in the background """
+
+    @method_decorator(login_required)
+    def get(self, request, token):
+        """ Method to get the file of a finished report """
+        job = get_object_or_404(ReportJob, token=token, user=request.user, status=ReportJob.done)
+        try:
+            report = job.report.open('rb')
+        except (FileNotFoundError, ValueError):
+            raise Http404('The report has expired')
+        return FileResponse(report, as_attachment=True, content_type='application/pdf',
+                            filename=os.path.basename(job.report.name))
+
+
+class ExportExpensesView(View):
+    """ Class to export the expenses of a timeframe as CSV or XLSX """
+
+    @method_decorator(login_required)
+    def get(self, request, file_format):
+        """ Method to stream the export of the expenses the user may see """
+        if file_format not in EXPORT_WRITERS:
+            raise Http404('Unknown export format')
+
+        form = GeneratePdfForm(request.GET)
+        if not form.is_valid():
+            return render(request, 'expensense/expense_pdf_form.html',
+                          {'form': form, 'error': 'Choose a start and end date to export'}, status=400)
+
+        return export_expenses(request.user, form.cleaned_data['start_date'],
+                               form.cleaned_data['end_date'], file_format)
+
+
+class ParquetExportView(View):
+    """ Class to export the expenses a user may see as a zip of a partitioned parquet dataset """
+
+    @method_decorator(login_required)
+    def get(self, request):
+        """
+        Method to export the expenses saved after the since parameter, all of
+        them without it. The watermark to pass as since next time is sent in
+        the X-Export-Watermark header
+        """
+        since = request.GET.get('since')
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None or timezone.is_naive(since):
+                return JsonResponse({'error': 'since is not a date and time with a timezone'},
+                                    status=400)
+
+        directory = tempfile.mkdtemp()
+        try:
+            exported = export_dataset(directory, visible_expenses(request.user), since)
+        except ImproperlyConfigured as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            return JsonResponse({'error': str(e)}, status=501)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        response = StreamingHttpResponse(dataset_zip_chunks(directory), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="expenses_parquet.zip"'
+        response['X-Export-Watermark'] = exported['watermark'].isoformat()
+        return response
+
+
 class BudgetView(View):
     """ Class to get budget for users """
 
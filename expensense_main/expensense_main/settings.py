@@ -135,3 +135,125 @@ MEDIA_URL = '/media/'
 LOGIN_URL = 'expensense:login'
 
 AUTH_USER_MODEL = 'expensense.User'
+
+# Signature similarity is calculated in a pool of worker processes, a size
+# of 0 calculates it within the request. Expenses logged while the queue is
+# full are also scored within the request. The workers are started with
+# gunicorn, uwsgi or runserver, other programs start them on first use.
+SIGNATURE_POOL_SIZE = 2
+SIGNATURE_POOL_QUEUE_DEPTH = 32
+
+# Longest side in pixels receipts are processed at for signature matching,
+# bigger photos are decoded at a reduced resolution. None keeps them as they are.
+SIGNATURE_MAX_WORKING_SIZE = 2048
+
+# Expenses are only auto approved above this signature similarity. Receipts are
+# first scored at SIGNATURE_PRESCREEN_SIZE and only scored again at the working
+# size when that score is within SIGNATURE_CASCADE_BAND of the threshold, a band
+# of None always scores at the working size.
+SIGNATURE_APPROVAL_THRESHOLD = 80
+SIGNATURE_CASCADE_BAND = 5
+SIGNATURE_PRESCREEN_SIZE = 512
+
+# Receipts whose perceptual hashes differ in at most this many of their 64 bits
+# from an earlier receipt of the company are flagged as possible duplicates.
+RECEIPT_DUPLICATE_DISTANCE = 6
+
+# The OCR API is queried over at most OCR_POOL_SIZE keep-alive connections.
+# Every request gives up after the connect and read timeouts in seconds and
+# trying the engines for a receipt after OCR_DEADLINE seconds.
+OCR_ENDPOINT = 'https://api.ocr.space/parse/image'
+OCR_CONNECT_TIMEOUT = 5
+OCR_READ_TIMEOUT = 30
+OCR_DEADLINE = 60
+OCR_POOL_SIZE = 10
+
+# 'sequential' tries the OCR engines in turn, only using the quota of the next
+# engine when a receipt is not parsed. 'racing' queries all of them at once
+# and takes the first parsed result for the lowest latency.
+OCR_ENGINE_POLICY = 'sequential'
+
+# Parsed OCR results are kept on disk by the SHA-256 of the receipt for
+# TIMEOUT seconds, a random third of them is removed once there are more
+# than MAX_ENTRIES.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'ocr': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'ocr_cache'),
+        'TIMEOUT': 7 * 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+# Backend reading the receipts, expensense.ocr_api.OcrClient queries OCR.space,
+# expensense.ocr_backends.TesseractBackend runs tesseract in local worker
+# processes and expensense.ocr_backends.RecordedBackend answers with recorded
+# responses without any network access. The options are passed to the backend.
+OCR_BACKEND = 'expensense.ocr_api.OcrClient'
+OCR_BACKEND_OPTIONS = {}
+
+# Largest receipt in bytes accepted by the OCR preview, which stores it for
+# the expense form to submit by its token.
+RECEIPT_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+# The OCR of uploaded receipts runs on OCR_JOB_WORKERS threads while the page
+# polls for the result, a size of 0 runs it within the upload request. While
+# OCR_JOB_QUEUE_DEPTH jobs are waiting an upload is still stored, but its OCR
+# is failed right away and the details are filled in by hand.
+OCR_JOB_WORKERS = 4
+OCR_JOB_QUEUE_DEPTH = 32
+
+# Receipts are sent to the OCR API as grayscale JPEGs with their longer side
+# at most OCR_MAX_SIDE pixels and at most OCR_MAX_BYTES big, OCR.space rejects
+# bigger files. OCR_COMPRESS = False sends them as they were uploaded.
+OCR_COMPRESS = True
+OCR_MAX_SIDE = 2000
+OCR_MAX_BYTES = 1024 * 1024
+
+# Share of the receipts which are cropped, straightened and binarized before
+# they are sent to the OCR API, a small experiment until its effect on the
+# success rates is known. The rest are sent plain and the success rate of
+# every engine is kept for both, across the processes in the database at
+# OCR_LIMITS_PATH, see OcrClient.metrics() and the ocr_limits command.
+OCR_ENHANCE_RATE = 0.1
+
+# The requests to the OCR API are limited to OCR_RATE_LIMIT per second with
+# bursts of OCR_RATE_BURST across all the server processes, a request waits at
+# most OCR_RATE_LIMIT_WAIT seconds for its turn. An engine failing
+# OCR_BREAKER_THRESHOLD times in a row is not sent requests for
+# OCR_BREAKER_COOLDOWN seconds. Both are kept in the SQLite database at
+# OCR_LIMITS_PATH, 0 disables them. See the ocr_limits management command.
+OCR_LIMITS_PATH = os.path.join(BASE_DIR, 'ocr_limits.sqlite3')
+OCR_RATE_LIMIT = 2
+OCR_RATE_BURST = 10
+OCR_RATE_LIMIT_WAIT = 2
+OCR_BREAKER_THRESHOLD = 5
+OCR_BREAKER_COOLDOWN = 30
+
+# Generated expense reports are kept in REPORT_CACHE_DIR until the expenses
+# they show change, the ones used least recently are removed once they take
+# more than REPORT_CACHE_MAX_BYTES.
+REPORT_CACHE_DIR = os.path.join(BASE_DIR, 'report_cache')
+REPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Reports asked for with the form are generated on REPORT_JOB_WORKERS threads
+# while a status page is shown, a size of 0 generates them within the request.
+# No more are queued while REPORT_JOB_QUEUE_DEPTH are waiting, a user can have
+# REPORT_JOBS_PER_USER being generated at once and the reports are deleted
+# REPORT_JOB_EXPIRY_HOURS after they were asked for. A report still queued or
+# being generated after REPORT_JOB_TIMEOUT_MINUTES is failed, its process
+# died or restarted.
+REPORT_JOB_WORKERS = 2
+REPORT_JOB_QUEUE_DEPTH = 16
+REPORT_JOBS_PER_USER = 2
+REPORT_JOB_EXPIRY_HOURS = 24
+REPORT_JOB_TIMEOUT_MINUTES = 30
+
+# Expenses are written to the parquet exports in record batches of
+# PARQUET_EXPORT_BATCH_ROWS rows, every batch is a row group of the files.
+PARQUET_EXPORT_BATCH_ROWS = 50000
@@ -14,7 +14,11 @@ function hideLoader() {
 const fileInput = document.getElementById('id_receipt');
 if(fileInput != null){
     // add an event listener to the file field
+    const tokenInput = document.getElementById('id_receipt_token');
     fileInput.addEventListener("change",() =>{
+        // send the file with the form until the new one is stored
+        fileInput.setAttribute('name', 'receipt');
+        tokenInput.value = '';
         const file = fileInput.files[0];
         // console.log('File to send ',file)
         const formData = new FormData();
@@ -31,6 +35,14 @@ if(fileInput != null){
             body: formData
         })
         .then(response => response.json())
+        .then(data => {
+            if (data.receipt_token) {
+                // the receipt is stored, the form only submits its token
+                tokenInput.value = data.receipt_token;
+                fileInput.removeAttribute('name');
+            }
+            return pollOcrJob(data);
+        })
         .then(data => {
             console.log('Success: ',data);
             updateFormFields(data);
@@ -45,11 +57,28 @@ if(fileInput != null){
     });
 }
 
+// poll the status of the OCR job every second until the receipt is read
+function pollOcrJob(data, attempts = 90){
+    if (data.status !== 'pending') {
+        return Promise.resolve(data);
+    }
+    if (attempts === 0) {
+        return Promise.reject(new Error('OCR did not finish in time'));
+    }
+    return new Promise(resolve => setTimeout(resolve, 1000))
+        .then(() => fetch(data.status_url))
+        .then(response => response.json())
+        .then(status => pollOcrJob({...status, status_url: data.status_url}, attempts - 1));
+}
+
 
 function updateFormFields(data){
+    if (data.status !== 'done') {
+        return;
+    }
     // extract the data from the JSON
     // console.log('data received is:', data);
-    const { amount, date: { day, month, year } } = JSON.parse(data);
+    const { amount, date: { day, month, year } } = data;
     // console.log('Amount: ', amount);
     // console.log('date: ', day,month,year);
 